@@ -0,0 +1,356 @@
+"""Нагрузочный тест четырёх эндпоинтов сервиса аутентификации.
+
+Примеры запуска из корня репозитория:
+
+    # приложение в текущем процессе, БД из docker/env/.env.dev
+    python -m benchmarks.auth_bench --concurrency 16 --duration 30 --output bench_results.json
+
+    # одноразовый кластер PostgreSQL (нужны initdb и pg_ctl в PATH или --pg-bin)
+    python -m benchmarks.auth_bench --initdb --mix register=1,login=2,status=20,logout=1
+
+    # уже запущенный сервис, например docker
+    python -m benchmarks.auth_bench --url http://localhost:5000
+
+Для каждого эндпоинта отчёт содержит число запросов, ошибки, пропускную способность и p50/p95/p99
+задержки и разбивку по фазам из заголовка Server-Timing: получение соединения из пула, SQL-запросы,
+bcrypt и JWT. У запущенного сервиса для этого должен быть включён SERVER_TIMING_ENABLED.
+Результаты пишутся в JSON-файл, чтобы сравнивать прогоны между собой.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from datetime import datetime
+
+ENDPOINTS = ('register', 'login', 'status', 'logout', 'refresh')
+PHASES = ('db_connect', 'db_query', 'bcrypt', 'jwt')
+
+
+def percentile(sorted_values, fraction):
+    """Перцентиль по ближайшему рангу для отсортированного списка."""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(values):
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'mean_ms': sum(values) / len(values) * 1000 if values else None,
+        'p50_ms': percentile(values, 0.50) * 1000 if values else None,
+        'p95_ms': percentile(values, 0.95) * 1000 if values else None,
+        'p99_ms': percentile(values, 0.99) * 1000 if values else None,
+    }
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f'Unknown endpoint {name!r} in --mix.')
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def parse_server_timing(header):
+    """Разбирает заголовок Server-Timing в словарь {фаза: секунды}."""
+    phases = {}
+    for entry in (header or '').split(','):
+        name, _, params = entry.strip().partition(';')
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'dur' and name:
+                try:
+                    phases[name] = float(value) / 1000
+                except ValueError:
+                    pass
+    return phases
+
+
+class Recorder:
+    """Собирает задержки запросов и фаз по эндпоинтам."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Сбрасывает собранные данные, например после прогрева."""
+        self.latencies = defaultdict(list)
+        self.phases = defaultdict(lambda: defaultdict(list))
+        self.errors = defaultdict(int)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    def record(self, endpoint, duration, status, ok, phases):
+        with self._lock:
+            self.latencies[endpoint].append(duration)
+            self.statuses[endpoint][status] += 1
+            if not ok:
+                self.errors[endpoint] += 1
+            for phase in PHASES:
+                if phase in phases:
+                    self.phases[endpoint][phase].append(phases[phase])
+
+
+class InProcessClient:
+    """Клиент, который вызывает приложение Flask в текущем процессе через тестовый клиент."""
+
+    def __init__(self):
+        from project import create_app
+        self.app = create_app()
+        self.app.config['AUTH_TOKEN_EXPIRATION_SECONDS'] = 3600
+        self.app.config['SERVER_TIMING_ENABLED'] = True
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, token=None):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        headers = {'Authorization': 'Bearer ' + token} if token else {}
+        response = client.open(path, method=method, json=body, headers=headers)
+        return response.status_code, response.get_json(silent=True) or {}, response.headers.get('Server-Timing')
+
+
+class HttpClient:
+    """Клиент для уже запущенного сервиса."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def request(self, method, path, body=None, token=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method)
+        req.add_header('Content-Type', 'application/json')
+        if token:
+            req.add_header('Authorization', 'Bearer ' + token)
+        try:
+            with urllib.request.urlopen(req, timeout=30) as response:
+                return response.status, json.loads(response.read() or b'{}'), response.headers.get('Server-Timing')
+        except urllib.error.HTTPError as e:
+            try:
+                return e.code, json.loads(e.read() or b'{}'), e.headers.get('Server-Timing')
+            except ValueError:
+                return e.code, {}, e.headers.get('Server-Timing')
+
+
+class Worker:
+    """Поток нагрузки: выполняет случайные операции по весам --mix от имени одного пользователя."""
+
+    def __init__(self, client, recorder, weights, password, run_id, worker_id):
+        self.client = client
+        self.recorder = recorder
+        self.names = list(weights)
+        self.weights = [weights[name] for name in self.names]
+        self.password = password
+        self.email = f'bench-{run_id}-{worker_id}@example.com'
+        self.run_id = run_id
+        self.worker_id = worker_id
+        self.registered = 0
+        self.token = None
+        self.refresh_token = None
+
+    def call(self, endpoint, method, path, body=None, token=None, expected=(200,)):
+        started = time.perf_counter()
+        status, data, server_timing = self.client.request(method, path, body=body, token=token)
+        self.recorder.record(endpoint, time.perf_counter() - started, status, status in expected,
+                             parse_server_timing(server_timing))
+        return status, data
+
+    def login(self):
+        status, data = self.call('login', 'POST', '/auth/login', {'email': self.email, 'password': self.password})
+        self.token = data.get('auth_token') if status == 200 else None
+        self.refresh_token = data.get('refresh_token') if status == 200 else None
+
+    def refresh(self):
+        """Получает новый access токен по refresh токену, как клиент, у которого истёк access токен."""
+        status, data = self.call('refresh', 'POST', '/auth/refresh', {'refresh_token': self.refresh_token})
+        self.token = data.get('auth_token') if status == 200 else None
+        if self.token is None:
+            self.login()
+
+    def step(self):
+        endpoint = random.choices(self.names, self.weights)[0]
+        if endpoint == 'register':
+            self.registered += 1
+            email = f'bench-{self.run_id}-{self.worker_id}-{self.registered}@example.com'
+            self.call('register', 'POST', '/auth/register', {'email': email, 'password': self.password},
+                      expected=(201,))
+        elif endpoint == 'login' or (self.token is None and self.refresh_token is None):
+            self.login()
+        elif endpoint == 'refresh' or self.token is None:
+            self.refresh()
+        elif endpoint == 'status':
+            status, _ = self.call('status', 'GET', '/auth/status', token=self.token)
+            if status == 401:
+                self.token = None
+        else:
+            self.call('logout', 'POST', '/auth/logout', {'refresh_token': self.refresh_token}, token=self.token)
+            self.token = None
+            self.refresh_token = None
+
+    def run(self, deadline, stop):
+        while not stop.is_set() and time.monotonic() < deadline:
+            self.step()
+
+
+def start_throwaway_postgres(pg_bin):
+    """Запускает одноразовый кластер PostgreSQL во временном каталоге на unix-сокете.
+    Возвращает каталог кластера и функцию остановки."""
+    def tool(name):
+        path = os.path.join(pg_bin, name) if pg_bin else shutil.which(name)
+        if not path or not os.path.exists(path):
+            sys.exit(f'{name} not found. Put PostgreSQL binaries in PATH or pass --pg-bin.')
+        return path
+
+    data_dir = tempfile.mkdtemp(prefix='flask_auth_bench_')
+    subprocess.run([tool('initdb'), '-D', data_dir, '-U', 'postgres', '-A', 'trust'],
+                   check=True, stdout=subprocess.DEVNULL)
+    subprocess.run([tool('pg_ctl'), '-D', data_dir, '-w', '-l', os.path.join(data_dir, 'server.log'),
+                    '-o', f"-k {data_dir} -c listen_addresses='' -c fsync=off", 'start'],
+                   check=True, stdout=subprocess.DEVNULL)
+    subprocess.run([tool('createdb'), '-h', data_dir, '-U', 'postgres', 'flask_auth_bench'],
+                   check=True)
+
+    def stop():
+        subprocess.run([tool('pg_ctl'), '-D', data_dir, '-m', 'fast', 'stop'], stdout=subprocess.DEVNULL)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    os.environ.update({
+        'SECRET_KEY': os.environ.get('SECRET_KEY', 'bench-secret'),
+        'DEBUG': 'False',
+        'DB_NAME': 'flask_auth_bench',
+        'DB_USER': 'postgres',
+        'DB_PASSWORD': '',
+        'DB_HOST': data_dir,
+        'DB_PORT': '5432',
+    })
+    return stop
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def build_report(args, recorder, elapsed):
+    endpoints = {}
+    for endpoint in ENDPOINTS:
+        latencies = recorder.latencies.get(endpoint)
+        if not latencies:
+            continue
+        report = summarize(latencies)
+        report['throughput_rps'] = len(latencies) / elapsed
+        report['errors'] = recorder.errors[endpoint]
+        report['statuses'] = {str(status): count for status, count in recorder.statuses[endpoint].items()}
+        if recorder.phases[endpoint]:
+            report['phases'] = {phase: summarize(values)
+                                for phase, values in recorder.phases[endpoint].items()}
+        endpoints[endpoint] = report
+    total = sum(len(values) for values in recorder.latencies.values())
+    return {
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'target': args.url or 'in-process',
+        'concurrency': args.concurrency,
+        'duration_s': elapsed,
+        'mix': args.mix,
+        'total_requests': total,
+        'throughput_rps': total / elapsed if elapsed else 0.0,
+        'endpoints': endpoints,
+    }
+
+
+def print_report(report):
+    print(f"{report['total_requests']} requests in {report['duration_s']:.1f}s "
+          f"({report['throughput_rps']:.0f} req/s), concurrency {report['concurrency']}")
+    print(f"{'endpoint':<10}{'count':>8}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for endpoint, stats in report['endpoints'].items():
+        print(f"{endpoint:<10}{stats['count']:>8}{stats['errors']:>8}{stats['throughput_rps']:>9.0f}"
+              f"{stats['p50_ms']:>9.2f}{stats['p95_ms']:>9.2f}{stats['p99_ms']:>9.2f}")
+        for phase, phase_stats in stats.get('phases', {}).items():
+            print(f"  {phase:<12}{phase_stats['count']:>14}{'':>9}"
+                  f"{phase_stats['p50_ms']:>9.2f}{phase_stats['p95_ms']:>9.2f}{phase_stats['p99_ms']:>9.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', help='Base URL of a running service. By default the app runs in-process.')
+    parser.add_argument('--initdb', action='store_true', help='Run against a throwaway PostgreSQL cluster.')
+    parser.add_argument('--pg-bin', help='Directory with initdb, pg_ctl and createdb.')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20.0, help='Seconds of measured load.')
+    parser.add_argument('--warmup', type=float, default=2.0, help='Seconds of unmeasured load before measuring.')
+    parser.add_argument('--mix', default='register=1,login=2,status=20,logout=1',
+                        help='Endpoint weights, e.g. register=1,login=2,status=20,logout=1.')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', default='bench_results.json', help='Where to write the JSON report.')
+    args = parser.parse_args(argv)
+    weights = parse_mix(args.mix)
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    stop_postgres = start_throwaway_postgres(args.pg_bin) if args.initdb else None
+    try:
+        recorder = Recorder()
+        client = HttpClient(args.url) if args.url else InProcessClient()
+        run_id = f'{int(time.time())}-{os.getpid()}'
+        password = 'bench-password'
+        workers = [Worker(client, recorder, weights, password, run_id, i) for i in range(args.concurrency)]
+        for worker in workers:
+            worker.call('register', 'POST', '/auth/register', {'email': worker.email, 'password': password},
+                        expected=(201,))
+            worker.login()
+
+        stop = threading.Event()
+        if args.warmup:
+            deadline = time.monotonic() + args.warmup
+            threads = [threading.Thread(target=worker.run, args=(deadline, stop)) for worker in workers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        recorder.reset()
+
+        started = time.monotonic()
+        deadline = started + args.duration
+        threads = [threading.Thread(target=worker.run, args=(deadline, stop)) for worker in workers]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        except KeyboardInterrupt:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        elapsed = time.monotonic() - started
+
+        report = build_report(args, recorder, elapsed)
+        print_report(report)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f'Results written to {args.output}')
+    finally:
+        if stop_postgres is not None:
+            stop_postgres()
+
+
+if __name__ == '__main__':
+    main()
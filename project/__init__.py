@@ -1,29 +1,79 @@
 import os
 
 from flask import Flask, current_app
-from project.db import create_data_base, create_user_table, create_blacklist_token_table, close_db_conn
+from project.commands import init_db_command, purge_blacklist_command, maintain_blacklist_command, \
+    set_admin_command, import_users_command, generate_signing_key_command
+from project.db import close_db_conn
+from project.hashing import init_hashing_pool
+from project.keys import init_keyring
+from project.metrics import StartupTimer, init_metrics
+from project.migrations import SchemaOutdated
+from project.models import BlacklistToken, init_token_cache, init_user_cache
+from project.storage import init_storage
 from project.views import auth_blueprint
+from project.writer import init_revocation_writer
 from flask_bcrypt import Bcrypt
 
 
+def running_from_cli():
+    """Возвращает True, если приложение создаётся командой flask (init-db, maintain-blacklist и т.д.)."""
+    return os.environ.get('FLASK_RUN_FROM_CLI') == 'true'
+
+
 def create_app():
+    timer = StartupTimer()
     new_app = Flask(__name__)
     app_settings = os.getenv(
         'APP_SETTINGS',
         'project.config.DevelopmentConfig'
     )
-    new_app.config.from_object(app_settings)
+    with timer.step('config'):
+        new_app.config.from_object(app_settings)
     with new_app.app_context():
-        create_data_base()
-        create_user_table()
-        create_blacklist_token_table()
+        with timer.step('keys'):
+            # Команде generate-signing-key ключи не нужны: из CLI они загружаются при первой подписи токена.
+            init_keyring(lazy=running_from_cli())
+        with timer.step('schema'):
+            storage = init_storage()
+            try:
+                storage.ensure_schema(current_app.config['SCHEMA_CHECK_ON_STARTUP'])
+            except SchemaOutdated as e:
+                # Схему обновляет команда init-db, поэтому командам flask устаревшая схема не мешает.
+                if not running_from_cli():
+                    raise
+                print(f'Предупреждение: {e}')
+        with timer.step('blacklist_filter'):
+            BlacklistToken.init_filter()
+        with timer.step('revocation_table'):
+            BlacklistToken.init_revocation_table()
+        init_revocation_writer()
+        with timer.step('caches'):
+            init_token_cache()
+            init_user_cache()
         close_db_conn()
+        new_app.teardown_appcontext(close_db_conn)
         new_app.register_blueprint(auth_blueprint)
+        init_metrics(new_app)
+        new_app.cli.add_command(init_db_command)
+        new_app.cli.add_command(purge_blacklist_command)
+        new_app.cli.add_command(maintain_blacklist_command)
+        new_app.cli.add_command(set_admin_command)
+        new_app.cli.add_command(import_users_command)
+        new_app.cli.add_command(generate_signing_key_command)
         bcrypt = Bcrypt(new_app)
         current_app.config['BCRYPT'] = bcrypt
+        with timer.step('hashing_pool'):
+            init_hashing_pool()
+    timer.finish(new_app.config)
     return new_app
 
 
+def create_asgi_app():
+    """Асинхронный вариант create_app для ASGI-серверов. Требует установленных quart и asyncpg."""
+    from project.aio import create_asgi_app as create_aio_app
+    return create_aio_app()
+
+
 if __name__ == 'main':
     app = create_app()
     app.run('localhost')
@@ -0,0 +1,45 @@
+import os
+
+from quart import Quart
+
+from project.aio.db import init_async_db_pool, close_async_db_pool
+from project.aio.models import AsyncBlacklistToken
+from project.aio.views import auth_blueprint
+from project.hashing import init_hashing_pool
+from project.keys import init_keyring
+from project.models import BlacklistToken, init_token_cache, init_user_cache
+from project.storage import POSTGRES_BACKEND
+
+
+def create_asgi_app():
+    """Создаёт асинхронный (ASGI) вариант приложения на Quart и asyncpg.
+    Схема БД при запуске не создаётся: её нужно подготовить командой init-db.
+    Работает только с хранилищем PostgreSQL."""
+    new_app = Quart(__name__)
+    app_settings = os.getenv(
+        'APP_SETTINGS',
+        'project.config.DevelopmentConfig'
+    )
+    new_app.config.from_object(app_settings)
+    if new_app.config['STORAGE_BACKEND'] != POSTGRES_BACKEND:
+        raise RuntimeError(f'ASGI приложение работает только с {POSTGRES_BACKEND}, '
+                           f'а STORAGE_BACKEND = {new_app.config["STORAGE_BACKEND"]}.')
+    new_app.register_blueprint(auth_blueprint)
+    init_keyring(new_app.config)
+    init_hashing_pool(new_app.config)
+    init_token_cache(new_app.config)
+    init_user_cache(new_app.config)
+    new_app.config['BLACKLIST_FILTER'] = BlacklistToken.create_filter(new_app.config)
+    new_app.config['REVOCATION_TABLE'] = BlacklistToken.create_revocation_table(new_app.config)
+
+    @new_app.before_serving
+    async def startup():
+        await init_async_db_pool()
+        await AsyncBlacklistToken.sync_filter()
+        await AsyncBlacklistToken.sync_revocation_table()
+
+    @new_app.after_serving
+    async def shutdown():
+        await close_async_db_pool()
+
+    return new_app
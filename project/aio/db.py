@@ -0,0 +1,50 @@
+import asyncpg
+from quart import current_app
+
+
+async def init_async_db_pool():
+    """Создаёт пул асинхронных соединений с PostgreSQL по настройкам приложения."""
+    config = current_app.config
+    config['ASYNC_DB_POOL'] = await asyncpg.create_pool(database=config['DB_NAME'],
+                                                        user=config['DB_USER'],
+                                                        password=config['DB_PASSWORD'],
+                                                        host=config['DB_HOST'],
+                                                        port=int(config['DB_PORT']),
+                                                        min_size=config['DB_POOL_MIN_SIZE'],
+                                                        max_size=config['DB_POOL_MAX_SIZE'],
+                                                        max_inactive_connection_lifetime=config[
+                                                            'DB_POOL_IDLE_TIMEOUT'])
+
+
+async def close_async_db_pool():
+    pool = current_app.config.pop('ASYNC_DB_POOL', None)
+    if pool is not None:
+        await pool.close()
+
+
+async def fetchrow(query, *args):
+    """Выполняет запрос на соединении из пула и возвращает первую строку результата."""
+    pool = current_app.config['ASYNC_DB_POOL']
+    async with pool.acquire(timeout=current_app.config['DB_POOL_TIMEOUT']) as conn:
+        return await conn.fetchrow(query, *args)
+
+
+async def fetch(query, *args):
+    """Выполняет запрос на соединении из пула и возвращает все строки результата."""
+    pool = current_app.config['ASYNC_DB_POOL']
+    async with pool.acquire(timeout=current_app.config['DB_POOL_TIMEOUT']) as conn:
+        return await conn.fetch(query, *args)
+
+
+async def execute(query, *args):
+    """Выполняет запрос на соединении из пула в отдельной транзакции."""
+    pool = current_app.config['ASYNC_DB_POOL']
+    async with pool.acquire(timeout=current_app.config['DB_POOL_TIMEOUT']) as conn:
+        return await conn.execute(query, *args)
+
+
+async def fetchval(query, *args):
+    """Выполняет запрос на соединении из пула и возвращает первое значение первой строки результата."""
+    pool = current_app.config['ASYNC_DB_POOL']
+    async with pool.acquire(timeout=current_app.config['DB_POOL_TIMEOUT']) as conn:
+        return await conn.fetchval(query, *args)
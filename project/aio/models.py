@@ -0,0 +1,278 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import jwt
+from quart import current_app
+
+from project.aio.db import fetchrow, fetch, fetchval, execute
+from project.db import get_statement
+from project.hashing import HashingPoolBusy, _generate_password_hash, _check_password_hash
+from project.storage import postgres  # noqa: F401 регистрирует запросы моделей
+from project.models import User, _token_hash, _revocation_key, _unverified_payload, UserRecord, \
+    _encode_auth_token, _decode_auth_token, REFRESH_TOKEN_TYPE, CREDENTIAL_FIELDS, PROFILE_FIELDS
+
+
+def _query(name):
+    """Возвращает текст зарегистрированного запроса модели с плейсхолдерами $1, $2, ... для asyncpg,
+    который сам готовит и кэширует prepared statements на каждом соединении."""
+    return get_statement(name, current_app.config).numbered_text
+
+
+async def _run_hashing(fn, *args):
+    """Выполняет bcrypt в пуле процессов, а если пул не настроен, то в пуле потоков цикла событий,
+    чтобы не блокировать цикл событий."""
+    pool = current_app.config.get('HASHING_POOL')
+    if pool is None:
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(pool.submit(fn, *args)), pool.timeout)
+    except asyncio.TimeoutError:
+        raise HashingPoolBusy('Пул хеширования не ответил вовремя.')
+
+
+async def generate_password_hash(password):
+    return await _run_hashing(_generate_password_hash, password, current_app.config.get('BCRYPT_LOG_ROUNDS'))
+
+
+async def check_password_hash(pw_hash, password):
+    return await _run_hashing(_check_password_hash, pw_hash, password)
+
+
+class AsyncUser:
+    """Асинхронный вариант методов, связанных с таблицей User"""
+
+    @staticmethod
+    async def create(email, password):
+        """Метод принимает email и password пользователя.
+        Атомарно сохраняет пользователя в БД и возвращает его профиль
+        или None, если пользователь с таким email уже существует"""
+        # Поиск по уникальному индексу в основной БД дешевле bcrypt, поэтому занятый email отсекается
+        # до хеширования. Гонку двух регистраций по-прежнему разрешает INSERT ... ON CONFLICT.
+        if await fetchval(_query('user_id_by_email'), email):
+            return None
+        password = await generate_password_hash(password)
+        user_data = await fetchrow(_query('create_user'), email, password, datetime.utcnow())
+        if not user_data:
+            return None
+        AsyncUser.invalidate_cache(user_data[0])
+        return UserRecord.from_row(user_data, PROFILE_FIELDS)
+
+    @staticmethod
+    async def get_credentials_by_email(email):
+        """Метод принимает email пользователя.
+        Возвращает UserRecord только с id и хешем пароля или None, если такого пользователя нет в БД"""
+        return UserRecord.from_row(await fetchrow(_query('user_credentials_by_email'), email), CREDENTIAL_FIELDS)
+
+    @staticmethod
+    async def get_profile_by_id(user_id):
+        """Метод принимает user_id пользователя.
+        Возвращает профиль пользователя из кэша пользователей, а при промахе из БД"""
+        user_cache = current_app.config.get('USER_CACHE')
+        if user_cache is not None:
+            row = user_cache.get(AsyncUser._cache_key(user_id))
+            if row is not None:
+                return UserRecord.from_row(row, PROFILE_FIELDS)
+        row = await fetchrow(_query('user_profile_by_id'), user_id)
+        if user_cache is not None and row is not None:
+            user_cache.set(AsyncUser._cache_key(user_id), list(row))
+        return UserRecord.from_row(row, PROFILE_FIELDS)
+
+    @staticmethod
+    async def get_profile_version(user_id):
+        """Метод принимает user_id пользователя.
+        Возвращает версию профиля из кэша пользователей, а при промахе читает из БД только её"""
+        user_cache = current_app.config.get('USER_CACHE')
+        if user_cache is not None:
+            row = user_cache.get(AsyncUser._cache_key(user_id))
+            if row is not None:
+                return UserRecord.from_row(row, PROFILE_FIELDS).version
+        return await fetchval(_query('user_version_by_id'), user_id)
+
+    @staticmethod
+    def _cache_key(user_id):
+        return User._cache_key(user_id)
+
+    @staticmethod
+    def invalidate_cache(user_id):
+        user_cache = current_app.config.get('USER_CACHE')
+        if user_cache is not None:
+            user_cache.delete(AsyncUser._cache_key(user_id))
+
+    @staticmethod
+    def encode_auth_token(user_id):
+        """Метод принимает user_id - id пользователя.
+        Возвращает его jwt токен"""
+        if isinstance(user_id, int):
+            try:
+                return _encode_auth_token(current_app.config, user_id)
+            except Exception as e:
+                print(e)
+        else:
+            print('id пользователя должен иметь тип int.')
+
+    @staticmethod
+    def encode_refresh_token(user_id):
+        """Метод принимает user_id - id пользователя.
+        Возвращает его refresh токен"""
+        if isinstance(user_id, int):
+            try:
+                return _encode_auth_token(current_app.config, user_id, token_type=REFRESH_TOKEN_TYPE)
+            except Exception as e:
+                print(e)
+        else:
+            print('id пользователя должен иметь тип int.')
+
+
+class AsyncBlacklistToken:
+    """Асинхронный вариант методов, связанных с таблицей BlacklistToken"""
+
+    @staticmethod
+    async def save(token):
+        """Метод принимает token. Сохраняет в БД его ключ отзыва и срок действия"""
+        payload = _unverified_payload(token)
+        revocation_key = _revocation_key(token, payload)
+        blacklisted_date = datetime.utcnow()
+        if 'exp' in payload:
+            expires_at = datetime.utcfromtimestamp(payload['exp'])
+        else:
+            expires_at = blacklisted_date + timedelta(seconds=current_app.config.get('AUTH_TOKEN_EXPIRATION_SECONDS'))
+        # Отложенная запись (REVOCATION_WRITER) здесь не нужна: ожидание записи не блокирует цикл событий.
+        # Другие процессы хоста, в том числе синхронные воркеры, видят отзыв через общую таблицу отзывов.
+        await execute(_query('save_token'), revocation_key, expires_at, blacklisted_date)
+        revocation_table = current_app.config.get('REVOCATION_TABLE')
+        if revocation_table is not None:
+            revocation_table.add(revocation_key, expires_at)
+        blacklist_filter = current_app.config.get('BLACKLIST_FILTER')
+        if blacklist_filter is not None:
+            blacklist_filter.add(revocation_key)
+        token_cache = current_app.config.get('TOKEN_CACHE')
+        if token_cache is not None:
+            token_cache.delete(_token_hash(token))
+
+    @staticmethod
+    async def is_token_in_blacklist(token, primary=False):
+        """Метод принимает token. Возвращает True, если токен находится в чёрном списке
+        и False в обратном случае. Чтобы проверить только что отозванный токен, нужно передать primary=True"""
+        return await AsyncBlacklistToken.is_token_hash_in_blacklist(
+            _revocation_key(token, _unverified_payload(token)), primary=primary)
+
+    @staticmethod
+    async def is_token_hash_in_blacklist(token_hash, primary=False):
+        """Метод принимает ключ отзыва токена. Возвращает True, если токен находится в чёрном списке.
+        Общая таблица отзывов хоста, если она включена, отвечает без БД и фильтра. Если фильтр Блума отвечает,
+        что токена точно нет в чёрном списке, запрос в БД не выполняется. С primary=True таблица отзывов
+        не используется и ответ даёт основная БД"""
+        if not primary:
+            is_blacklisted = await AsyncBlacklistToken.lookup_revocation_table(token_hash)
+            if is_blacklisted is not None:
+                return is_blacklisted
+        blacklist_filter = current_app.config.get('BLACKLIST_FILTER')
+        if blacklist_filter is not None:
+            if blacklist_filter.needs_resync():
+                await AsyncBlacklistToken.sync_filter()
+            if not blacklist_filter.might_contain(token_hash):
+                return False
+        is_blacklisted = bool(await fetchrow(_query('is_token_blacklisted'), token_hash))
+        if blacklist_filter is not None:
+            blacklist_filter.record_db_result(is_blacklisted)
+        return is_blacklisted
+
+    @staticmethod
+    async def get_token_hashes_since(since, now):
+        rows = await fetch(_query('token_hashes_since'), since, now)
+        return [bytes(row[0]) for row in rows]
+
+    @staticmethod
+    async def lookup_revocation_table(token_hash):
+        """Асинхронный вариант BlacklistToken.lookup_revocation_table."""
+        revocation_table = current_app.config.get('REVOCATION_TABLE')
+        if revocation_table is None:
+            return None
+        if revocation_table.needs_resync():
+            await AsyncBlacklistToken.sync_revocation_table()
+        return revocation_table.lookup(token_hash)
+
+    @staticmethod
+    async def sync_revocation_table():
+        """Асинхронный вариант BlacklistToken.sync_revocation_table: догружает в общую таблицу отзывов токены,
+        отозванные на других хостах."""
+        revocation_table = current_app.config.get('REVOCATION_TABLE')
+        if revocation_table is None or not revocation_table.try_begin_sync():
+            return
+        try:
+            now = datetime.utcnow()
+            if revocation_table.needs_rebuild():
+                rows = await fetch(_query('revoked_tokens_since'), datetime.min, now)
+                revocation_table.rebuild([(bytes(row[0]), row[1]) for row in rows], now)
+            elif revocation_table.needs_resync():
+                since = revocation_table.synced_at - timedelta(seconds=revocation_table.resync_interval)
+                rows = await fetch(_query('revoked_tokens_since'), since, now)
+                revocation_table.merge([(bytes(row[0]), row[1]) for row in rows], now)
+        except Exception as e:
+            print(f'Возникло исключение {e} при синхронизации таблицы отзывов.')
+        finally:
+            revocation_table.end_sync()
+
+    @staticmethod
+    async def sync_filter():
+        """Догружает в фильтр Блума токены, отозванные другими процессами после прошлой синхронизации."""
+        blacklist_filter = current_app.config.get('BLACKLIST_FILTER')
+        if blacklist_filter is None or not blacklist_filter.try_begin_sync():
+            return
+        try:
+            now = datetime.utcnow()
+            if blacklist_filter.needs_rebuild():
+                blacklist_filter.rebuild(await AsyncBlacklistToken.get_token_hashes_since(datetime.min, now), now)
+            else:
+                since = blacklist_filter.synced_at - timedelta(seconds=blacklist_filter.resync_interval)
+                blacklist_filter.merge(await AsyncBlacklistToken.get_token_hashes_since(since, now), now)
+        except Exception as e:
+            print(f'Возникло исключение {e} при синхронизации фильтра чёрного списка токенов.')
+        finally:
+            blacklist_filter.end_sync()
+
+
+async def decode_auth_token(token):
+    """
+    Асинхронный вариант project.models.decode_auth_token: возвращает субъект токена (id пользователя),
+    если он действительный и не находится в чёрном списке, иначе сообщение об ошибке. Для токенов из кэша
+    сверяется таблица отзывов хоста, чтобы logout в другом процессе был виден сразу.
+    """
+    token_hash = _token_hash(token)
+    token_cache = current_app.config.get('TOKEN_CACHE')
+    if token_cache is not None:
+        cached = token_cache.get(token_hash)
+        if cached is not None:
+            subject, revocation_key = cached
+            if await AsyncBlacklistToken.lookup_revocation_table(revocation_key):
+                return 'Token blacklisted. Please log in again.'
+            return subject
+    try:
+        payload = _decode_auth_token(current_app.config, token)
+        revocation_key = _revocation_key(token, payload)
+        is_blacklisted_token = await AsyncBlacklistToken.is_token_hash_in_blacklist(revocation_key)
+        if is_blacklisted_token:
+            return 'Token blacklisted. Please log in again.'
+        else:
+            if token_cache is not None:
+                token_cache.set(token_hash, (payload['sub'], revocation_key), ttl=payload['exp'] - time.time())
+            return payload['sub']
+    except jwt.ExpiredSignatureError:
+        return 'Signature expired. Please log in again.'
+    except jwt.InvalidTokenError:
+        return 'Invalid token. Please log in again.'
+
+
+async def decode_refresh_token(token):
+    """Асинхронный вариант project.models.decode_refresh_token."""
+    try:
+        payload = _decode_auth_token(current_app.config, token, token_type=REFRESH_TOKEN_TYPE)
+        # Как и в синхронном варианте, отзыв refresh токена проверяется по основной БД.
+        if await AsyncBlacklistToken.is_token_hash_in_blacklist(_revocation_key(token, payload), primary=True):
+            return 'Token blacklisted. Please log in again.'
+        return payload['sub']
+    except jwt.ExpiredSignatureError:
+        return 'Signature expired. Please log in again.'
+    except jwt.InvalidTokenError:
+        return 'Invalid token. Please log in again.'
@@ -0,0 +1,329 @@
+from quart import Blueprint, request, jsonify, current_app, Response
+from quart.views import MethodView
+
+from project.aio.models import AsyncUser, AsyncBlacklistToken, decode_auth_token, decode_refresh_token, \
+    check_password_hash
+from project.hashing import HashingPoolBusy
+from project.keys import get_keyring
+from project.models import user_etag
+
+auth_blueprint = Blueprint('auth', __name__)
+
+
+def hashing_pool_busy_response():
+    """Ответ на запрос, для которого не нашлось места в очереди пула хеширования паролей."""
+    response_object = {
+        'status': 'fail',
+        'message': 'Service is busy. Please try again later.'
+    }
+    retry_after = str(current_app.config.get('BCRYPT_RETRY_AFTER'))
+    return jsonify(response_object), 503, {'Retry-After': retry_after}
+
+
+def profile_cache_headers(etag):
+    """Заголовки ответа с профилем, как в project.views.profile_cache_headers."""
+    return {'ETag': f'"{etag}"', 'Cache-Control': 'private, no-cache', 'Vary': 'Authorization'}
+
+
+def get_auth_token():
+    """Возвращает токен из заголовка Authorization, пустую строку, если заголовка нет,
+    или None, если заголовок не в формате 'Bearer <token>'."""
+    auth_header = request.headers.get('Authorization')
+    if auth_header:
+        try:
+            return auth_header.split(" ")[1]
+        except IndexError:
+            return None
+    return ''
+
+
+class RegisterAPI(MethodView):
+    """
+    Асинхронный API для регистрации пользователя
+    """
+
+    @staticmethod
+    async def post():
+        """Endpoint для обработки post запросов"""
+        post_data = await request.get_json()
+        try:
+            user = await AsyncUser.create(email=post_data.get('email'),
+                                          password=post_data.get('password'))
+            if user:
+                auth_token = AsyncUser.encode_auth_token(user_id=user.id)
+                if auth_token:
+                    response_object = {
+                        'status': 'success',
+                        'message': 'Successfully registered.',
+                        'auth_token': auth_token,
+                        'refresh_token': AsyncUser.encode_refresh_token(user_id=user.id)
+                    }
+                    return jsonify(response_object), 201
+            else:
+                response_object = {
+                    'status': 'fail',
+                    'message': 'User already exists. Please Log in.',
+                }
+                return jsonify(response_object), 202
+        except HashingPoolBusy:
+            return hashing_pool_busy_response()
+        except Exception as e:
+            print(e)
+        response_object = {
+            'status': 'fail',
+            'message': 'Some error occurred. Please try again.'
+        }
+        return jsonify(response_object), 401
+
+
+class LoginAPI(MethodView):
+    """
+    Асинхронный API для авторизации пользователя по email и password
+    """
+
+    @staticmethod
+    async def post():
+        """Endpoint для обработки post запросов"""
+        post_data = await request.get_json()
+        try:
+            user = await AsyncUser.get_credentials_by_email(email=post_data.get('email'))
+            if user:
+                if await check_password_hash(user.password, post_data.get('password')):
+                    auth_token = AsyncUser.encode_auth_token(user_id=user.id)
+                    if auth_token:
+                        response_object = {
+                            'status': 'success',
+                            'message': 'Successfully logged in.',
+                            'auth_token': auth_token,
+                            'refresh_token': AsyncUser.encode_refresh_token(user_id=user.id)
+                        }
+                        return jsonify(response_object), 200
+                    else:
+                        raise Exception('Ошибка при получении токена пользователя')
+                else:
+                    response_object = {
+                        'status': 'fail',
+                        'message': 'Try again.',
+                    }
+                    return jsonify(response_object), 500
+
+            else:
+                response_object = {
+                    'status': 'fail',
+                    'message': 'User does not exist.'
+                }
+                return jsonify(response_object), 404
+        except HashingPoolBusy:
+            return hashing_pool_busy_response()
+        except Exception as e:
+            print(e)
+            response_object = {
+                'status': 'fail',
+                'message': 'Try again.'
+            }
+            return jsonify(response_object), 500
+
+
+class UserAPI(MethodView):
+    """
+    Асинхронный API для аутентификации пользователя по заголовку Authorization
+    """
+
+    @staticmethod
+    async def get():
+        """Endpoint для обработки get запросов"""
+        auth_token = get_auth_token()
+        if auth_token is None:
+            response_object = {
+                'status': 'fail',
+                'message': 'Bearer token malformed.'
+            }
+            return jsonify(response_object), 401
+        if auth_token:
+            resp = await decode_auth_token(auth_token)
+            if not isinstance(resp, str):
+                if request.if_none_match:
+                    version = await AsyncUser.get_profile_version(user_id=resp)
+                    if version is not None and request.if_none_match.contains_weak(user_etag(resp, version)):
+                        return '', 304, profile_cache_headers(user_etag(resp, version))
+                user = await AsyncUser.get_profile_by_id(user_id=resp)
+                if user is None:
+                    response_object = {
+                        'status': 'success',
+                        'data': {}
+                    }
+                    return jsonify(response_object), 200
+                response_object = {
+                    'status': 'success',
+                    'data': user.as_dict()
+                }
+                return jsonify(response_object), 200, profile_cache_headers(user.etag())
+            response_object = {
+                'status': 'fail',
+                'message': resp
+            }
+            return jsonify(response_object), 401
+        else:
+            response_object = {
+                'status': 'fail',
+                'message': 'Provide a valid auth token.'
+            }
+            return jsonify(response_object), 401
+
+
+class LogoutAPI(MethodView):
+    """
+    Асинхронный API для выхода пользователя по заголовку Authorization
+    """
+
+    @staticmethod
+    async def post():
+        """Endpoint для обработки post запросов"""
+        auth_token = get_auth_token()
+        if auth_token is None:
+            response_object = {
+                'status': 'fail',
+                'message': 'Bearer token malformed.'
+            }
+            return jsonify(response_object), 401
+        if auth_token:
+            resp = await decode_auth_token(auth_token)
+            if not isinstance(resp, str):
+                try:
+                    await AsyncBlacklistToken.save(token=auth_token)
+                    refresh_token = (await request.get_json(silent=True) or {}).get('refresh_token')
+                    if refresh_token and await decode_refresh_token(refresh_token) == resp:
+                        await AsyncBlacklistToken.save(token=refresh_token)
+                    # save дожидается записи отзыва в БД, повторная проверка токена не нужна.
+                    response_object = {
+                        'status': 'success',
+                        'message': 'Successfully logged out.'
+                    }
+                    return jsonify(response_object), 200
+                except Exception as e:
+                    response_object = {
+                        'status': 'fail',
+                        'message': str(e)
+                    }
+                    return jsonify(response_object), 200
+            else:
+                response_object = {
+                    'status': 'fail',
+                    'message': resp
+                }
+                return jsonify(response_object), 401
+        else:
+            response_object = {
+                'status': 'fail',
+                'message': 'Provide a valid auth token.'
+            }
+            return jsonify(response_object), 403
+
+
+class RefreshAPI(MethodView):
+    """
+    Асинхронный API для получения нового access токена по refresh токену
+    """
+
+    @staticmethod
+    async def post():
+        """Endpoint для обработки post запросов"""
+        refresh_token = (await request.get_json(silent=True) or {}).get('refresh_token')
+        if not isinstance(refresh_token, str) or not refresh_token:
+            response_object = {
+                'status': 'fail',
+                'message': 'Provide a valid refresh token.'
+            }
+            return jsonify(response_object), 400
+        try:
+            resp = await decode_refresh_token(refresh_token)
+            if isinstance(resp, str):
+                response_object = {
+                    'status': 'fail',
+                    'message': resp
+                }
+                return jsonify(response_object), 401
+            if not await AsyncUser.get_profile_by_id(user_id=resp):
+                response_object = {
+                    'status': 'fail',
+                    'message': 'User does not exist.'
+                }
+                return jsonify(response_object), 401
+            auth_token = AsyncUser.encode_auth_token(user_id=resp)
+            if not auth_token:
+                raise Exception('Ошибка при получении токена пользователя')
+        except Exception as e:
+            print(e)
+            response_object = {
+                'status': 'fail',
+                'message': 'Try again.'
+            }
+            return jsonify(response_object), 500
+        response_object = {
+            'status': 'success',
+            'message': 'Successfully refreshed.',
+            'auth_token': auth_token
+        }
+        return jsonify(response_object), 200
+
+
+class JwksAPI(MethodView):
+    """
+    Асинхронный API с открытыми ключами подписи токенов в формате JWKS
+    """
+
+    @staticmethod
+    async def get():
+        """Endpoint для обработки get запросов"""
+        keyring = get_keyring(current_app.config)
+        if keyring is None:
+            body, etag = '{"keys": []}', 'empty'
+        else:
+            body, etag = keyring.jwks_json, keyring.jwks_etag
+        status = 304 if etag in request.if_none_match else 200
+        response = Response(body if status == 200 else '', status=status, mimetype='application/json')
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config.get('JWKS_MAX_AGE')
+        return response
+
+
+# define the API resources
+registration_view = RegisterAPI.as_view('register_api')
+login_view = LoginAPI.as_view('login_api')
+user_view = UserAPI.as_view('user_api')
+logout_view = LogoutAPI.as_view('logout_api')
+refresh_view = RefreshAPI.as_view('refresh_api')
+jwks_view = JwksAPI.as_view('jwks_api')
+
+# add Rules for API Endpoints
+auth_blueprint.add_url_rule(
+    '/auth/register',
+    view_func=registration_view,
+    methods=['POST']
+)
+auth_blueprint.add_url_rule(
+    '/auth/login',
+    view_func=login_view,
+    methods=['POST']
+)
+auth_blueprint.add_url_rule(
+    '/auth/status',
+    view_func=user_view,
+    methods=['GET']
+)
+auth_blueprint.add_url_rule(
+    '/auth/logout',
+    view_func=logout_view,
+    methods=['POST']
+)
+auth_blueprint.add_url_rule(
+    '/auth/refresh',
+    view_func=refresh_view,
+    methods=['POST']
+)
+auth_blueprint.add_url_rule(
+    '/.well-known/jwks.json',
+    view_func=jwks_view,
+    methods=['GET']
+)
@@ -0,0 +1,4 @@
+"""Точка входа ASGI-сервера, например: hypercorn project.asgi:app"""
+from project import create_asgi_app
+
+app = create_asgi_app()
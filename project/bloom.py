@@ -0,0 +1,151 @@
+import math
+import threading
+import time
+
+
+class BloomFilter:
+    """Фильтр Блума над SHA-256 хешами токенов.
+
+    Отвечает «точно нет» или «возможно есть». Позиции битов вычисляются двойным хешированием
+    из первых 16 байт дайджеста, поэтому повторно хешировать токен не нужно.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def _positions(self, digest):
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, digest):
+        with self._lock:
+            for position in self._positions(digest):
+                self.bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def __contains__(self, digest):
+        bits = self.bits
+        for position in self._positions(digest):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def expected_false_positive_rate(self):
+        """Оценка вероятности ложноположительного ответа при текущем числе элементов."""
+        return (1 - math.exp(-self.hash_count * self.count / self.size)) ** self.hash_count
+
+
+class BlacklistFilter:
+    """Фильтр Блума отозванных токенов с состоянием синхронизации и счётчиками обращений.
+
+    Пока фильтр не прогрет из БД, он отвечает «возможно есть» на любой запрос, чтобы не пропустить
+    отозванный токен.
+    """
+
+    def __init__(self, capacity, error_rate, resync_interval, rebuild_interval):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.resync_interval = resync_interval
+        self.rebuild_interval = rebuild_interval
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.ready = False
+        self.synced_at = None
+        self.rebuilt_at = 0.0
+        self.synced_monotonic = 0.0
+        self.lookups = 0
+        self.negatives = 0
+        self.db_lookups = 0
+        self.db_positives = 0
+        self._sync_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._rebuild_adds = None
+
+    def might_contain(self, digest):
+        self.lookups += 1
+        if self.ready and digest not in self.bloom:
+            self.negatives += 1
+            return False
+        self.db_lookups += 1
+        return True
+
+    def record_db_result(self, is_blacklisted):
+        if is_blacklisted:
+            self.db_positives += 1
+
+    def add(self, digest):
+        with self._lock:
+            if self._rebuild_adds is not None:
+                self._rebuild_adds.append(digest)
+            if digest not in self.bloom:
+                self.bloom.add(digest)
+
+    def needs_resync(self):
+        return time.monotonic() - self.synced_monotonic >= self.resync_interval
+
+    def needs_rebuild(self):
+        return (not self.ready or self.bloom.count >= self.capacity
+                or time.monotonic() - self.rebuilt_at >= self.rebuild_interval)
+
+    def try_begin_sync(self):
+        """Захватывает право на синхронизацию без ожидания, чтобы её выполнял только один поток."""
+        return self._sync_lock.acquire(blocking=False)
+
+    def end_sync(self):
+        self._sync_lock.release()
+
+    def rebuild(self, digests, synced_at):
+        """Заменяет фильтр новым, построенным из переданных хешей.
+
+        Хеши, добавленные через add() пока строится новый фильтр, запоминаются и переносятся в него
+        перед заменой, иначе отзыв, сохранённый во время перестроения, потерялся бы вместе со старым фильтром.
+        """
+        with self._lock:
+            self._rebuild_adds = []
+        try:
+            bloom = BloomFilter(self.capacity, self.error_rate)
+            for digest in digests:
+                bloom.add(digest)
+            with self._lock:
+                for digest in self._rebuild_adds:
+                    if digest not in bloom:
+                        bloom.add(digest)
+                self.bloom = bloom
+        finally:
+            with self._lock:
+                self._rebuild_adds = None
+        self.ready = True
+        self.synced_at = synced_at
+        self.rebuilt_at = self.synced_monotonic = time.monotonic()
+
+    def merge(self, digests, synced_at):
+        """Добавляет в фильтр хеши, отозванные после предыдущей синхронизации."""
+        for digest in digests:
+            self.add(digest)
+        self.synced_at = synced_at
+        self.synced_monotonic = time.monotonic()
+
+    def stats(self):
+        bloom = self.bloom
+        false_positives = self.db_lookups - self.db_positives
+        negatives_total = self.lookups - self.db_positives
+        return {
+            'ready': self.ready,
+            'items': bloom.count,
+            'capacity': bloom.capacity,
+            'bits': bloom.size,
+            'hash_count': bloom.hash_count,
+            'memory_bytes': len(bloom.bits),
+            'expected_false_positive_rate': bloom.expected_false_positive_rate(),
+            'observed_false_positive_rate': false_positives / negatives_total if negatives_total else 0.0,
+            'lookups': self.lookups,
+            'filter_negatives': self.negatives,
+            'db_lookups': self.db_lookups,
+            'db_positives': self.db_positives,
+        }
@@ -0,0 +1,118 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+
+class CacheBackend:
+    """Интерфейс хранилища кэша.
+
+    Реализации должны быть потокобезопасными. get возвращает None, если значения нет или оно устарело,
+    set принимает необязательный ttl в секундах, который не может превышать ttl самого хранилища.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def _ttl(self, ttl):
+        return self.ttl if ttl is None else min(ttl, self.ttl)
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0.0,
+        }
+
+
+class LRUCache(CacheBackend):
+    """Ограниченный LRU-кэш в памяти процесса со временем жизни записей."""
+
+    def __init__(self, maxsize, ttl):
+        super().__init__(maxsize, ttl)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + self._ttl(ttl)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        stats = super().stats()
+        stats['size'] = len(self._entries)
+        return stats
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    raise TypeError(f'Значение типа {type(value).__name__} нельзя сохранить в кэш.')
+
+
+def _json_object_hook(value):
+    if '__datetime__' in value:
+        return datetime.fromisoformat(value['__datetime__'])
+    return value
+
+
+class RedisCache(CacheBackend):
+    """Общий для всех процессов кэш в Redis. Значения хранятся в JSON, размер ограничивается
+    политикой вытеснения самого Redis, поэтому maxsize здесь не используется.
+    Требует установленного пакета redis."""
+
+    def __init__(self, maxsize, ttl, url=None, prefix='flask_auth:'):
+        super().__init__(maxsize, ttl)
+        import redis
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url or 'redis://localhost:6379/0')
+
+    def get(self, key):
+        raw = self._client.get(self.prefix + key)
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(raw, object_hook=_json_object_hook)
+
+    def set(self, key, value, ttl=None):
+        ttl = max(1, int(self._ttl(ttl)))
+        self._client.set(self.prefix + key, json.dumps(value, default=_json_default), ex=ttl)
+
+    def delete(self, key):
+        self._client.delete(self.prefix + key)
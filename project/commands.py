@@ -1,11 +1,93 @@
 import click
-from db import create_data_base, create_user_table, create_blacklist_token_table
+from flask import current_app
+from project.importer import import_users
+from project.keys import ASYMMETRIC_ALGORITHMS, generate_signing_key
+from project.models import BlacklistToken, User
+from project.storage import get_storage
 
 
 @click.command('init-db')
 def init_db_command():
-    """Clear the existing data and create new tables."""
-    create_data_base()
-    create_user_table()
-    create_blacklist_token_table()
-    click.echo('Initialized the database.')
+    """Create the database and apply pending schema migrations."""
+    version = get_storage().init_schema()
+    if version is None:
+        click.echo(f'The {get_storage().name} storage needs no schema.')
+    else:
+        click.echo(f'Initialized the database. Schema version: {version}.')
+
+
+@click.command('purge-blacklist')
+@click.option('--batch-size', default=10000, show_default=True, help='Rows deleted per transaction.')
+def purge_blacklist_command(batch_size):
+    """Delete revoked tokens that have already expired."""
+    deleted = BlacklistToken.purge_expired(batch_size=batch_size)
+    click.echo(f'Purged {deleted} expired tokens from the blacklist.')
+
+
+@click.command('maintain-blacklist')
+def maintain_blacklist_command():
+    """Create upcoming blacklist partitions and drop the expired ones.
+
+    Run it daily. Dropping a partition whose tokens have all expired replaces
+    the row by row DELETE of purge-blacklist.
+    """
+    result = BlacklistToken.maintain_partitions()
+    if result is None:
+        click.echo(f'The {get_storage().name} storage does not partition the blacklist.')
+        return
+    created, dropped = result
+    click.echo(f'Created {len(created)} and dropped {len(dropped)} blacklist partitions.')
+    for partition_name in dropped:
+        click.echo(f'Dropped {partition_name}.')
+
+
+@click.command('set-admin')
+@click.argument('email')
+@click.option('--revoke', is_flag=True, help='Take admin rights away instead of granting them.')
+def set_admin_command(email, revoke):
+    """Grant or revoke admin rights of a user."""
+    if User.set_admin(email, is_admin=not revoke) is None:
+        raise click.BadParameter(f'User {email} does not exist.', param_hint='EMAIL')
+    click.echo(f'{email} is {"no longer" if revoke else "now"} an admin.')
+
+
+@click.command('import-users')
+@click.argument('file', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'ndjson']), default=None,
+              help='Input format. Guessed from the file extension by default.')
+@click.option('--batch-size', default=5000, show_default=True, help='Rows loaded per COPY batch.')
+@click.option('--workers', default=None, type=int, help='Hashing processes. Defaults to the CPU count.')
+def import_users_command(file, file_format, batch_size, workers):
+    """Bulk load users from a CSV or NDJSON file.
+
+    Each row needs an email and either a plaintext password or an existing
+    bcrypt password_hash. Rows with an already registered email are skipped.
+    """
+    if get_storage().name != 'postgres':
+        raise click.UsageError('import-users loads users with COPY and needs the postgres storage backend.')
+    if file_format is None:
+        file_format = 'ndjson' if file.name.endswith(('.ndjson', '.jsonl')) else 'csv'
+
+    def progress(stats):
+        click.echo(f'{stats.read} read, {stats.inserted} inserted, {stats.duplicates} duplicates, '
+                   f'{stats.rejected} rejected, {stats.rows_per_second:.0f} rows/s', err=True)
+
+    stats = import_users(file, file_format=file_format, batch_size=batch_size, workers=workers, progress=progress)
+    click.echo(f'Imported {stats.inserted} users: {stats.duplicates} duplicates, {stats.rejected} rejected, '
+               f'{stats.rows_per_second:.0f} rows/s.')
+
+
+@click.command('generate-signing-key')
+@click.option('--algorithm', type=click.Choice(ASYMMETRIC_ALGORITHMS), default=None,
+              help='Key type. Defaults to JWT_ALGORITHM of the current config.')
+def generate_signing_key_command(algorithm):
+    """Create a new JWT signing key in JWT_KEYS_DIR.
+
+    The newest key signs new tokens after the workers restart. Older keys keep
+    verifying tokens and stay in the JWKS until they are deleted.
+    """
+    algorithm = algorithm or current_app.config['JWT_ALGORITHM']
+    if algorithm not in ASYMMETRIC_ALGORITHMS:
+        raise click.UsageError(f'JWT_ALGORITHM is {algorithm}, pass --algorithm to choose the key type.')
+    kid = generate_signing_key(current_app.config['JWT_KEYS_DIR'], algorithm)
+    click.echo(f'Created {algorithm} signing key {kid} in {current_app.config["JWT_KEYS_DIR"]}.')
@@ -1,14 +1,88 @@
 import os
+from functools import lru_cache
 from environs import Env
 import pathlib
 
 
+@lru_cache(maxsize=None)
+def _read_env(path):
+    env = Env()
+    env.read_env(path=path)
+    return env
+
+
+class EnvVar:
+    """Переменная окружения из файла ENV_FILE класса конфигурации.
+    Файл читается при первом обращении к переменной, поэтому импорт модуля не читает файлы
+    конфигураций, которые не выбраны. parser - имя метода environs для разбора значения,
+    например list, остальные аргументы передаются ему."""
+
+    def __init__(self, name, suffix='', parser='str', **kwargs):
+        self.name = name
+        self.suffix = suffix
+        self.parser = parser
+        self.kwargs = kwargs
+
+    def __get__(self, instance, owner):
+        value = getattr(_read_env(owner.ENV_FILE), self.parser)(self.name, **self.kwargs)
+        return value + self.suffix if self.suffix else value
+
+
 class BaseConfig:
     """Base configuration."""
     BASE_DIR = pathlib.Path(__file__).parent.resolve()
     BCRYPT_LOG_ROUNDS = 4
     USER_TABLE_NAME = 'user'
     BLACKLIST_TOKEN_TABLE_NAME = 'blacklist_token'
+    SCHEMA_VERSION_TABLE_NAME = 'schema_version'
+    DB_POOL_MIN_SIZE = 1
+    DB_POOL_MAX_SIZE = 10
+    DB_POOL_TIMEOUT = 5
+    DB_POOL_IDLE_TIMEOUT = 300
+    DB_POOL_MAX_LIFETIME = 3600
+    DB_POOL_HEALTH_CHECK_INTERVAL = 30
+    DB_PREPARED_STATEMENTS = True
+    DB_REPLICA_EJECT_SECONDS = 30
+    AUTH_TOKEN_EXPIRATION_SECONDS = 5
+    REFRESH_TOKEN_EXPIRATION_SECONDS = 30 * 24 * 3600
+    JWT_ALGORITHM = 'HS256'
+    JWT_KEYS_DIR = os.path.join(BASE_DIR.parent.resolve(), 'docker/keys')
+    JWT_ACTIVE_KID = None
+    JWKS_MAX_AGE = 300
+    BLACKLIST_FILTER_ENABLED = True
+    BLACKLIST_FILTER_CAPACITY = 100000
+    BLACKLIST_FILTER_ERROR_RATE = 0.001
+    BLACKLIST_FILTER_RESYNC_INTERVAL = 5
+    BLACKLIST_FILTER_REBUILD_INTERVAL = 600
+    REVOCATION_TABLE_PATH = None
+    REVOCATION_TABLE_CAPACITY = 2 ** 17
+    REVOCATION_TABLE_RESYNC_INTERVAL = 5
+    REVOCATION_TABLE_REBUILD_INTERVAL = 600
+    REVOCATION_WRITER_BATCH_SIZE = 0
+    REVOCATION_WRITER_FLUSH_INTERVAL = 0.05
+    REVOCATION_WRITER_QUEUE_SIZE = 10000
+    BLACKLIST_PARTITION_DAYS = 7
+    BLACKLIST_PARTITIONS_PREMAKE = 1
+    BCRYPT_POOL_SIZE = 0
+    BCRYPT_POOL_QUEUE_SIZE = 16
+    BCRYPT_POOL_TIMEOUT = 10
+    BCRYPT_RETRY_AFTER = 1
+    TOKEN_CACHE_SIZE = 10000
+    TOKEN_CACHE_TTL = 5
+    USER_CACHE_BACKEND = 'project.cache.LRUCache'
+    USER_CACHE_OPTIONS = {}
+    USER_CACHE_SIZE = 10000
+    USER_CACHE_TTL = 60
+    INTROSPECT_MAX_TOKENS = 100
+    ADMIN_USERS_PAGE_SIZE = 100
+    ADMIN_USERS_MAX_PAGE_SIZE = 1000
+    ADMIN_EXPORT_BATCH_SIZE = 1000
+    METRICS_ENABLED = True
+    SERVER_TIMING_ENABLED = True
+    SCHEMA_CHECK_ON_STARTUP = 'migrate'
+    STARTUP_TIMING_REPORT = False
+    STORAGE_BACKEND = 'project.storage.postgres.PostgresStorage'
+    STORAGE_OPTIONS = {}
 
 
 class DevelopmentConfig(BaseConfig):
@@ -17,16 +91,65 @@ class DevelopmentConfig(BaseConfig):
     BCRYPT_LOG_ROUNDS = BaseConfig.BCRYPT_LOG_ROUNDS
     USER_TABLE_NAME = BaseConfig.USER_TABLE_NAME
     BLACKLIST_TOKEN_TABLE_NAME = BaseConfig.BLACKLIST_TOKEN_TABLE_NAME
+    SCHEMA_VERSION_TABLE_NAME = BaseConfig.SCHEMA_VERSION_TABLE_NAME
+    DB_POOL_MIN_SIZE = BaseConfig.DB_POOL_MIN_SIZE
+    DB_POOL_MAX_SIZE = BaseConfig.DB_POOL_MAX_SIZE
+    DB_POOL_TIMEOUT = BaseConfig.DB_POOL_TIMEOUT
+    DB_POOL_IDLE_TIMEOUT = BaseConfig.DB_POOL_IDLE_TIMEOUT
+    DB_POOL_MAX_LIFETIME = BaseConfig.DB_POOL_MAX_LIFETIME
+    DB_POOL_HEALTH_CHECK_INTERVAL = BaseConfig.DB_POOL_HEALTH_CHECK_INTERVAL
+    DB_PREPARED_STATEMENTS = BaseConfig.DB_PREPARED_STATEMENTS
+    DB_REPLICA_EJECT_SECONDS = BaseConfig.DB_REPLICA_EJECT_SECONDS
+    AUTH_TOKEN_EXPIRATION_SECONDS = BaseConfig.AUTH_TOKEN_EXPIRATION_SECONDS
+    REFRESH_TOKEN_EXPIRATION_SECONDS = BaseConfig.REFRESH_TOKEN_EXPIRATION_SECONDS
+    JWT_KEYS_DIR = BaseConfig.JWT_KEYS_DIR
+    JWT_ACTIVE_KID = BaseConfig.JWT_ACTIVE_KID
+    JWKS_MAX_AGE = BaseConfig.JWKS_MAX_AGE
+    BLACKLIST_FILTER_ENABLED = BaseConfig.BLACKLIST_FILTER_ENABLED
+    BLACKLIST_FILTER_CAPACITY = BaseConfig.BLACKLIST_FILTER_CAPACITY
+    BLACKLIST_FILTER_ERROR_RATE = BaseConfig.BLACKLIST_FILTER_ERROR_RATE
+    BLACKLIST_FILTER_RESYNC_INTERVAL = BaseConfig.BLACKLIST_FILTER_RESYNC_INTERVAL
+    BLACKLIST_FILTER_REBUILD_INTERVAL = BaseConfig.BLACKLIST_FILTER_REBUILD_INTERVAL
+    REVOCATION_TABLE_PATH = BaseConfig.REVOCATION_TABLE_PATH
+    REVOCATION_TABLE_CAPACITY = BaseConfig.REVOCATION_TABLE_CAPACITY
+    REVOCATION_TABLE_RESYNC_INTERVAL = BaseConfig.REVOCATION_TABLE_RESYNC_INTERVAL
+    REVOCATION_TABLE_REBUILD_INTERVAL = BaseConfig.REVOCATION_TABLE_REBUILD_INTERVAL
+    REVOCATION_WRITER_BATCH_SIZE = BaseConfig.REVOCATION_WRITER_BATCH_SIZE
+    REVOCATION_WRITER_FLUSH_INTERVAL = BaseConfig.REVOCATION_WRITER_FLUSH_INTERVAL
+    REVOCATION_WRITER_QUEUE_SIZE = BaseConfig.REVOCATION_WRITER_QUEUE_SIZE
+    BLACKLIST_PARTITION_DAYS = BaseConfig.BLACKLIST_PARTITION_DAYS
+    BLACKLIST_PARTITIONS_PREMAKE = BaseConfig.BLACKLIST_PARTITIONS_PREMAKE
+    BCRYPT_POOL_SIZE = BaseConfig.BCRYPT_POOL_SIZE
+    BCRYPT_POOL_QUEUE_SIZE = BaseConfig.BCRYPT_POOL_QUEUE_SIZE
+    BCRYPT_POOL_TIMEOUT = BaseConfig.BCRYPT_POOL_TIMEOUT
+    BCRYPT_RETRY_AFTER = BaseConfig.BCRYPT_RETRY_AFTER
+    TOKEN_CACHE_SIZE = BaseConfig.TOKEN_CACHE_SIZE
+    TOKEN_CACHE_TTL = BaseConfig.TOKEN_CACHE_TTL
+    USER_CACHE_BACKEND = BaseConfig.USER_CACHE_BACKEND
+    USER_CACHE_OPTIONS = BaseConfig.USER_CACHE_OPTIONS
+    USER_CACHE_SIZE = BaseConfig.USER_CACHE_SIZE
+    USER_CACHE_TTL = BaseConfig.USER_CACHE_TTL
+    INTROSPECT_MAX_TOKENS = BaseConfig.INTROSPECT_MAX_TOKENS
+    ADMIN_USERS_PAGE_SIZE = BaseConfig.ADMIN_USERS_PAGE_SIZE
+    ADMIN_USERS_MAX_PAGE_SIZE = BaseConfig.ADMIN_USERS_MAX_PAGE_SIZE
+    ADMIN_EXPORT_BATCH_SIZE = BaseConfig.ADMIN_EXPORT_BATCH_SIZE
+    METRICS_ENABLED = BaseConfig.METRICS_ENABLED
+    SERVER_TIMING_ENABLED = BaseConfig.SERVER_TIMING_ENABLED
+    SCHEMA_CHECK_ON_STARTUP = BaseConfig.SCHEMA_CHECK_ON_STARTUP
+    STARTUP_TIMING_REPORT = BaseConfig.STARTUP_TIMING_REPORT
 
-    env = Env()
-    env.read_env(path=os.path.join(BASE_DIR.parent.resolve(), 'docker/env/.env.dev'))
-    SECRET_KEY = env('SECRET_KEY')
-    DEBUG = env('DEBUG')
-    DB_NAME = env('DB_NAME')
-    DB_USER = env('DB_USER')
-    DB_PASSWORD = env('DB_PASSWORD')
-    DB_HOST = env('DB_HOST')
-    DB_PORT = env('DB_PORT')
+    ENV_FILE = os.path.join(BASE_DIR.parent.resolve(), 'docker/env/.env.dev')
+    SECRET_KEY = EnvVar('SECRET_KEY')
+    DEBUG = EnvVar('DEBUG')
+    DB_NAME = EnvVar('DB_NAME')
+    DB_USER = EnvVar('DB_USER')
+    DB_PASSWORD = EnvVar('DB_PASSWORD')
+    DB_HOST = EnvVar('DB_HOST')
+    DB_PORT = EnvVar('DB_PORT')
+    DB_REPLICAS = EnvVar('DB_REPLICAS', parser='list', default=[])
+    STORAGE_BACKEND = EnvVar('STORAGE_BACKEND', default=BaseConfig.STORAGE_BACKEND)
+    STORAGE_OPTIONS = EnvVar('STORAGE_OPTIONS', parser='json', default=BaseConfig.STORAGE_OPTIONS)
+    JWT_ALGORITHM = EnvVar('JWT_ALGORITHM', default=BaseConfig.JWT_ALGORITHM)
 
 
 class TestingConfig(BaseConfig):
@@ -35,16 +158,65 @@ class TestingConfig(BaseConfig):
     BCRYPT_LOG_ROUNDS = BaseConfig.BCRYPT_LOG_ROUNDS
     USER_TABLE_NAME = BaseConfig.USER_TABLE_NAME + '_test'
     BLACKLIST_TOKEN_TABLE_NAME = BaseConfig.BLACKLIST_TOKEN_TABLE_NAME + '_test'
+    SCHEMA_VERSION_TABLE_NAME = BaseConfig.SCHEMA_VERSION_TABLE_NAME + '_test'
+    DB_POOL_MIN_SIZE = BaseConfig.DB_POOL_MIN_SIZE
+    DB_POOL_MAX_SIZE = BaseConfig.DB_POOL_MAX_SIZE
+    DB_POOL_TIMEOUT = BaseConfig.DB_POOL_TIMEOUT
+    DB_POOL_IDLE_TIMEOUT = BaseConfig.DB_POOL_IDLE_TIMEOUT
+    DB_POOL_MAX_LIFETIME = BaseConfig.DB_POOL_MAX_LIFETIME
+    DB_POOL_HEALTH_CHECK_INTERVAL = BaseConfig.DB_POOL_HEALTH_CHECK_INTERVAL
+    DB_PREPARED_STATEMENTS = BaseConfig.DB_PREPARED_STATEMENTS
+    DB_REPLICA_EJECT_SECONDS = BaseConfig.DB_REPLICA_EJECT_SECONDS
+    AUTH_TOKEN_EXPIRATION_SECONDS = BaseConfig.AUTH_TOKEN_EXPIRATION_SECONDS
+    REFRESH_TOKEN_EXPIRATION_SECONDS = BaseConfig.REFRESH_TOKEN_EXPIRATION_SECONDS
+    JWT_ALGORITHM = BaseConfig.JWT_ALGORITHM
+    JWT_KEYS_DIR = BaseConfig.JWT_KEYS_DIR
+    JWT_ACTIVE_KID = BaseConfig.JWT_ACTIVE_KID
+    JWKS_MAX_AGE = BaseConfig.JWKS_MAX_AGE
+    BLACKLIST_FILTER_ENABLED = BaseConfig.BLACKLIST_FILTER_ENABLED
+    BLACKLIST_FILTER_CAPACITY = BaseConfig.BLACKLIST_FILTER_CAPACITY
+    BLACKLIST_FILTER_ERROR_RATE = BaseConfig.BLACKLIST_FILTER_ERROR_RATE
+    BLACKLIST_FILTER_RESYNC_INTERVAL = BaseConfig.BLACKLIST_FILTER_RESYNC_INTERVAL
+    BLACKLIST_FILTER_REBUILD_INTERVAL = BaseConfig.BLACKLIST_FILTER_REBUILD_INTERVAL
+    REVOCATION_TABLE_PATH = BaseConfig.REVOCATION_TABLE_PATH
+    REVOCATION_TABLE_CAPACITY = BaseConfig.REVOCATION_TABLE_CAPACITY
+    REVOCATION_TABLE_RESYNC_INTERVAL = BaseConfig.REVOCATION_TABLE_RESYNC_INTERVAL
+    REVOCATION_TABLE_REBUILD_INTERVAL = BaseConfig.REVOCATION_TABLE_REBUILD_INTERVAL
+    REVOCATION_WRITER_BATCH_SIZE = BaseConfig.REVOCATION_WRITER_BATCH_SIZE
+    REVOCATION_WRITER_FLUSH_INTERVAL = BaseConfig.REVOCATION_WRITER_FLUSH_INTERVAL
+    REVOCATION_WRITER_QUEUE_SIZE = BaseConfig.REVOCATION_WRITER_QUEUE_SIZE
+    BLACKLIST_PARTITION_DAYS = BaseConfig.BLACKLIST_PARTITION_DAYS
+    BLACKLIST_PARTITIONS_PREMAKE = BaseConfig.BLACKLIST_PARTITIONS_PREMAKE
+    BCRYPT_POOL_SIZE = BaseConfig.BCRYPT_POOL_SIZE
+    BCRYPT_POOL_QUEUE_SIZE = BaseConfig.BCRYPT_POOL_QUEUE_SIZE
+    BCRYPT_POOL_TIMEOUT = BaseConfig.BCRYPT_POOL_TIMEOUT
+    BCRYPT_RETRY_AFTER = BaseConfig.BCRYPT_RETRY_AFTER
+    TOKEN_CACHE_SIZE = BaseConfig.TOKEN_CACHE_SIZE
+    TOKEN_CACHE_TTL = BaseConfig.TOKEN_CACHE_TTL
+    USER_CACHE_BACKEND = BaseConfig.USER_CACHE_BACKEND
+    USER_CACHE_OPTIONS = BaseConfig.USER_CACHE_OPTIONS
+    USER_CACHE_SIZE = BaseConfig.USER_CACHE_SIZE
+    USER_CACHE_TTL = BaseConfig.USER_CACHE_TTL
+    INTROSPECT_MAX_TOKENS = BaseConfig.INTROSPECT_MAX_TOKENS
+    ADMIN_USERS_PAGE_SIZE = BaseConfig.ADMIN_USERS_PAGE_SIZE
+    ADMIN_USERS_MAX_PAGE_SIZE = BaseConfig.ADMIN_USERS_MAX_PAGE_SIZE
+    ADMIN_EXPORT_BATCH_SIZE = BaseConfig.ADMIN_EXPORT_BATCH_SIZE
+    METRICS_ENABLED = BaseConfig.METRICS_ENABLED
+    SERVER_TIMING_ENABLED = BaseConfig.SERVER_TIMING_ENABLED
+    SCHEMA_CHECK_ON_STARTUP = BaseConfig.SCHEMA_CHECK_ON_STARTUP
+    STARTUP_TIMING_REPORT = BaseConfig.STARTUP_TIMING_REPORT
 
-    env = Env()
-    env.read_env(path=os.path.join(BASE_DIR.parent.resolve(), 'docker/env/.env.dev'))
-    SECRET_KEY = env('SECRET_KEY')
-    DEBUG = env('DEBUG')
-    DB_NAME = env('DB_NAME') + '_test'
-    DB_USER = env('DB_USER')
-    DB_PASSWORD = env('DB_PASSWORD')
-    DB_HOST = env('DB_HOST')
-    DB_PORT = env('DB_PORT')
+    ENV_FILE = os.path.join(BASE_DIR.parent.resolve(), 'docker/env/.env.dev')
+    SECRET_KEY = EnvVar('SECRET_KEY')
+    DEBUG = EnvVar('DEBUG')
+    DB_NAME = EnvVar('DB_NAME', suffix='_test')
+    DB_USER = EnvVar('DB_USER')
+    DB_PASSWORD = EnvVar('DB_PASSWORD')
+    DB_HOST = EnvVar('DB_HOST')
+    DB_PORT = EnvVar('DB_PORT')
+    DB_REPLICAS = EnvVar('DB_REPLICAS', parser='list', default=[])
+    STORAGE_BACKEND = EnvVar('STORAGE_BACKEND', default=BaseConfig.STORAGE_BACKEND)
+    STORAGE_OPTIONS = EnvVar('STORAGE_OPTIONS', parser='json', default=BaseConfig.STORAGE_OPTIONS)
 
 
 class ProductionConfig(BaseConfig):
@@ -53,13 +225,64 @@ class ProductionConfig(BaseConfig):
     BCRYPT_LOG_ROUNDS = 13
     USER_TABLE_NAME = BaseConfig.USER_TABLE_NAME
     BLACKLIST_TOKEN_TABLE_NAME = BaseConfig.BLACKLIST_TOKEN_TABLE_NAME
+    SCHEMA_VERSION_TABLE_NAME = BaseConfig.SCHEMA_VERSION_TABLE_NAME
+    DB_POOL_MIN_SIZE = 2
+    DB_POOL_MAX_SIZE = 20
+    DB_POOL_TIMEOUT = 3
+    DB_POOL_IDLE_TIMEOUT = 600
+    DB_POOL_MAX_LIFETIME = 1800
+    DB_POOL_HEALTH_CHECK_INTERVAL = 30
+    DB_PREPARED_STATEMENTS = BaseConfig.DB_PREPARED_STATEMENTS
+    DB_REPLICA_EJECT_SECONDS = BaseConfig.DB_REPLICA_EJECT_SECONDS
+    AUTH_TOKEN_EXPIRATION_SECONDS = 300
+    REFRESH_TOKEN_EXPIRATION_SECONDS = BaseConfig.REFRESH_TOKEN_EXPIRATION_SECONDS
+    JWT_KEYS_DIR = BaseConfig.JWT_KEYS_DIR
+    JWT_ACTIVE_KID = BaseConfig.JWT_ACTIVE_KID
+    JWKS_MAX_AGE = 3600
+    BLACKLIST_FILTER_ENABLED = True
+    BLACKLIST_FILTER_CAPACITY = 1000000
+    BLACKLIST_FILTER_ERROR_RATE = 0.001
+    BLACKLIST_FILTER_RESYNC_INTERVAL = 2
+    BLACKLIST_FILTER_REBUILD_INTERVAL = 300
+    REVOCATION_TABLE_PATH = '/dev/shm/flask_auth_revocations'
+    # 2 ** 20 слотов по 40 байт - 40 МиБ, что помещается в /dev/shm контейнера docker по умолчанию (64 МиБ).
+    REVOCATION_TABLE_CAPACITY = 2 ** 20
+    REVOCATION_TABLE_RESYNC_INTERVAL = 2
+    REVOCATION_TABLE_REBUILD_INTERVAL = 300
+    REVOCATION_WRITER_BATCH_SIZE = 500
+    REVOCATION_WRITER_FLUSH_INTERVAL = BaseConfig.REVOCATION_WRITER_FLUSH_INTERVAL
+    REVOCATION_WRITER_QUEUE_SIZE = BaseConfig.REVOCATION_WRITER_QUEUE_SIZE
+    BLACKLIST_PARTITION_DAYS = BaseConfig.BLACKLIST_PARTITION_DAYS
+    BLACKLIST_PARTITIONS_PREMAKE = BaseConfig.BLACKLIST_PARTITIONS_PREMAKE
+    BCRYPT_POOL_SIZE = os.cpu_count() or 1
+    BCRYPT_POOL_QUEUE_SIZE = 4 * (os.cpu_count() or 1)
+    BCRYPT_POOL_TIMEOUT = 5
+    BCRYPT_RETRY_AFTER = 2
+    TOKEN_CACHE_SIZE = 100000
+    TOKEN_CACHE_TTL = 2
+    USER_CACHE_BACKEND = BaseConfig.USER_CACHE_BACKEND
+    USER_CACHE_OPTIONS = BaseConfig.USER_CACHE_OPTIONS
+    USER_CACHE_SIZE = 100000
+    USER_CACHE_TTL = 300
+    INTROSPECT_MAX_TOKENS = BaseConfig.INTROSPECT_MAX_TOKENS
+    ADMIN_USERS_PAGE_SIZE = BaseConfig.ADMIN_USERS_PAGE_SIZE
+    ADMIN_USERS_MAX_PAGE_SIZE = BaseConfig.ADMIN_USERS_MAX_PAGE_SIZE
+    ADMIN_EXPORT_BATCH_SIZE = BaseConfig.ADMIN_EXPORT_BATCH_SIZE
+    METRICS_ENABLED = BaseConfig.METRICS_ENABLED
+    SERVER_TIMING_ENABLED = False
+    SCHEMA_CHECK_ON_STARTUP = 'check'
+    STARTUP_TIMING_REPORT = True
 
-    env = Env()
-    env.read_env(path=os.path.join(BASE_DIR.parent.resolve(), 'docker/env/.env.prod'))
-    SECRET_KEY = env('SECRET_KEY')
-    DEBUG = env('DEBUG')
-    DB_NAME = env('DB_NAME')
-    DB_USER = env('DB_USER')
-    DB_PASSWORD = env('DB_PASSWORD')
-    DB_HOST = env('DB_HOST')
-    DB_PORT = env('DB_PORT')
+    ENV_FILE = os.path.join(BASE_DIR.parent.resolve(), 'docker/env/.env.prod')
+    SECRET_KEY = EnvVar('SECRET_KEY')
+    DEBUG = EnvVar('DEBUG')
+    DB_NAME = EnvVar('DB_NAME')
+    DB_USER = EnvVar('DB_USER')
+    DB_PASSWORD = EnvVar('DB_PASSWORD')
+    DB_HOST = EnvVar('DB_HOST')
+    DB_PORT = EnvVar('DB_PORT')
+    DB_REPLICAS = EnvVar('DB_REPLICAS', parser='list', default=[])
+    STORAGE_BACKEND = EnvVar('STORAGE_BACKEND', default=BaseConfig.STORAGE_BACKEND)
+    STORAGE_OPTIONS = EnvVar('STORAGE_OPTIONS', parser='json', default=BaseConfig.STORAGE_OPTIONS)
+    # Асимметричная подпись (RS256 или EdDSA) включается явно: ей нужны ключи в JWT_KEYS_DIR.
+    JWT_ALGORITHM = EnvVar('JWT_ALGORITHM', default=BaseConfig.JWT_ALGORITHM)
@@ -1,96 +1,412 @@
+import os
+import re
+import threading
+import time
+import zlib
+from collections import deque
+from itertools import count
+from functools import lru_cache
+
 from flask import current_app, g
 from psycopg2 import sql, connect, ProgrammingError, OperationalError, InterfaceError
-from psycopg2.errors import DuplicateTable
+from psycopg2.extensions import connection as _pg_connection, cursor as _pg_cursor, TRANSACTION_STATUS_IDLE
+
+from project.metrics import DB_CONNECTIONS, DB_REPLICA_EJECTIONS, timed
+
+
+class PoolTimeout(OperationalError):
+    """Исключение, возникающее, если за отведённое время в пуле не освободилось соединение."""
+
+
+class DatabaseUnavailable(OperationalError):
+    """Исключение, возникающее, если не удалось установить соединение с базой данных."""
+
+
+class PooledConnection(_pg_connection):
+    """Соединение с PostgreSQL, которое помнит свой пул и время создания."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = None
+        self.created_at = time.monotonic()
+        self.last_used_at = self.created_at
+        # Имена серверных prepared statements, уже подготовленных на этом соединении.
+        self.prepared_statements = set()
+
+
+class TimedCursor(_pg_cursor):
+    """Курсор, который учитывает время выполнения запросов в фазе db_query."""
+
+    def execute(self, query, vars=None):
+        with timed('db_query'):
+            return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        with timed('db_query'):
+            return super().executemany(query, vars_list)
 
+    def copy_expert(self, sql, file, size=8192):
+        with timed('db_query'):
+            return super().copy_expert(sql, file, size)
+
+
+class ConnectionPool:
+    """Потокобезопасный пул соединений с PostgreSQL.
+
+    Держит не больше max_size соединений. При выдаче соединения проверяет, что оно живо, простаивающие сверх
+    min_size соединения закрывает через idle_timeout секунд, а соединения старше max_lifetime секунд пересоздаёт.
+    """
+
+    def __init__(self, connect_kwargs, min_size=1, max_size=10, timeout=5.0, idle_timeout=300.0,
+                 max_lifetime=3600.0, health_check_interval=30.0):
+        self.connect_kwargs = connect_kwargs
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        self._idle = deque()
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def getconn(self):
+        """Выдаёт соединение из пула. Если свободных соединений нет и пул заполнен, ждёт не дольше timeout секунд."""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                to_close = self._reap_idle()
+                conn = None
+                while conn is None:
+                    if self._idle:
+                        conn = self._idle.pop()
+                    elif self._size < self.max_size:
+                        self._size += 1
+                        break
+                    else:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise PoolTimeout('Нет свободных соединений в пуле.')
+                        self._cond.wait(remaining)
+            self._close_all(to_close)
+            if conn is None:
+                return self._connect()
+            if self._is_usable(conn):
+                return conn
+            self._discard(conn)
+
+    def putconn(self, conn):
+        """Возвращает соединение в пул, откатывая незавершённую транзакцию."""
+        if conn.closed:
+            self._discard(conn)
+            return
+        try:
+            if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            if conn.autocommit:
+                conn.autocommit = False
+        except (OperationalError, InterfaceError):
+            self._discard(conn)
+            return
+        now = time.monotonic()
+        if now - conn.created_at > self.max_lifetime:
+            self._discard(conn)
+            return
+        conn.last_used_at = now
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def close(self):
+        """Закрывает все простаивающие соединения пула."""
+        with self._cond:
+            to_close = list(self._idle)
+            self._idle.clear()
+            self._size -= len(to_close)
+            self._cond.notify_all()
+        self._close_all(to_close)
+
+    def _connect(self):
+        try:
+            conn = connect(connection_factory=PooledConnection, cursor_factory=TimedCursor, **self.connect_kwargs)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        conn.pool = self
+        try:
+            # Даты пишутся наивными в UTC, а столбцы timestamptz читают их в часовом поясе сессии.
+            cursor = conn.cursor()
+            cursor.execute("SET TIME ZONE 'UTC';")
+            cursor.close()
+            conn.commit()
+        except (OperationalError, InterfaceError):
+            self._discard(conn)
+            raise
+        DB_CONNECTIONS.inc()
+        return conn
 
-def get_conn_to_db():
+    def _is_usable(self, conn):
+        now = time.monotonic()
+        if conn.closed or now - conn.created_at > self.max_lifetime:
+            return False
+        if now - conn.last_used_at > self.health_check_interval:
+            try:
+                cursor = conn.cursor()
+                cursor.execute('SELECT 1;')
+                cursor.close()
+                conn.rollback()
+            except (OperationalError, InterfaceError):
+                return False
+        return True
+
+    def _reap_idle(self):
+        """Убирает из пула соединения, простаивающие дольше idle_timeout. Вызывается под блокировкой."""
+        now = time.monotonic()
+        to_close = []
+        # Самые давно простаивающие соединения лежат в начале очереди.
+        while self._idle and self._size > self.min_size and now - self._idle[0].last_used_at > self.idle_timeout:
+            to_close.append(self._idle.popleft())
+            self._size -= 1
+        return to_close
+
+    def _discard(self, conn):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+        self._close_all([conn])
+
+    @staticmethod
+    def _close_all(connections):
+        for conn in connections:
+            try:
+                conn.close()
+            except (OperationalError, InterfaceError):
+                pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(connect_kwargs):
+    """Возвращает пул соединений для connect_kwargs, создавая его при первом обращении.
+    Пулы создаются отдельно для каждого процесса, поэтому после fork соединения родителя не используются."""
+    key = (os.getpid(),) + tuple(sorted(connect_kwargs.items()))
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                config = current_app.config
+                pool = ConnectionPool(connect_kwargs,
+                                      min_size=config['DB_POOL_MIN_SIZE'],
+                                      max_size=config['DB_POOL_MAX_SIZE'],
+                                      timeout=config['DB_POOL_TIMEOUT'],
+                                      idle_timeout=config['DB_POOL_IDLE_TIMEOUT'],
+                                      max_lifetime=config['DB_POOL_MAX_LIFETIME'],
+                                      health_check_interval=config['DB_POOL_HEALTH_CHECK_INTERVAL'])
+                _pools[key] = pool
+    return pool
+
+
+def get_db_pool():
+    """Возвращает пул соединений с основной БД для текущих настроек приложения."""
+    config = current_app.config
+    return _get_pool(dict(database=config['DB_NAME'],
+                          user=config['DB_USER'],
+                          password=config['DB_PASSWORD'],
+                          host=config['DB_HOST'],
+                          port=config['DB_PORT']))
+
+
+class ReplicaSet:
+    """Пулы соединений с репликами для чтения.
+
+    Выдаёт реплики по кругу. Реплику, к которой не удалось подключиться, исключает на eject_seconds секунд,
+    после чего снова пробует её.
+    """
+
+    def __init__(self, pools, eject_seconds=30.0):
+        self.pools = pools
+        self.eject_seconds = eject_seconds
+        self._ejected_until = {}
+        self._counter = count()
+
+    def candidates(self):
+        """Возвращает реплики, которые сейчас не исключены, начиная со следующей по кругу."""
+        now = time.monotonic()
+        start = next(self._counter) % len(self.pools)
+        ordered = self.pools[start:] + self.pools[:start]
+        return [pool for pool in ordered if self._ejected_until.get(id(pool), 0) <= now]
+
+    def eject(self, pool):
+        self._ejected_until[id(pool)] = time.monotonic() + self.eject_seconds
+        DB_REPLICA_EJECTIONS.inc()
+
+
+_replica_sets = {}
+
+
+def get_replica_set():
+    """Возвращает набор реплик из DB_REPLICAS для текущего процесса или None, если реплики не заданы."""
+    config = current_app.config
+    dsns = tuple(config.get('DB_REPLICAS') or ())
+    if not dsns:
+        return None
+    key = (os.getpid(),) + dsns
+    replica_set = _replica_sets.get(key)
+    if replica_set is None:
+        pools = [_get_pool(dict(dsn=dsn)) for dsn in dsns]
+        with _pools_lock:
+            replica_set = _replica_sets.setdefault(
+                key, ReplicaSet(pools, eject_seconds=config['DB_REPLICA_EJECT_SECONDS']))
+    return replica_set
+
+
+def _get_replica_conn():
+    """Берёт соединение с одной из живых реплик или возвращает None, если реплик нет или все недоступны."""
+    if 'db_replica_conn' in g:
+        return g.db_replica_conn
+    replica_set = get_replica_set()
+    if replica_set is None:
+        return None
+    for pool in replica_set.candidates():
+        try:
+            with timed('db_connect'):
+                g.db_replica_conn = pool.getconn()
+        except (OperationalError, InterfaceError) as e:
+            print(f'Возникло исключение {e} при подключении к реплике, реплика временно исключена.')
+            replica_set.eject(pool)
+        else:
+            return g.db_replica_conn
+    return None
+
+
+# Настройки с именами таблиц, которые подставляются в шаблоны запросов.
+STATEMENT_TABLE_SETTINGS = (('user_table', 'USER_TABLE_NAME'),
+                            ('blacklist_token_table', 'BLACKLIST_TOKEN_TABLE_NAME'))
+
+_statement_templates = {}
+_placeholder_re = re.compile(r'%(s|%)')
+
+
+def quote_ident(name):
+    """Экранирует имя таблицы или индекса для подстановки в текст запроса."""
+    return '"' + name.replace('"', '""') + '"'
+
+
+class Statement:
+    """Запрос, собранный для конкретных имён таблиц.
+
+    text - текст с плейсхолдерами %s для psycopg2, numbered_text - тот же запрос с плейсхолдерами $1, $2, ...
+    для PREPARE и asyncpg, prepared_name - имя серверного prepared statement.
+    """
+    __slots__ = ('name', 'text', 'numbered_text', 'param_count', 'prepared_name', 'execute_text')
+
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+        counter = iter(range(1, text.count('%s') + 1))
+        self.numbered_text = _placeholder_re.sub(lambda m: '%' if m.group(1) == '%' else f'${next(counter)}', text)
+        self.param_count = text.count('%s')
+        self.prepared_name = f'{name}_{zlib.crc32(text.encode()):08x}'
+        params = ', '.join(['%s'] * self.param_count)
+        self.execute_text = f'EXECUTE {self.prepared_name}' + (f' ({params})' if params else '') + ';'
+
+
+def register_statement(name, template):
+    """Регистрирует шаблон запроса модели. В шаблоне имена таблиц задаются как {user_table}
+    и {blacklist_token_table}, а параметры как %s."""
+    _statement_templates[name] = template
+
+
+@lru_cache(maxsize=None)
+def _compose_statement(name, table_names):
+    tables = {key: quote_ident(table_name) for key, table_name in table_names}
+    return Statement(name, _statement_templates[name].format(**tables))
+
+
+def get_statement(name, config=None):
+    """Возвращает запрос name, собранный для имён таблиц из config. Запрос собирается один раз на набор имён."""
+    config = config if config is not None else current_app.config
+    table_names = tuple((key, config[setting]) for key, setting in STATEMENT_TABLE_SETTINGS)
+    return _compose_statement(name, table_names)
+
+
+def execute_statement(cursor, name, params=()):
+    """Выполняет зарегистрированный запрос name на курсоре.
+
+    Если включён DB_PREPARED_STATEMENTS, запрос один раз на соединение подготавливается через PREPARE,
+    а дальше выполняется через EXECUTE, и PostgreSQL не разбирает и не планирует его заново.
+    """
+    statement = get_statement(name)
+    conn = cursor.connection
+    prepared_statements = getattr(conn, 'prepared_statements', None)
+    if prepared_statements is None or not current_app.config.get('DB_PREPARED_STATEMENTS'):
+        cursor.execute(statement.text, params)
+        return
+    if statement.prepared_name not in prepared_statements:
+        cursor.execute(f'PREPARE {statement.prepared_name} AS {statement.numbered_text}')
+        prepared_statements.add(statement.prepared_name)
+    cursor.execute(statement.execute_text, params)
+
+
+def get_conn_to_db(readonly=False):
+    """Берёт соединение из пула и закрепляет его за текущим контекстом приложения до вызова close_db_conn.
+
+    Для readonly=True соединение берётся с реплики из DB_REPLICAS, если они заданы и доступны, иначе с основной БД.
+    Если в контексте уже открыто соединение с основной БД, чтение тоже идёт через него.
+    Если пул занят дольше DB_POOL_TIMEOUT, выбрасывает PoolTimeout, а если подключиться к БД не удалось
+    и со второй попытки - DatabaseUnavailable.
+    """
+    if readonly and 'db_conn' not in g:
+        conn = _get_replica_conn()
+        if conn is not None:
+            return conn
     if 'db_conn' not in g:
+        pool = get_db_pool()
+        error = None
         for _ in range(2):
             try:
-                # print('Выполняется попытка подключения к базе данных.')
-                g.db_conn = connect(database=current_app.config['DB_NAME'],
-                                    user=current_app.config['DB_USER'],
-                                    password=current_app.config['DB_PASSWORD'],
-                                    host=current_app.config['DB_HOST'],
-                                    port=current_app.config['DB_PORT'])
+                with timed('db_connect'):
+                    g.db_conn = pool.getconn()
+            except PoolTimeout:
+                # Пул уже прождал DB_POOL_TIMEOUT, повторная попытка только удвоила бы задержку.
+                raise
             except (OperationalError, InterfaceError) as e:
                 print(f'Возникло исключение {e} при попытке установить соединение с базой данных.')
+                error = e
             else:
-                # print('Соединение с базой данных установлено.')
                 break
         else:
-            return None
+            raise DatabaseUnavailable(f'Не удалось установить соединение с базой данных: {error}') from error
     return g.db_conn
 
 
 def create_data_base():
     """Функции для создания базы данных."""
     conn = get_conn_to_db()
-    if conn:
-        cursor = conn.cursor()
-        conn.autocommit = True
-        db_name = sql.Identifier(current_app.config['DB_NAME'])
-        try:
-            cursor.execute(sql.SQL('CREATE DATABASE {db_name}').format(db_name=db_name))
-        except ProgrammingError:
-            print(f"База данных {db_name} уже существует.")
-        else:
-            print(f"База данных {db_name} успешно создана.")
-        cursor.close()
-        close_db_conn()
-
-
-def create_user_table():
-    """Функции для создания таблицы user."""
-    conn = get_conn_to_db()
-    if conn:
-        cursor = conn.cursor()
-        user_table_name = sql.Identifier(current_app.config['USER_TABLE_NAME'])
-        try:
-            cursor.execute(sql.SQL("""
-                                  CREATE TABLE {user_table_name}
-                                  (id SERIAL PRIMARY KEY,
-                                   email varchar(100) NOT NULL,
-                                   password varchar(500) NOT NULL,
-                                   is_admin boolean NOT NULL DEFAULT FALSE,
-                                   registration_date timestamptz NOT NULL);""").format(
-                user_table_name=user_table_name, ))
-        except DuplicateTable:
-            print(f"Таблица {user_table_name} уже существует.")
-        else:
-            conn.commit()
-            print(f"Таблица {user_table_name} успешно создана.")
-        cursor.close()
-        close_db_conn()
-
-
-def create_blacklist_token_table():
-    """Функции для создания таблицы blacklist_token."""
-    conn = get_conn_to_db()
-    if conn:
-        cursor = conn.cursor()
-        blacklist_token_table_name = sql.Identifier(current_app.config['BLACKLIST_TOKEN_TABLE_NAME'])
-        try:
-            cursor.execute(sql.SQL("""
-                                  CREATE TABLE {blacklist_token_table_name}
-                                  (id SERIAL PRIMARY KEY,
-                                   token varchar(500) NOT NULL,
-                                   blacklisted_date timestamptz NOT NULL);""").format(
-                blacklist_token_table_name=blacklist_token_table_name, ))
-        except DuplicateTable:
-            print(f"Таблица {blacklist_token_table_name} уже существует.")
-        else:
-            conn.commit()
-            print(f"Таблица {blacklist_token_table_name} успешно создана.")
-        cursor.close()
-        close_db_conn()
-
+    cursor = conn.cursor()
+    conn.autocommit = True
+    db_name = sql.Identifier(current_app.config['DB_NAME'])
+    try:
+        cursor.execute(sql.SQL('CREATE DATABASE {db_name}').format(db_name=db_name))
+    except ProgrammingError:
+        print(f"База данных {db_name} уже существует.")
+    else:
+        print(f"База данных {db_name} успешно создана.")
+    cursor.close()
+    close_db_conn()
 
-def close_db_conn():
-    db_conn = g.pop('db_conn', None)
 
-    if db_conn is not None:
-        db_conn.close()
+def close_db_conn(e=None):
+    """Возвращает соединения текущего контекста приложения в пул."""
+    for key in ('db_conn', 'db_replica_conn'):
+        db_conn = g.pop(key, None)
+        if db_conn is not None:
+            db_conn.pool.putconn(db_conn)
 
 
 def delete_test_tables():
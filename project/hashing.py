@@ -0,0 +1,114 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from flask import current_app
+from flask_bcrypt import Bcrypt
+
+from project.metrics import timed
+
+# Экземпляр без приложения для дочерних процессов пула: число раундов всегда передаётся явно.
+_bcrypt = Bcrypt()
+
+
+class HashingPoolBusy(Exception):
+    """Исключение, возникающее, если очередь пула хеширования заполнена или ответ не получен вовремя."""
+
+
+def _generate_password_hash(password, rounds):
+    return _bcrypt.generate_password_hash(password, rounds).decode('utf-8')
+
+
+def _check_password_hash(pw_hash, password):
+    return _bcrypt.check_password_hash(pw_hash, password)
+
+
+class HashingPool:
+    """Пул процессов для bcrypt с ограниченной очередью.
+
+    Одновременно принимает не больше size + queue_size задач, остальные сразу получают HashingPoolBusy,
+    чтобы потоки веб-сервера не простаивали в ожидании хеширования во время всплеска логинов.
+    """
+
+    def __init__(self, size, queue_size, timeout):
+        self.size = size
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.in_flight = 0
+        self._slots = threading.BoundedSemaphore(size + queue_size)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _get_executor(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # spawn, а не fork: дочерние процессы не наследуют потоки и соединения веб-сервера.
+                    self._executor = ProcessPoolExecutor(max_workers=self.size,
+                                                         mp_context=multiprocessing.get_context('spawn'))
+                    self._pid = os.getpid()
+        return self._executor
+
+    def _release(self, future):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def submit(self, fn, *args):
+        """Ставит fn(*args) в очередь пула и возвращает Future или бросает HashingPoolBusy."""
+        if not self._slots.acquire(blocking=False):
+            raise HashingPoolBusy('Очередь пула хеширования заполнена.')
+        with self._lock:
+            self.in_flight += 1
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except Exception:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def run(self, fn, *args):
+        """Выполняет fn(*args) в пуле и возвращает результат или бросает HashingPoolBusy."""
+        future = self.submit(fn, *args)
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise HashingPoolBusy('Пул хеширования не ответил вовремя.')
+
+    def shutdown(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+        self._pid = None
+
+
+def init_hashing_pool(config=None):
+    """Создаёт пул хеширования, если в настройках задан BCRYPT_POOL_SIZE больше нуля."""
+    config = current_app.config if config is None else config
+    size = config.get('BCRYPT_POOL_SIZE')
+    if size:
+        config['HASHING_POOL'] = HashingPool(size=size,
+                                             queue_size=config['BCRYPT_POOL_QUEUE_SIZE'],
+                                             timeout=config['BCRYPT_POOL_TIMEOUT'])
+
+
+def generate_password_hash(password):
+    """Хеширует пароль в пуле процессов, а если пул не настроен, то в текущем потоке."""
+    rounds = current_app.config.get('BCRYPT_LOG_ROUNDS')
+    pool = current_app.config.get('HASHING_POOL')
+    with timed('bcrypt'):
+        if pool is None:
+            return current_app.config['BCRYPT'].generate_password_hash(password, rounds).decode('utf-8')
+        return pool.run(_generate_password_hash, password, rounds)
+
+
+def check_password_hash(pw_hash, password):
+    """Проверяет пароль в пуле процессов, а если пул не настроен, то в текущем потоке."""
+    pool = current_app.config.get('HASHING_POOL')
+    with timed('bcrypt'):
+        if pool is None:
+            return current_app.config['BCRYPT'].check_password_hash(pw_hash, password)
+        return pool.run(_check_password_hash, pw_hash, password)
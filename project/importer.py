@@ -0,0 +1,147 @@
+import csv
+import io
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+
+from flask import current_app
+from psycopg2 import sql
+
+from project.db import get_conn_to_db, close_db_conn
+from project.hashing import _generate_password_hash
+
+BCRYPT_PREFIXES = ('$2a$', '$2b$', '$2y$')
+
+
+class ImportStats:
+    """Счётчики загрузки пользователей."""
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.read = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.rejected = 0
+
+    @property
+    def rows_per_second(self):
+        elapsed = time.monotonic() - self.started_at
+        return self.read / elapsed if elapsed else 0.0
+
+
+def read_user_rows(file, file_format):
+    """Построчно читает пользователей из CSV с заголовком или из NDJSON. Возвращает генератор словарей
+    с ключами email и password (открытый пароль) либо password_hash (готовый хеш bcrypt)."""
+    if file_format == 'csv':
+        yield from csv.DictReader(file)
+    else:
+        for line in file:
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield {}
+
+
+def _prepare_row(row):
+    """Проверяет строку файла. Возвращает (email, пароль или хеш, нужно ли хешировать, is_admin)
+    или None, если строку нужно отклонить."""
+    if not isinstance(row, dict):
+        return None
+    email = (row.get('email') or '').strip()
+    password_hash = row.get('password_hash') or ''
+    password = row.get('password') or ''
+    is_admin = str(row.get('is_admin', '')).lower() in ('1', 'true', 't', 'yes')
+    if not email or len(email) > 100:
+        return None
+    if password_hash:
+        if not password_hash.startswith(BCRYPT_PREFIXES):
+            return None
+        return email, password_hash, False, is_admin
+    if password:
+        return email, password, True, is_admin
+    return None
+
+
+def _hash_batch(executor, workers, rows, rounds):
+    """Сразу ставит хеширование открытых паролей пачки в пул процессов.
+    Возвращает строки пачки и итератор хешей в порядке строк."""
+    plaintext = [row[1] for row in rows if row[2]]
+    chunksize = max(1, len(plaintext) // (workers * 4))
+    hashes = executor.map(_generate_password_hash, plaintext, [rounds] * len(plaintext), chunksize=chunksize)
+    return rows, hashes
+
+
+def _copy_batch(conn, cursor, rows, hashes, stats):
+    """Загружает пачку во временную таблицу через COPY и переносит её в таблицу user одним запросом.
+    Строки с уже существующим email пропускаются и считаются дубликатами."""
+    user_table_name = sql.Identifier(current_app.config['USER_TABLE_NAME'])
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    registration_date = datetime.utcnow().isoformat()
+    for email, secret, needs_hash, is_admin in rows:
+        writer.writerow([email, next(hashes) if needs_hash else secret, 't' if is_admin else 'f', registration_date])
+    buffer.seek(0)
+    cursor.copy_expert('COPY import_user (email, password, is_admin, registration_date) FROM STDIN WITH (FORMAT csv)',
+                       buffer)
+    cursor.execute(sql.SQL("""INSERT INTO {user_table_name} (email, password, is_admin, registration_date)
+                              SELECT DISTINCT ON (email) email, password, is_admin, registration_date
+                              FROM import_user
+                              ON CONFLICT (email) DO NOTHING;""").format(user_table_name=user_table_name))
+    inserted = cursor.rowcount
+    cursor.execute('TRUNCATE import_user;')
+    conn.commit()
+    stats.inserted += inserted
+    stats.duplicates += len(rows) - inserted
+
+
+def import_users(file, file_format='csv', batch_size=5000, workers=None, progress=None):
+    """Загружает пользователей из файла пачками по batch_size строк.
+
+    Открытые пароли хешируются в пуле из workers процессов, пока предыдущая пачка загружается в БД,
+    готовые хеши bcrypt сохраняются как есть. В памяти одновременно держится не больше двух пачек.
+    После каждой пачки вызывается progress(stats). Возвращает ImportStats.
+    """
+    stats = ImportStats()
+    rounds = current_app.config.get('BCRYPT_LOG_ROUNDS')
+    conn = get_conn_to_db()
+    cursor = conn.cursor()
+    cursor.execute("""CREATE TEMP TABLE IF NOT EXISTS import_user
+                      (email varchar(100) NOT NULL,
+                       password varchar(500) NOT NULL,
+                       is_admin boolean NOT NULL,
+                       registration_date timestamptz NOT NULL);""")
+    conn.commit()
+    rows_iter = read_user_rows(file, file_format)
+    workers = workers or os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        pending = None
+        while True:
+            raw_rows = list(islice(rows_iter, batch_size))
+            batch = None
+            if raw_rows:
+                stats.read += len(raw_rows)
+                rows = [prepared for prepared in map(_prepare_row, raw_rows) if prepared is not None]
+                stats.rejected += len(raw_rows) - len(rows)
+                batch = _hash_batch(executor, workers, rows, rounds)
+            if pending is not None:
+                _copy_batch(conn, cursor, pending[0], pending[1], stats)
+                if progress is not None:
+                    progress(stats)
+            if batch is None:
+                break
+            pending = batch
+    finally:
+        executor.shutdown(cancel_futures=True)
+        conn.rollback()
+        cursor.execute('DROP TABLE IF EXISTS import_user;')
+        conn.commit()
+        cursor.close()
+        close_db_conn()
+    return stats
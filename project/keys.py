@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+from flask import current_app
+from jwt.algorithms import OKPAlgorithm, RSAAlgorithm
+
+ASYMMETRIC_ALGORITHMS = ('RS256', 'EdDSA')
+
+
+class SigningKey:
+    """Ключ подписи токенов с идентификатором kid."""
+
+    def __init__(self, kid, algorithm, private_key):
+        self.kid = kid
+        self.algorithm = algorithm
+        self.private_key = private_key
+        self.public_key = private_key.public_key()
+
+    def jwk(self):
+        """Возвращает открытую часть ключа в формате JWK."""
+        if self.algorithm == 'RS256':
+            jwk = RSAAlgorithm.to_jwk(self.public_key, as_dict=True)
+        else:
+            jwk = OKPAlgorithm.to_jwk(self.public_key, as_dict=True)
+        jwk.update(kid=self.kid, alg=self.algorithm, use='sig')
+        return jwk
+
+
+class KeyRing:
+    """Набор ключей подписи. Новые токены подписываются активным ключом, а проверяются любым ключом набора,
+    поэтому при ротации старый ключ остаётся в наборе, пока не истекут подписанные им токены."""
+
+    def __init__(self, keys, active_kid=None):
+        if not keys:
+            raise ValueError('Набор ключей подписи пуст.')
+        self.keys = {key.kid: key for key in keys}
+        active_kid = active_kid or max(self.keys)
+        if active_kid not in self.keys:
+            raise ValueError(f'Ключа {active_kid} нет в наборе.')
+        self.active = self.keys[active_kid]
+        self.jwks = {'keys': [key.jwk() for key in sorted(self.keys.values(), key=lambda key: key.kid)]}
+        self.jwks_json = json.dumps(self.jwks, sort_keys=True)
+        self.jwks_etag = hashlib.sha256(self.jwks_json.encode('utf-8')).hexdigest()[:32]
+
+    def get(self, kid):
+        return self.keys.get(kid)
+
+    @classmethod
+    def from_directory(cls, path, algorithm, active_kid=None):
+        """Загружает ключи из файлов <kid>.pem каталога path. Активным ключом становится active_kid,
+        а если он не задан, ключ с наибольшим kid."""
+        keys = []
+        for file_name in sorted(os.listdir(path)):
+            if not file_name.endswith('.pem'):
+                continue
+            with open(os.path.join(path, file_name), 'rb') as f:
+                private_key = serialization.load_pem_private_key(f.read(), password=None)
+            if _algorithm_for_key(private_key) != algorithm:
+                continue
+            keys.append(SigningKey(file_name[:-len('.pem')], algorithm, private_key))
+        return cls(keys, active_kid)
+
+
+def _algorithm_for_key(private_key):
+    if isinstance(private_key, rsa.RSAPrivateKey):
+        return 'RS256'
+    if isinstance(private_key, ed25519.Ed25519PrivateKey):
+        return 'EdDSA'
+    return None
+
+
+def generate_signing_key(path, algorithm):
+    """Создаёт в каталоге path новый закрытый ключ для algorithm. Идентификатор ключа строится из времени
+    создания, поэтому новый ключ становится активным. Возвращает kid."""
+    if algorithm == 'RS256':
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    elif algorithm == 'EdDSA':
+        private_key = ed25519.Ed25519PrivateKey.generate()
+    else:
+        raise ValueError(f'Алгоритм {algorithm} не поддерживается, нужен один из {ASYMMETRIC_ALGORITHMS}.')
+    kid = datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
+    os.makedirs(path, exist_ok=True)
+    pem = private_key.private_bytes(encoding=serialization.Encoding.PEM,
+                                    format=serialization.PrivateFormat.PKCS8,
+                                    encryption_algorithm=serialization.NoEncryption())
+    fd = os.open(os.path.join(path, kid + '.pem'), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(pem)
+    return kid
+
+
+def init_keyring(config=None, lazy=False):
+    """Загружает ключи подписи в config['JWT_KEYRING'], если JWT_ALGORITHM асимметричный.
+    Для HS256 токены подписываются SECRET_KEY и набор ключей не нужен.
+    С lazy=True ключи загружаются при первой подписи или проверке токена (get_keyring)."""
+    config = config if config is not None else current_app.config
+    algorithm = config['JWT_ALGORITHM']
+    if algorithm == 'HS256':
+        config['JWT_KEYRING'] = None
+        return
+    if algorithm not in ASYMMETRIC_ALGORITHMS:
+        raise ValueError(f'JWT_ALGORITHM должен быть HS256 или одним из {ASYMMETRIC_ALGORITHMS}, а не {algorithm!r}.')
+    if lazy:
+        config.pop('JWT_KEYRING', None)
+        return
+    try:
+        config['JWT_KEYRING'] = KeyRing.from_directory(config['JWT_KEYS_DIR'], algorithm, config['JWT_ACTIVE_KID'])
+    except (OSError, ValueError) as e:
+        raise RuntimeError(f'Не удалось загрузить ключи {algorithm} из {config["JWT_KEYS_DIR"]}: {e}. '
+                           f'Создайте ключ командой flask generate-signing-key.') from e
+
+
+def get_keyring(config):
+    """Возвращает набор ключей подписи из config или None для HS256. Загружает ключи, если init_keyring
+    отложил их загрузку."""
+    if 'JWT_KEYRING' not in config:
+        init_keyring(config)
+    return config['JWT_KEYRING']
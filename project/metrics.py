@@ -0,0 +1,250 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import Blueprint, Response, current_app, g, has_request_context, request
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Монотонно растущий счётчик Prometheus с метками."""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self, extra_labels=()):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = list(self._values.items())
+        for labelvalues, value in values:
+            labels = _format_labels(self.labelnames, labelvalues, extra_labels)
+            lines.append(f'{self.name}{labels} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    """Гистограмма Prometheus с метками и фиксированными границами корзин."""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self, extra_labels=()):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = [(labelvalues, list(counts), total, count)
+                      for labelvalues, (counts, total, count) in self._series.items()]
+        for labelvalues, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, labelvalues,
+                                        list(extra_labels) + [('le', _format_value(bound))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, labelvalues, extra_labels)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+REQUEST_SECONDS = Histogram('flask_auth_request_seconds', 'Request duration by endpoint.',
+                            ('endpoint', 'method', 'status'))
+PHASE_SECONDS = Histogram('flask_auth_phase_seconds', 'Time spent per request phase.', ('phase',))
+DB_CONNECTIONS = Counter('flask_auth_db_connections_total', 'New connections opened to PostgreSQL.')
+DB_REPLICA_EJECTIONS = Counter('flask_auth_db_replica_ejections_total', 'Read replicas ejected after a failure.')
+METRICS = [REQUEST_SECONDS, PHASE_SECONDS, DB_CONNECTIONS, DB_REPLICA_EJECTIONS]
+
+
+def observe_phase(phase, duration):
+    """Учитывает длительность фазы в гистограмме и, внутри запроса, в заголовке Server-Timing."""
+    PHASE_SECONDS.observe(duration, phase)
+    if has_request_context():
+        timings = g.setdefault('phase_timings', {})
+        timings[phase] = timings.get(phase, 0.0) + duration
+
+
+@contextmanager
+def timed(phase):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_phase(phase, time.perf_counter() - started)
+
+
+class StartupTimer:
+    """Замеряет шаги запуска приложения, чтобы было видно, на что уходит время старта воркера."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings = {}
+
+    @contextmanager
+    def step(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = time.perf_counter() - started
+
+    def finish(self, config):
+        """Сохраняет замеры в config['STARTUP_TIMINGS'] и, если включён STARTUP_TIMING_REPORT, печатает отчёт."""
+        self.timings['total'] = time.perf_counter() - self.started
+        config['STARTUP_TIMINGS'] = self.timings
+        if config.get('STARTUP_TIMING_REPORT'):
+            steps = ', '.join(f'{name} {duration * 1000:.1f} мс' for name, duration in self.timings.items())
+            print(f'Приложение запущено за {self.timings["total"] * 1000:.1f} мс: {steps}.')
+
+
+# Поля stats(), которые только растут. Они отдаются как counter с суффиксом _total, чтобы к ним работал rate(),
+# остальные поля описывают текущее состояние и отдаются как gauge.
+COUNTER_STATS = {
+    'cache': ('hits', 'misses'),
+    'blacklist_filter': ('lookups', 'filter_negatives', 'db_lookups', 'db_positives'),
+    'revocation_table': ('lookups', 'positives', 'fallbacks'),
+    'revocation_writer': ('batches', 'written', 'failures'),
+}
+
+
+def _family_lines(name, metric_type, documentation, samples, extra_labels=()):
+    lines = [f'# HELP {name} {documentation}', f'# TYPE {name} {metric_type}']
+    for labels, value in samples:
+        lines.append(f'{name}{_format_labels([label for label, _ in labels], [v for _, v in labels], extra_labels)} '
+                     f'{_format_value(value)}')
+    return lines
+
+
+def _stats_lines(group, documentation, stats_by_labels, extra_labels=()):
+    """Раскладывает словари stats() на gauge flask_auth_<group>{stat=...} и counter flask_auth_<group>_<поле>_total."""
+    name = f'flask_auth_{group}'
+    counter_fields = COUNTER_STATS.get(group, ())
+    gauge_samples = []
+    counter_samples = {field: [] for field in counter_fields}
+    for labels, stats in stats_by_labels:
+        for field, value in stats.items():
+            if field in counter_samples:
+                counter_samples[field].append((labels, value))
+            else:
+                gauge_samples.append((labels + (('stat', field),), float(value)))
+    lines = _family_lines(name, 'gauge', documentation, gauge_samples, extra_labels) if gauge_samples else []
+    for field, samples in counter_samples.items():
+        if samples:
+            lines += _family_lines(f'{name}_{field}_total', 'counter',
+                                   f'{field.replace("_", " ").capitalize()} since the process started.', samples,
+                                   extra_labels)
+    return lines
+
+
+def _collect_app_metrics(config, extra_labels=()):
+    """Снимает на момент запроса /metrics состояние кэшей, фильтра и таблицы отзывов и пулов."""
+    lines = []
+    cache_stats = []
+    for cache_name, key in (('token', 'TOKEN_CACHE'), ('user', 'USER_CACHE')):
+        cache = config.get(key)
+        if cache is not None:
+            stats = cache.stats()
+            cache_stats.append(((('cache', cache_name),),
+                                {field: stats[field] for field in ('hits', 'misses', 'hit_rate', 'size')
+                                 if field in stats}))
+    lines += _stats_lines('cache', 'Cache lookups and hit rate.', cache_stats, extra_labels)
+    for group, key, documentation in (
+            ('blacklist_filter', 'BLACKLIST_FILTER', 'Blacklist Bloom filter state and hit rate.'),
+            ('revocation_table', 'REVOCATION_TABLE', 'Host-wide revocation table state and lookups.'),
+            ('revocation_writer', 'REVOCATION_WRITER', 'Write-behind revocation queue and batches.')):
+        source = config.get(key)
+        if source is not None:
+            lines += _stats_lines(group, documentation, [((), source.stats())], extra_labels)
+    startup_timings = config.get('STARTUP_TIMINGS')
+    if startup_timings:
+        lines += _family_lines('flask_auth_startup_seconds', 'gauge', 'Duration of application startup steps.',
+                               [((('step', name),), duration) for name, duration in startup_timings.items()],
+                               extra_labels)
+    hashing_pool = config.get('HASHING_POOL')
+    if hashing_pool is not None:
+        lines += _family_lines('flask_auth_hashing_in_flight', 'gauge', 'Bcrypt jobs running or queued.',
+                               [((), hashing_pool.in_flight)], extra_labels)
+    return lines
+
+
+metrics_blueprint = Blueprint('metrics', __name__)
+
+
+@metrics_blueprint.route('/metrics', methods=['GET'])
+def metrics():
+    """Метрики в текстовом формате Prometheus.
+
+    Метрики считаются отдельно в каждом процессе, поэтому у каждой серии есть метка pid: ответы разных воркеров
+    за одним портом не сливаются в одну серию, а суммируются в запросе через sum without (pid).
+    """
+    extra_labels = [('pid', os.getpid())]
+    lines = []
+    for metric in METRICS:
+        lines += metric.render(extra_labels)
+    lines += _collect_app_metrics(current_app.config, extra_labels)
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+def _record_request(response):
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    duration = time.perf_counter() - started
+    REQUEST_SECONDS.observe(duration, request.endpoint or 'unknown', request.method, str(response.status_code))
+    if current_app.config.get('SERVER_TIMING_ENABLED'):
+        timings = g.pop('phase_timings', {})
+        entries = [f'{phase};dur={value * 1000:.2f}' for phase, value in timings.items()]
+        entries.append(f'total;dur={duration * 1000:.2f}')
+        response.headers['Server-Timing'] = ', '.join(entries)
+    return response
+
+
+def init_metrics(app):
+    """Подключает к приложению замер запросов, заголовок Server-Timing и эндпоинт /metrics."""
+    if not app.config.get('METRICS_ENABLED'):
+        return
+    app.before_request(_start_request_timer)
+    app.after_request(_record_request)
+    app.register_blueprint(metrics_blueprint)
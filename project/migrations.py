@@ -0,0 +1,373 @@
+import os
+import re
+from datetime import datetime, timedelta
+
+from flask import current_app
+from psycopg2 import sql
+
+from project.db import get_conn_to_db, close_db_conn, DatabaseUnavailable
+
+# Ключ advisory-блокировки, чтобы несколько процессов не применяли миграции одновременно.
+MIGRATION_LOCK_KEY = 720531
+SCHEMA_CHECK_MODES = ('migrate', 'check', 'skip')
+
+
+class SchemaOutdated(RuntimeError):
+    """Исключение, возникающее при запуске приложения на БД с неприменёнными миграциями."""
+
+
+def _table_identifiers():
+    """Возвращает идентификаторы таблиц и индексов из настроек приложения."""
+    user_table_name = current_app.config['USER_TABLE_NAME']
+    blacklist_token_table_name = current_app.config['BLACKLIST_TOKEN_TABLE_NAME']
+    return dict(
+        user_table_name=sql.Identifier(user_table_name),
+        blacklist_token_table_name=sql.Identifier(blacklist_token_table_name),
+        unpartitioned_blacklist_token_table_name=sql.Identifier(blacklist_token_table_name + '_unpartitioned'),
+        default_blacklist_token_partition_name=sql.Identifier(blacklist_token_table_name + '_default'),
+        email_index_name=sql.Identifier(user_table_name + '_email_key'),
+        token_hash_index_name=sql.Identifier(blacklist_token_table_name + '_token_hash_idx'),
+        expires_at_index_name=sql.Identifier(blacklist_token_table_name + '_expires_at_idx'),
+        blacklisted_date_index_name=sql.Identifier(blacklist_token_table_name + '_blacklisted_date_idx'),
+        user_version_function_name=sql.Identifier(user_table_name + '_bump_version'),
+        user_version_trigger_name=sql.Identifier(user_table_name + '_bump_version'),
+    )
+
+
+def _create_user_table(cursor, names):
+    cursor.execute(sql.SQL("""
+                          CREATE TABLE IF NOT EXISTS {user_table_name}
+                          (id SERIAL PRIMARY KEY,
+                           email varchar(100) NOT NULL,
+                           password varchar(500) NOT NULL,
+                           is_admin boolean NOT NULL DEFAULT FALSE,
+                           registration_date timestamptz NOT NULL);""").format(**names))
+
+
+def _create_blacklist_token_table(cursor, names):
+    cursor.execute(sql.SQL("""
+                          CREATE TABLE IF NOT EXISTS {blacklist_token_table_name}
+                          (id SERIAL PRIMARY KEY,
+                           token varchar(500) NOT NULL,
+                           blacklisted_date timestamptz NOT NULL);""").format(**names))
+
+
+def _add_user_email_unique_index(cursor, names):
+    # До этой миграции одновременные регистрации могли сохранить один email дважды. Из каждой группы
+    # дубликатов остаётся пользователь с наименьшим id, удалённые строки выводятся в отчёт.
+    cursor.execute(sql.SQL("""DELETE FROM {user_table_name} duplicate
+                              USING {user_table_name} original
+                              WHERE duplicate.email = original.email AND duplicate.id > original.id
+                              RETURNING duplicate.id, duplicate.email;""").format(**names))
+    for user_id, email in sorted(cursor.fetchall()):
+        print(f'Удалён дубликат пользователя {email} с id {user_id}.')
+    conn = cursor.connection
+    conn.commit()
+    # CONCURRENTLY не блокирует запись в таблицу на время построения индекса, но работает только вне транзакции.
+    conn.autocommit = True
+    try:
+        # Прерванное построение оставляет невалидный индекс, который IF NOT EXISTS не стал бы пересоздавать.
+        cursor.execute("""SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s);""",
+                       [names['email_index_name'].as_string(cursor)])
+        row = cursor.fetchone()
+        if row is not None and row[0]:
+            cursor.execute(sql.SQL("""DROP INDEX CONCURRENTLY {email_index_name};""").format(**names))
+        cursor.execute(sql.SQL("""CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {email_index_name}
+                                  ON {user_table_name} (email);""").format(**names))
+    finally:
+        conn.autocommit = False
+
+
+def _add_blacklist_token_hash(cursor, names):
+    # Вместо индекса по varchar(500) храним SHA-256 токена фиксированной длины 32 байта.
+    cursor.execute(sql.SQL("""ALTER TABLE {blacklist_token_table_name}
+                              ADD COLUMN IF NOT EXISTS token_hash bytea;""").format(**names))
+    cursor.execute(sql.SQL("""UPDATE {blacklist_token_table_name}
+                              SET token_hash = sha256(convert_to(token, 'UTF8'))
+                              WHERE token_hash IS NULL;""").format(**names))
+    cursor.execute(sql.SQL("""ALTER TABLE {blacklist_token_table_name}
+                              ALTER COLUMN token_hash SET NOT NULL,
+                              ADD CHECK (octet_length(token_hash) = 32);""").format(**names))
+    cursor.execute(sql.SQL("""CREATE INDEX IF NOT EXISTS {token_hash_index_name}
+                              ON {blacklist_token_table_name} (token_hash);""").format(**names))
+
+
+def _add_blacklist_token_expiry(cursor, names):
+    # Теперь в чёрном списке хранится только ключ отзыва (хеш jti) и срок действия токена.
+    # Для старых строк срок действия неизвестен, поэтому берём дату отзыва плюс время жизни токена.
+    cursor.execute(sql.SQL("""ALTER TABLE {blacklist_token_table_name}
+                              ALTER COLUMN token DROP NOT NULL,
+                              ADD COLUMN IF NOT EXISTS expires_at timestamptz;""").format(**names))
+    cursor.execute(sql.SQL("""UPDATE {blacklist_token_table_name}
+                              SET expires_at = blacklisted_date + make_interval(secs => %s)
+                              WHERE expires_at IS NULL;""").format(**names),
+                   [current_app.config['AUTH_TOKEN_EXPIRATION_SECONDS']])
+    cursor.execute(sql.SQL("""ALTER TABLE {blacklist_token_table_name}
+                              ALTER COLUMN expires_at SET NOT NULL;""").format(**names))
+    cursor.execute(sql.SQL("""CREATE INDEX IF NOT EXISTS {expires_at_index_name}
+                              ON {blacklist_token_table_name} (expires_at);""").format(**names))
+
+
+def _add_user_version(cursor, names):
+    # Версия строки пользователя для ETag ответа /auth/status. Её увеличивает триггер при любом изменении строки,
+    # в том числе сделанном в обход приложения.
+    cursor.execute(sql.SQL("""ALTER TABLE {user_table_name}
+                              ADD COLUMN IF NOT EXISTS version integer NOT NULL DEFAULT 1;""").format(**names))
+    cursor.execute(sql.SQL("""CREATE OR REPLACE FUNCTION {user_version_function_name}() RETURNS trigger AS $$
+                              BEGIN
+                                  IF NEW IS DISTINCT FROM OLD THEN
+                                      NEW.version := OLD.version + 1;
+                                  END IF;
+                                  RETURN NEW;
+                              END;
+                              $$ LANGUAGE plpgsql;""").format(**names))
+    cursor.execute(sql.SQL("""DROP TRIGGER IF EXISTS {user_version_trigger_name}
+                              ON {user_table_name};""").format(**names))
+    cursor.execute(sql.SQL("""CREATE TRIGGER {user_version_trigger_name}
+                              BEFORE UPDATE ON {user_table_name}
+                              FOR EACH ROW EXECUTE FUNCTION {user_version_function_name}();""").format(**names))
+
+
+def _partition_blacklist_token(cursor, names):
+    # Чёрный список секционируется по сроку действия токена: секция, срок которой прошёл, содержит только
+    # истёкшие токены и удаляется целиком через DROP TABLE вместо DELETE по строкам. Секции по датам создаёт
+    # maintain_blacklist_partitions, а до этого строки попадают в секцию по умолчанию.
+    cursor.execute(sql.SQL("""ALTER TABLE {blacklist_token_table_name}
+                              RENAME TO {unpartitioned_blacklist_token_table_name};""").format(**names))
+    cursor.execute(sql.SQL("""DROP INDEX IF EXISTS {token_hash_index_name}, {expires_at_index_name};""").format(
+        **names))
+    cursor.execute("""SELECT pg_get_serial_sequence(%s, 'id');""",
+                   [names['unpartitioned_blacklist_token_table_name'].as_string(cursor)])
+    id_sequence = cursor.fetchone()[0]
+    # Ключ секционирования должен входить в первичный ключ, поэтому id остаётся без ограничения PRIMARY KEY.
+    cursor.execute(sql.SQL("""CREATE TABLE {blacklist_token_table_name}
+                              (id integer NOT NULL DEFAULT nextval({id_sequence}::regclass),
+                               token_hash bytea NOT NULL CHECK (octet_length(token_hash) = 32),
+                               expires_at timestamptz NOT NULL,
+                               blacklisted_date timestamptz NOT NULL)
+                              PARTITION BY RANGE (expires_at);""").format(id_sequence=sql.Literal(id_sequence),
+                                                                         **names))
+    cursor.execute(sql.SQL("""CREATE TABLE {default_blacklist_token_partition_name}
+                              PARTITION OF {blacklist_token_table_name} DEFAULT;""").format(**names))
+    cursor.execute(sql.SQL("""CREATE INDEX {token_hash_index_name}
+                              ON {blacklist_token_table_name} (token_hash);""").format(**names))
+    cursor.execute(sql.SQL("""CREATE INDEX {expires_at_index_name}
+                              ON {blacklist_token_table_name} (expires_at);""").format(**names))
+    cursor.execute(sql.SQL("""INSERT INTO {blacklist_token_table_name} (id, token_hash, expires_at, blacklisted_date)
+                              SELECT id, token_hash, expires_at, blacklisted_date
+                              FROM {unpartitioned_blacklist_token_table_name};""").format(**names))
+    cursor.execute(sql.SQL("""ALTER SEQUENCE {id_sequence} OWNED BY {blacklist_token_table_name}.id;""").format(
+        id_sequence=sql.SQL(id_sequence), **names))
+    cursor.execute(sql.SQL("""DROP TABLE {unpartitioned_blacklist_token_table_name};""").format(**names))
+
+
+def _add_blacklisted_date_index(cursor, names):
+    # Фильтр Блума и таблица отзывов каждого воркера раз в несколько секунд догружают отзывы по blacklisted_date.
+    # Индекс на секционированной таблице создаётся во всех её секциях, включая будущие.
+    cursor.execute(sql.SQL("""CREATE INDEX IF NOT EXISTS {blacklisted_date_index_name}
+                              ON {blacklist_token_table_name} (blacklisted_date);""").format(**names))
+
+
+# Миграции применяются строго по возрастанию версии. Уже выпущенные миграции не изменяются,
+# любое изменение схемы добавляется новой миграцией в конец списка.
+MIGRATIONS = [
+    (1, 'Создание таблицы user', _create_user_table),
+    (2, 'Создание таблицы blacklist_token', _create_blacklist_token_table),
+    (3, 'Уникальный индекс по email пользователя', _add_user_email_unique_index),
+    (4, 'Хеш токена фиксированной длины и индекс по нему', _add_blacklist_token_hash),
+    (5, 'Срок действия отозванных токенов вместо самих токенов', _add_blacklist_token_expiry),
+    (6, 'Версия строки пользователя для ETag', _add_user_version),
+    (7, 'Секционирование blacklist_token по сроку действия токена', _partition_blacklist_token),
+    (8, 'Индекс по дате отзыва для догрузки отзывов', _add_blacklisted_date_index),
+]
+LATEST_SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Схемы, версия которых уже проверена в этом процессе.
+_verified_schemas = set()
+
+
+def get_schema_version(cursor):
+    """Возвращает номер последней применённой миграции или 0, если миграции ещё не применялись."""
+    schema_version_table_name = sql.Identifier(current_app.config['SCHEMA_VERSION_TABLE_NAME'])
+    cursor.execute(sql.SQL("""SELECT to_regclass(%s);"""),
+                   [current_app.config['SCHEMA_VERSION_TABLE_NAME']])
+    if cursor.fetchone()[0] is None:
+        return 0
+    cursor.execute(sql.SQL("""SELECT coalesce(max(version), 0) FROM {schema_version_table_name};""").format(
+        schema_version_table_name=schema_version_table_name))
+    return cursor.fetchone()[0]
+
+
+def apply_migrations():
+    """Применяет к БД все ещё не применённые миграции. Возвращает номер версии схемы после применения."""
+    conn = get_conn_to_db()
+    cursor = conn.cursor()
+    schema_version_table_name = sql.Identifier(current_app.config['SCHEMA_VERSION_TABLE_NAME'])
+    names = _table_identifiers()
+    cursor.execute('SELECT pg_advisory_lock(%s);', [MIGRATION_LOCK_KEY])
+    try:
+        cursor.execute(sql.SQL("""
+                              CREATE TABLE IF NOT EXISTS {schema_version_table_name}
+                              (version integer PRIMARY KEY,
+                               description varchar(200) NOT NULL,
+                               applied_date timestamptz NOT NULL);""").format(
+            schema_version_table_name=schema_version_table_name))
+        conn.commit()
+        version = get_schema_version(cursor)
+        for migration_version, description, migration in MIGRATIONS:
+            if migration_version <= version:
+                continue
+            migration(cursor, names)
+            cursor.execute(sql.SQL("""INSERT INTO {schema_version_table_name}
+                                      (version, description, applied_date)
+                                      VALUES(%s, %s, %s);""").format(
+                schema_version_table_name=schema_version_table_name),
+                [migration_version, description, datetime.utcnow()])
+            conn.commit()
+            version = migration_version
+            print(f"Применена миграция {migration_version}: {description}.")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.execute('SELECT pg_advisory_unlock(%s);', [MIGRATION_LOCK_KEY])
+        conn.commit()
+        cursor.close()
+        close_db_conn()
+    return version
+
+
+def ensure_schema(mode):
+    """Проверяет при запуске приложения, что схема БД актуальна.
+
+    mode='migrate' применяет недостающие миграции, mode='check' выбрасывает SchemaOutdated,
+    mode='skip' ничего не делает и оставляет схему команде init-db. Если схема актуальна, выполняется
+    один запрос версии, а повторные проверки той же БД в процессе не выполняются вовсе.
+    Возвращает версию схемы или None, если проверка не выполнялась или не удалось подключиться к БД.
+    """
+    if mode not in SCHEMA_CHECK_MODES:
+        raise ValueError(f'SCHEMA_CHECK_ON_STARTUP должен быть одним из {SCHEMA_CHECK_MODES}, а не {mode!r}.')
+    if mode == 'skip':
+        return None
+    config = current_app.config
+    key = (os.getpid(), config['DB_NAME'], config['DB_HOST'], config['DB_PORT'],
+           config['SCHEMA_VERSION_TABLE_NAME'])
+    if key in _verified_schemas:
+        return LATEST_SCHEMA_VERSION
+    try:
+        conn = get_conn_to_db()
+    except DatabaseUnavailable as e:
+        # БД может подняться позже приложения: запросы получат ошибку, а схему проверит следующий запуск.
+        print(f'Схема БД не проверена: {e}')
+        return None
+    cursor = conn.cursor()
+    try:
+        version = get_schema_version(cursor)
+    finally:
+        conn.rollback()
+        cursor.close()
+    if version < LATEST_SCHEMA_VERSION:
+        if mode == 'check':
+            raise SchemaOutdated(f'Версия схемы БД {version}, приложению нужна {LATEST_SCHEMA_VERSION}. '
+                                 f'Выполните flask init-db.')
+        version = apply_migrations()
+    if version is not None and version >= LATEST_SCHEMA_VERSION:
+        _verified_schemas.add(key)
+    return version
+
+
+def _partition_bounds(table_name, partition_name):
+    """Возвращает границы секции чёрного списка по её имени или None для секции по умолчанию."""
+    match = re.fullmatch(re.escape(table_name) + r'_(\d{8})_(\d{8})', partition_name)
+    if match is None:
+        return None
+    return tuple(datetime.strptime(value, '%Y%m%d') for value in match.groups())
+
+
+def maintain_blacklist_partitions(now=None):
+    """Обслуживает секции чёрного списка.
+
+    Создаёт секции по BLACKLIST_PARTITION_DAYS дней вперёд так, чтобы они покрывали срок действия любого
+    токена, выданного сейчас, плюс BLACKLIST_PARTITIONS_PREMAKE секций про запас, и переносит в них строки
+    из секции по умолчанию. Удаляет секции, все токены в которых уже истекли, и истёкшие токены из секции
+    по умолчанию. Возвращает списки имён созданных и удалённых секций или None, если таблица ещё
+    не секционирована.
+    """
+    config = current_app.config
+    now = now or datetime.utcnow()
+    table_name = config['BLACKLIST_TOKEN_TABLE_NAME']
+    names = _table_identifiers()
+    conn = get_conn_to_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT pg_advisory_lock(%s);', [MIGRATION_LOCK_KEY])
+    created, dropped = [], []
+    try:
+        cursor.execute("""SELECT relkind FROM pg_class
+                          WHERE relname = %s AND relnamespace = current_schema()::regnamespace;""", [table_name])
+        row = cursor.fetchone()
+        if row is None or row[0] != 'p':
+            return None
+        cursor.execute("""SELECT child.relname FROM pg_inherits
+                          JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                          JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+                          WHERE parent.relname = %s
+                            AND parent.relnamespace = current_schema()::regnamespace;""", [table_name])
+        ranges = []
+        for (partition_name,) in cursor.fetchall():
+            bounds = _partition_bounds(table_name, partition_name)
+            if bounds is None:
+                continue
+            if bounds[1] <= now:
+                cursor.execute(sql.SQL('DROP TABLE {partition_name};').format(
+                    partition_name=sql.Identifier(partition_name)))
+                conn.commit()
+                dropped.append(partition_name)
+            else:
+                ranges.append(bounds)
+        ranges.sort()
+        interval = timedelta(days=config['BLACKLIST_PARTITION_DAYS'])
+        lifetime = timedelta(seconds=max(config['AUTH_TOKEN_EXPIRATION_SECONDS'],
+                                         config['REFRESH_TOKEN_EXPIRATION_SECONDS']))
+        horizon = now + lifetime + interval * config['BLACKLIST_PARTITIONS_PREMAKE']
+        # Новые секции заполняют промежутки между существующими и не пересекаются с ними,
+        # даже если BLACKLIST_PARTITION_DAYS изменился после их создания.
+        lower = datetime(now.year, now.month, now.day)
+        while lower < horizon:
+            covering = [upper for existing_lower, upper in ranges if existing_lower <= lower < upper]
+            if covering:
+                lower = covering[0]
+                continue
+            upper = min([lower + interval] + [existing_lower for existing_lower, _ in ranges if existing_lower > lower])
+            partition_name = f'{table_name}_{lower:%Y%m%d}_{upper:%Y%m%d}'
+            partition = sql.Identifier(partition_name)
+            # Границы наивные, как и сроки токенов: и те, и другие читаются в часовом поясе сессии (UTC).
+            bounds = dict(lower=sql.Literal(lower), upper=sql.Literal(upper))
+            # Строки этого диапазона, попавшие в секцию по умолчанию, переносятся в новую секцию до её
+            # подключения, иначе ATTACH PARTITION не пройдёт проверку секции по умолчанию.
+            cursor.execute(sql.SQL("""CREATE TABLE {partition}
+                                      (LIKE {blacklist_token_table_name} INCLUDING DEFAULTS INCLUDING CONSTRAINTS);
+                                      """).format(partition=partition, **names))
+            cursor.execute(sql.SQL("""WITH moved AS (DELETE FROM {default_blacklist_token_partition_name}
+                                                     WHERE expires_at >= {lower} AND expires_at < {upper}
+                                                     RETURNING id, token_hash, expires_at, blacklisted_date)
+                                      INSERT INTO {partition} (id, token_hash, expires_at, blacklisted_date)
+                                      SELECT * FROM moved;""").format(partition=partition, **bounds, **names))
+            cursor.execute(sql.SQL("""ALTER TABLE {blacklist_token_table_name}
+                                      ATTACH PARTITION {partition} FOR VALUES FROM ({lower}) TO ({upper});""").format(
+                partition=partition, **bounds, **names))
+            conn.commit()
+            created.append(partition_name)
+            lower = upper
+        # Токены, для срока которых не нашлось секции, лежат в секции по умолчанию и удаляются построчно.
+        cursor.execute(sql.SQL("""DELETE FROM {default_blacklist_token_partition_name}
+                                  WHERE expires_at < %s;""").format(**names), [now])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.execute('SELECT pg_advisory_unlock(%s);', [MIGRATION_LOCK_KEY])
+        conn.commit()
+        cursor.close()
+        close_db_conn()
+    return created, dropped
@@ -1,100 +1,256 @@
-from project.db import get_conn_to_db, close_db_conn
-from psycopg2 import sql
+from project.bloom import BlacklistFilter
+from project.cache import LRUCache
+from project.hashing import generate_password_hash
+from project.keys import get_keyring
+from project.metrics import timed
+from project.revocation import RevocationTable
+from project.storage import get_storage
 from datetime import datetime, timedelta
+import hashlib
+import time
+import uuid
 import jwt
 from flask import current_app
+from werkzeug.utils import import_string
+
+
+def _token_hash(token):
+    """Возвращает SHA-256 токена. По нему токен ищется в кэше проверенных токенов."""
+    if isinstance(token, str):
+        token = token.encode('utf-8')
+    return hashlib.sha256(token).digest()
+
+
+def _revocation_key(token, payload):
+    """Возвращает ключ отзыва токена, который хранится в столбце token_hash таблицы blacklist_token:
+    SHA-256 от jti, а для токенов без jti - SHA-256 всего токена."""
+    jti = payload.get('jti')
+    if jti:
+        return hashlib.sha256(('jti:' + str(jti)).encode('utf-8')).digest()
+    return _token_hash(token)
+
+
+def _unverified_payload(token):
+    """Возвращает полезную нагрузку токена без проверки подписи и срока действия.
+    Используется только для токенов, которые уже были проверены."""
+    return jwt.decode(token, options={'verify_signature': False, 'verify_exp': False})
+
+
+ACCESS_TOKEN_TYPE = 'access'
+REFRESH_TOKEN_TYPE = 'refresh'
+TOKEN_EXPIRATION_SETTINGS = {
+    ACCESS_TOKEN_TYPE: 'AUTH_TOKEN_EXPIRATION_SECONDS',
+    REFRESH_TOKEN_TYPE: 'REFRESH_TOKEN_EXPIRATION_SECONDS',
+}
+
+
+def _encode_auth_token(config, user_id, token_type=ACCESS_TOKEN_TYPE):
+    """Возвращает jwt токен пользователя типа token_type, подписанный по настройкам config.
+    Тип токена записывается в claim typ, срок действия берётся из настройки для этого типа."""
+    payload = {
+        'exp': datetime.utcnow() + timedelta(
+            days=0, seconds=config.get(TOKEN_EXPIRATION_SETTINGS[token_type])),
+        'iat': datetime.utcnow(),
+        'sub': user_id,
+        'jti': uuid.uuid4().hex,
+        'typ': token_type
+    }
+    keyring = get_keyring(config)
+    with timed('jwt'):
+        if keyring is None:
+            return jwt.encode(
+                payload,
+                config.get('SECRET_KEY'),
+                algorithm='HS256'
+            )
+        key = keyring.active
+        return jwt.encode(payload, key.private_key, algorithm=key.algorithm, headers={'kid': key.kid})
+
+
+def _decode_auth_token(config, token, token_type=ACCESS_TOKEN_TYPE):
+    """Проверяет подпись, срок действия и тип токена по настройкам config и возвращает его полезную нагрузку.
+    Токен, подписанный асимметричным ключом, проверяется открытым ключом из заголовка kid.
+    Токены без claim typ, выпущенные до появления refresh токенов, считаются access токенами."""
+    keyring = get_keyring(config)
+    with timed('jwt'):
+        if keyring is None:
+            payload = jwt.decode(token, key=config.get('SECRET_KEY'), algorithms="HS256")
+        else:
+            key = keyring.get(jwt.get_unverified_header(token).get('kid'))
+            if key is None:
+                raise jwt.InvalidTokenError('Неизвестный ключ подписи.')
+            payload = jwt.decode(token, key=key.public_key, algorithms=[key.algorithm])
+    if payload.get('typ', ACCESS_TOKEN_TYPE) != token_type:
+        raise jwt.InvalidTokenError('Неверный тип токена.')
+    return payload
+
+
+# Проекции таблицы user: столбцы, которые читаются для входа по паролю и для данных профиля.
+# Версия профиля не отдаётся в теле ответа, из неё строится ETag.
+CREDENTIAL_FIELDS = ('id', 'password')
+PROFILE_FIELDS = ('id', 'email', 'is_admin', 'registration_date', 'version')
+PUBLIC_PROFILE_FIELDS = ('id', 'email', 'is_admin', 'registration_date')
+
+
+def user_etag(user_id, version):
+    """Строгий ETag профиля пользователя: версия строки растёт при каждом её изменении."""
+    return f'{user_id}.{version}'
+
+
+class UserRecord:
+    """Данные пользователя из одной проекции таблицы user. Заполнены только прочитанные поля,
+    обращение к остальным выбрасывает AttributeError, поэтому хеш пароля не попадёт в ответ случайно."""
+
+    __slots__ = ('id', 'email', 'password', 'is_admin', 'registration_date', 'version')
+
+    @classmethod
+    def from_row(cls, row, fields):
+        """Возвращает запись из строки со столбцами fields или None, если строки нет."""
+        if row is None:
+            return None
+        record = cls()
+        for field, value in zip(fields, row):
+            setattr(record, field, value)
+        return record
+
+    def as_dict(self, fields=PUBLIC_PROFILE_FIELDS):
+        return {field: getattr(self, field) for field in fields}
+
+    def etag(self):
+        return user_etag(self.id, self.version)
 
 
 class User:
     """Класс для хранения методов, связанных с таблицей User"""
 
+    @staticmethod
+    def create(email, password):
+        """Метод принимает email и password пользователя.
+        Атомарно сохраняет пользователя в БД и возвращает его профиль (UserRecord)
+        или None, если пользователь с таким email уже существует"""
+        # Поиск по уникальному индексу дешевле bcrypt, поэтому занятый email отсекается до хеширования.
+        # Читаем основную БД: реплика с отставанием не видит только что зарегистрированный email.
+        # Гонку двух регистраций по-прежнему разрешает INSERT ... ON CONFLICT.
+        if User.get_user_id_or_none(email, primary=True):
+            return None
+        # Хешируем до получения соединения, чтобы не держать его занятым на время работы bcrypt.
+        password = generate_password_hash(password)
+        user_data = get_storage().create_user(email, password, datetime.utcnow())
+        if not user_data:
+            return None
+        User.invalidate_cache(user_data[0])
+        return UserRecord.from_row(user_data, PROFILE_FIELDS)
+
     @staticmethod
     def save(email, password):
         """Метод принимает email и password пользователя.
         Сохраняет пользователя в БД"""
-        user_table_name = sql.Identifier(current_app.config['USER_TABLE_NAME'])
-        conn = get_conn_to_db()
-        cursor = conn.cursor()
-        registration_date = datetime.utcnow()
-        bcrypt = current_app.config.get('BCRYPT')
-        password = bcrypt.generate_password_hash(
-            password, current_app.config.get('BCRYPT_LOG_ROUNDS')).decode('utf-8')
-        data = [email, password, registration_date]
-        cursor.execute(sql.SQL("""INSERT INTO {user_table_name} 
-                                  (email, password, registration_date)
-                                  VALUES(%s, %s, %s);""").format(
-            user_table_name=user_table_name), data)
-        conn.commit()
-        cursor.close()
-        close_db_conn()
-
-    @staticmethod
-    def get_user_id_or_none(email):
+        User.create(email=email, password=password)
+
+    @staticmethod
+    def get_user_id_or_none(email, primary=False):
         """Метод принимает email пользователя.
-        Возвращает user_id пользователя или None, если такого пользователя нет в БД"""
-        user_table_name = sql.Identifier(current_app.config['USER_TABLE_NAME'])
-        conn = get_conn_to_db()
-        cursor = conn.cursor()
-        data = [email]
-        cursor.execute(sql.SQL("""SELECT id FROM {user_table_name} WHERE
-                                  email=%s;""").format(
-            user_table_name=user_table_name), data)
-        user_id = cursor.fetchone()
-        cursor.close()
-        close_db_conn()
-        return user_id
+        Возвращает user_id пользователя или None, если такого пользователя нет в БД.
+        Читает с реплики, если primary не задан"""
+        return get_storage().get_user_id_by_email(email, primary=primary)
 
     @staticmethod
-    def get_user_dict_by_email(email):
+    def get_credentials_by_email(email, primary=False):
         """Метод принимает email пользователя.
-        Возвращает данные пользователя или None, если такого пользователя нет в БД"""
-        user_table_name = sql.Identifier(current_app.config['USER_TABLE_NAME'])
-        conn = get_conn_to_db()
-        cursor = conn.cursor()
-        data = [email]
-        cursor.execute(sql.SQL("""SELECT * FROM {user_table_name} WHERE
-                                  email = %s;""").format(
-            user_table_name=user_table_name), data)
-        user_data = cursor.fetchone()
-        cursor.close()
-        close_db_conn()
-        user_dict = dict()
-        if user_data:
-            try:
-                user_dict['id'] = user_data[0]
-                user_dict['email'] = user_data[1]
-                user_dict['password'] = user_data[2]
-                user_dict['is_admin'] = user_data[3]
-                user_dict['registration_date'] = user_data[4]
-            except IndexError:
-                return user_dict
-        return user_dict
+        Возвращает UserRecord только с id и хешем пароля или None, если такого пользователя нет в БД.
+        Читает с реплики, если primary не задан"""
+        return UserRecord.from_row(get_storage().get_user_credentials_by_email(email, primary=primary),
+                                   CREDENTIAL_FIELDS)
 
     @staticmethod
-    def get_user_dict_by_id(user_id):
+    def get_profile_by_id(user_id, primary=False, cached=True):
         """Метод принимает user_id пользователя.
-        Возвращает данные пользователя или None, если такого пользователя нет в БД"""
-        user_table_name = sql.Identifier(current_app.config['USER_TABLE_NAME'])
-        conn = get_conn_to_db()
-        cursor = conn.cursor()
-        data = [user_id]
-        cursor.execute(sql.SQL("""SELECT * FROM {user_table_name} WHERE
-                                      id = %s;""").format(
-            user_table_name=user_table_name), data)
-        user_data = cursor.fetchone()
-        cursor.close()
-        close_db_conn()
-        user_dict = dict()
-        if user_data:
-            try:
-                user_dict['id'] = user_data[0]
-                user_dict['email'] = user_data[1]
-                user_dict['password'] = user_data[2]
-                user_dict['is_admin'] = user_data[3]
-                user_dict['registration_date'] = user_data[4]
-            except IndexError:
-                return user_dict
-        return user_dict
+        Возвращает профиль пользователя (UserRecord без хеша пароля) или None, если такого пользователя нет в БД.
+        Профиль берётся из кэша пользователей, а при промахе читается из БД и кладётся в кэш.
+        При промахе читает с реплики, если primary не задан. С cached=False кэш не используется"""
+        if not cached:
+            return UserRecord.from_row(get_storage().get_user_profile_by_id(user_id, primary=primary), PROFILE_FIELDS)
+        user_cache = current_app.config.get('USER_CACHE')
+        if user_cache is not None:
+            row = user_cache.get(User._cache_key(user_id))
+            if row is not None:
+                return UserRecord.from_row(row, PROFILE_FIELDS)
+        row = get_storage().get_user_profile_by_id(user_id, primary=primary)
+        if user_cache is not None and row is not None:
+            user_cache.set(User._cache_key(user_id), list(row))
+        return UserRecord.from_row(row, PROFILE_FIELDS)
+
+    @staticmethod
+    def get_profile_version(user_id, primary=False):
+        """Метод принимает user_id пользователя.
+        Возвращает версию профиля или None, если такого пользователя нет в БД. Версия берётся из профиля
+        в кэше пользователей, а при промахе читается из БД без остальных столбцов"""
+        user_cache = current_app.config.get('USER_CACHE')
+        if user_cache is not None:
+            row = user_cache.get(User._cache_key(user_id))
+            if row is not None:
+                return UserRecord.from_row(row, PROFILE_FIELDS).version
+        return get_storage().get_user_version(user_id, primary=primary)
+
+    @staticmethod
+    def get_profiles_page(after_id=0, limit=100):
+        """Метод принимает id, после которого начинается страница, и размер страницы.
+        Возвращает список профилей пользователей по возрастанию id. Страница выбирается по ключу id > after_id,
+        поэтому её стоимость не зависит от того, насколько она далеко от начала"""
+        return [UserRecord.from_row(row, PROFILE_FIELDS)
+                for row in get_storage().get_user_profiles_page(after_id, limit)]
+
+    @staticmethod
+    def iter_profiles(after_id=0, batch_size=1000):
+        """Генератор профилей всех пользователей с id больше after_id по возрастанию id.
+        Профили читаются из БД пачками по batch_size строк и не кэшируются"""
+        for row in get_storage().iter_user_profiles(after_id, batch_size):
+            yield UserRecord.from_row(row, PROFILE_FIELDS)
+
+    @staticmethod
+    def set_admin(email, is_admin=True):
+        """Метод принимает email пользователя и новое значение is_admin.
+        Возвращает id пользователя или None, если такого пользователя нет в БД"""
+        user_id = get_storage().set_user_admin(email, is_admin)
+        if user_id is not None:
+            User.invalidate_cache(user_id)
+        return user_id
+
+    @staticmethod
+    def get_profiles_by_ids(user_ids):
+        """Метод принимает список user_id пользователей.
+        Возвращает словарь user_id -> профиль пользователя для найденных пользователей.
+        Пользователи, которых нет в кэше, читаются из БД одним запросом"""
+        user_cache = current_app.config.get('USER_CACHE')
+        profiles = dict()
+        missing_ids = []
+        for user_id in set(user_ids):
+            row = user_cache.get(User._cache_key(user_id)) if user_cache is not None else None
+            if row is not None:
+                profiles[user_id] = UserRecord.from_row(row, PROFILE_FIELDS)
+            else:
+                missing_ids.append(user_id)
+        if missing_ids:
+            for row in get_storage().get_user_profiles_by_ids(missing_ids):
+                profile = UserRecord.from_row(row, PROFILE_FIELDS)
+                profiles[profile.id] = profile
+                if user_cache is not None:
+                    user_cache.set(User._cache_key(profile.id), list(row))
+        return profiles
+
+    @staticmethod
+    def _cache_key(user_id):
+        # В кэше лежат строки PROFILE_FIELDS. При изменении проекции нужно менять и пространство ключей,
+        # чтобы общий кэш (Redis) не отдавал строки старого формата.
+        return f"{current_app.config['USER_TABLE_NAME']}:profile:{user_id}"
+
+    @staticmethod
+    def invalidate_cache(user_id):
+        """Метод принимает user_id пользователя и удаляет его данные из кэша пользователей.
+        Должен вызываться после любого изменения строки пользователя в БД"""
+        user_cache = current_app.config.get('USER_CACHE')
+        if user_cache is not None:
+            user_cache.delete(User._cache_key(user_id))
 
     @staticmethod
     def encode_auth_token(user_id):
@@ -102,16 +258,19 @@ class User:
         Возвращает его jwt токен"""
         if isinstance(user_id, int):
             try:
-                payload = {
-                    'exp': datetime.utcnow() + timedelta(days=0, seconds=5),
-                    'iat': datetime.utcnow(),
-                    'sub': user_id
-                }
-                return jwt.encode(
-                    payload,
-                    current_app.config.get('SECRET_KEY'),
-                    algorithm='HS256'
-                )
+                return _encode_auth_token(current_app.config, user_id)
+            except Exception as e:
+                print(e)
+        else:
+            print('id пользователя должен иметь тип int.')
+
+    @staticmethod
+    def encode_refresh_token(user_id):
+        """Метод принимает user_id - id пользователя.
+        Возвращает долгоживущий refresh токен, по которому выдаются новые access токены без пароля"""
+        if isinstance(user_id, int):
+            try:
+                return _encode_auth_token(current_app.config, user_id, token_type=REFRESH_TOKEN_TYPE)
             except Exception as e:
                 print(e)
         else:
@@ -123,50 +282,314 @@ class BlacklistToken:
 
     @staticmethod
     def save(token):
-        """Метод принимает token. Сохраняет его в БД"""
-        blacklist_token_table_name = sql.Identifier(current_app.config['BLACKLIST_TOKEN_TABLE_NAME'])
-        conn = get_conn_to_db()
-        cursor = conn.cursor()
+        """Метод принимает token. Сохраняет в БД его ключ отзыва и срок действия, сам токен не хранится"""
+        payload = _unverified_payload(token)
+        revocation_key = _revocation_key(token, payload)
         blacklisted_date = datetime.utcnow()
-        data = [token, blacklisted_date]
-        cursor.execute(sql.SQL("""INSERT INTO {blacklist_token_table_name} 
-                                  (token, blacklisted_date) 
-                                  VALUES(%s, %s);""").format(
-            blacklist_token_table_name=blacklist_token_table_name), data)
-        conn.commit()
-        cursor.close()
-        close_db_conn()
+        if 'exp' in payload:
+            expires_at = datetime.utcfromtimestamp(payload['exp'])
+        else:
+            expires_at = blacklisted_date + timedelta(seconds=current_app.config.get('AUTH_TOKEN_EXPIRATION_SECONDS'))
+        writer = current_app.config.get('REVOCATION_WRITER')
+        if writer is None or not writer.submit(revocation_key, expires_at):
+            get_storage().save_token(revocation_key, expires_at, blacklisted_date)
+        revocation_table = current_app.config.get('REVOCATION_TABLE')
+        if revocation_table is not None:
+            revocation_table.add(revocation_key, expires_at)
+        blacklist_filter = current_app.config.get('BLACKLIST_FILTER')
+        if blacklist_filter is not None:
+            blacklist_filter.add(revocation_key)
+        token_cache = current_app.config.get('TOKEN_CACHE')
+        if token_cache is not None:
+            token_cache.delete(_token_hash(token))
 
     @staticmethod
-    def is_token_in_blacklist(token):
+    def is_token_in_blacklist(token, primary=False):
         """Метод принимает token. Возвращает True, если токен находится в чёрном списке
-        и False в обратном случае."""
-        blacklist_token_table_name = sql.Identifier(current_app.config['BLACKLIST_TOKEN_TABLE_NAME'])
-        conn = get_conn_to_db()
-        cursor = conn.cursor()
-        data = [token]
-        cursor.execute(sql.SQL("""SELECT token FROM {blacklist_token_table_name}
-                                  WHERE token = %s;""").format(
-            blacklist_token_table_name=blacklist_token_table_name), data)
-        token = cursor.fetchone()
-        cursor.close()
-        close_db_conn()
-        return bool(token)
+        и False в обратном случае. Чтобы проверить только что отозванный токен, нужно передать primary=True"""
+        return BlacklistToken.is_token_hash_in_blacklist(_revocation_key(token, _unverified_payload(token)),
+                                                         primary=primary)
+
+    @staticmethod
+    def is_token_hash_in_blacklist(token_hash, primary=False):
+        """Метод принимает ключ отзыва токена. Возвращает True, если токен находится в чёрном списке
+        и False в обратном случае. Если фильтр Блума отвечает, что токена точно нет в чёрном списке,
+        запрос в БД не выполняется. Общая таблица отзывов хоста, если она включена, отвечает без БД и фильтра.
+        Отзывы этого процесса, которые ещё не записаны в БД, находятся в очереди отложенной записи."""
+        if BlacklistToken.is_revocation_pending(token_hash):
+            return True
+        if not primary:
+            is_blacklisted = BlacklistToken.lookup_revocation_table(token_hash)
+            if is_blacklisted is not None:
+                return is_blacklisted
+        blacklist_filter = current_app.config.get('BLACKLIST_FILTER')
+        if blacklist_filter is not None:
+            if blacklist_filter.needs_resync():
+                BlacklistToken.sync_filter()
+            if not blacklist_filter.might_contain(token_hash):
+                return False
+        is_blacklisted = get_storage().is_token_blacklisted(token_hash, primary=primary)
+        if blacklist_filter is not None:
+            blacklist_filter.record_db_result(is_blacklisted)
+        return is_blacklisted
+
+    @staticmethod
+    def get_blacklisted_token_hashes(token_hashes):
+        """Метод принимает список ключей отзыва токенов. Возвращает множество тех из них, которые находятся
+        в чёрном списке. Ключи, на которые не ответила таблица отзывов и которые не отсеял фильтр Блума,
+        проверяются в БД одним запросом"""
+        blacklisted = set()
+        writer = current_app.config.get('REVOCATION_WRITER')
+        if writer is not None:
+            blacklisted = {token_hash for token_hash in token_hashes if writer.is_pending(token_hash)}
+            token_hashes = [token_hash for token_hash in token_hashes if token_hash not in blacklisted]
+        if current_app.config.get('REVOCATION_TABLE') is not None:
+            unknown = []
+            for token_hash in token_hashes:
+                is_blacklisted = BlacklistToken.lookup_revocation_table(token_hash)
+                if is_blacklisted is None:
+                    unknown.append(token_hash)
+                elif is_blacklisted:
+                    blacklisted.add(token_hash)
+            token_hashes = unknown
+        blacklist_filter = current_app.config.get('BLACKLIST_FILTER')
+        if blacklist_filter is not None:
+            if blacklist_filter.needs_resync():
+                BlacklistToken.sync_filter()
+            token_hashes = [token_hash for token_hash in token_hashes if blacklist_filter.might_contain(token_hash)]
+        if not token_hashes:
+            return blacklisted
+        found = get_storage().get_blacklisted_token_hashes(token_hashes)
+        if blacklist_filter is not None:
+            for token_hash in token_hashes:
+                blacklist_filter.record_db_result(token_hash in found)
+        return blacklisted | found
+
+    @staticmethod
+    def get_token_hashes_since(since, now):
+        """Метод принимает две даты. Возвращает ключи отзыва ещё не истёкших к now токенов,
+        добавленных в чёрный список начиная с since."""
+        return get_storage().get_token_hashes_since(since, now)
+
+    @staticmethod
+    def purge_expired(now=None, batch_size=10000):
+        """Удаляет из чёрного списка токены, срок действия которых истёк, пачками по batch_size строк,
+        чтобы не держать долгих блокировок. Возвращает число удалённых строк."""
+        return get_storage().purge_expired_tokens(now or datetime.utcnow(), batch_size)
+
+    @staticmethod
+    def maintain_partitions(now=None):
+        """Создаёт будущие секции чёрного списка и удаляет секции, все токены в которых истекли.
+        Возвращает списки имён созданных и удалённых секций или None, если хранилище не секционирует чёрный список."""
+        return get_storage().maintain_token_partitions(now or datetime.utcnow())
+
+    @staticmethod
+    def create_filter(config):
+        """Возвращает пустой фильтр Блума чёрного списка по настройкам config или None, если фильтр выключен."""
+        if not config.get('BLACKLIST_FILTER_ENABLED'):
+            return None
+        return BlacklistFilter(capacity=config['BLACKLIST_FILTER_CAPACITY'],
+                               error_rate=config['BLACKLIST_FILTER_ERROR_RATE'],
+                               resync_interval=config['BLACKLIST_FILTER_RESYNC_INTERVAL'],
+                               rebuild_interval=config['BLACKLIST_FILTER_REBUILD_INTERVAL'])
+
+    @staticmethod
+    def init_filter():
+        """Создаёт фильтр Блума чёрного списка и прогревает его токенами, которые ещё не истекли."""
+        current_app.config['BLACKLIST_FILTER'] = BlacklistToken.create_filter(current_app.config)
+        BlacklistToken.sync_filter()
+
+    @staticmethod
+    def sync_filter():
+        """Догружает в фильтр Блума токены, отозванные другими процессами после прошлой синхронизации.
+        Периодически перестраивает фильтр целиком, чтобы из него уходили истёкшие токены."""
+        blacklist_filter = current_app.config.get('BLACKLIST_FILTER')
+        if blacklist_filter is None or not blacklist_filter.try_begin_sync():
+            return
+        try:
+            now = datetime.utcnow()
+            if blacklist_filter.needs_rebuild():
+                blacklist_filter.rebuild(BlacklistToken.get_token_hashes_since(datetime.min, now), now)
+            else:
+                # Перекрытие с прошлой синхронизацией покрывает транзакции, закоммиченные с опозданием.
+                since = blacklist_filter.synced_at - timedelta(seconds=blacklist_filter.resync_interval)
+                blacklist_filter.merge(BlacklistToken.get_token_hashes_since(since, now), now)
+        except Exception as e:
+            print(f'Возникло исключение {e} при синхронизации фильтра чёрного списка токенов.')
+        finally:
+            blacklist_filter.end_sync()
+
+    @staticmethod
+    def create_revocation_table(config):
+        """Открывает общую для процессов хоста таблицу отзывов по настройкам config
+        или возвращает None, если REVOCATION_TABLE_PATH не задан."""
+        if not config.get('REVOCATION_TABLE_PATH'):
+            return None
+        return RevocationTable(path=config['REVOCATION_TABLE_PATH'],
+                               capacity=config['REVOCATION_TABLE_CAPACITY'],
+                               resync_interval=config['REVOCATION_TABLE_RESYNC_INTERVAL'],
+                               rebuild_interval=config['REVOCATION_TABLE_REBUILD_INTERVAL'])
+
+    @staticmethod
+    def init_revocation_table():
+        """Открывает общую для процессов хоста таблицу отзывов, если задан REVOCATION_TABLE_PATH,
+        и догружает в неё из БД отзывы с момента последней синхронизации."""
+        current_app.config['REVOCATION_TABLE'] = BlacklistToken.create_revocation_table(current_app.config)
+        BlacklistToken.sync_revocation_table()
+
+    @staticmethod
+    def sync_revocation_table():
+        """Догружает в таблицу отзывов токены, отозванные на других хостах. Синхронизацию выполняет
+        один процесс хоста, остальные видят её результат через общий файл."""
+        revocation_table = current_app.config.get('REVOCATION_TABLE')
+        if revocation_table is None or not revocation_table.try_begin_sync():
+            return
+        try:
+            now = datetime.utcnow()
+            if revocation_table.needs_rebuild():
+                revocation_table.rebuild(get_storage().get_revoked_tokens_since(datetime.min, now), now)
+                # Перестроение из БД не знает об отзывах этого процесса, которые ещё ждут записи.
+                writer = current_app.config.get('REVOCATION_WRITER')
+                if writer is not None:
+                    for token_hash, expires_at in writer.pending_entries():
+                        revocation_table.add(token_hash, expires_at)
+            elif revocation_table.needs_resync():
+                since = revocation_table.synced_at - timedelta(seconds=revocation_table.resync_interval)
+                revocation_table.merge(get_storage().get_revoked_tokens_since(since, now), now)
+        except Exception as e:
+            print(f'Возникло исключение {e} при синхронизации таблицы отзывов.')
+        finally:
+            revocation_table.end_sync()
+
+    @staticmethod
+    def lookup_revocation_table(token_hash):
+        """Возвращает ответ таблицы отзывов хоста: True или False, или None, если таблица выключена
+        или сейчас не может ответить."""
+        revocation_table = current_app.config.get('REVOCATION_TABLE')
+        if revocation_table is None:
+            return None
+        if revocation_table.needs_resync():
+            BlacklistToken.sync_revocation_table()
+        return revocation_table.lookup(token_hash)
+
+    @staticmethod
+    def is_revocation_pending(token_hash):
+        """Возвращает True, если отзыв токена ждёт отложенной записи в БД в этом процессе."""
+        writer = current_app.config.get('REVOCATION_WRITER')
+        return writer is not None and writer.is_pending(token_hash)
+
+    @staticmethod
+    def filter_stats():
+        """Возвращает статистику фильтра Блума чёрного списка или None, если фильтр выключен."""
+        blacklist_filter = current_app.config.get('BLACKLIST_FILTER')
+        return blacklist_filter.stats() if blacklist_filter is not None else None
+
+
+def init_token_cache(config=None):
+    """Создаёт кэш проверенных токенов, если в настройках задан TOKEN_CACHE_SIZE больше нуля.
+    Кэш всегда локальный для процесса, так как BlacklistToken.save вытесняет из него токены сразу."""
+    config = current_app.config if config is None else config
+    maxsize = config.get('TOKEN_CACHE_SIZE')
+    if maxsize:
+        config['TOKEN_CACHE'] = LRUCache(maxsize=maxsize, ttl=config['TOKEN_CACHE_TTL'])
+
+
+def init_user_cache(config=None):
+    """Создаёт кэш пользователей с хранилищем из USER_CACHE_BACKEND, если задан USER_CACHE_SIZE больше нуля."""
+    config = current_app.config if config is None else config
+    maxsize = config.get('USER_CACHE_SIZE')
+    if maxsize:
+        backend = import_string(config['USER_CACHE_BACKEND'])
+        config['USER_CACHE'] = backend(maxsize=maxsize, ttl=config['USER_CACHE_TTL'],
+                                       **config.get('USER_CACHE_OPTIONS', {}))
 
 
 def decode_auth_token(token):
     """
     Проверяет токен и возвращает субъект токена (id пользователя), если он действительный и не находится в чёрном
     списке. Иначе возвращает сообщения о том, что токен в чёрном списке, либо просроченный, либо неверный.
+    Субъекты недавно проверенных токенов берутся из кэша без повторной проверки подписи и чёрного списка,
+    сверяется только таблица отзывов хоста, чтобы logout в другом процессе был виден сразу.
     """
+    token_hash = _token_hash(token)
+    token_cache = current_app.config.get('TOKEN_CACHE')
+    if token_cache is not None:
+        cached = token_cache.get(token_hash)
+        if cached is not None:
+            subject, revocation_key = cached
+            if BlacklistToken.lookup_revocation_table(revocation_key):
+                return 'Token blacklisted. Please log in again.'
+            return subject
     try:
-        payload = jwt.decode(token, key=current_app.config.get('SECRET_KEY'), algorithms="HS256")
-        is_blacklisted_token = BlacklistToken.is_token_in_blacklist(token)
+        payload = _decode_auth_token(current_app.config, token)
+        revocation_key = _revocation_key(token, payload)
+        is_blacklisted_token = BlacklistToken.is_token_hash_in_blacklist(revocation_key)
         if is_blacklisted_token:
             return 'Token blacklisted. Please log in again.'
         else:
+            if token_cache is not None:
+                token_cache.set(token_hash, (payload['sub'], revocation_key), ttl=payload['exp'] - time.time())
             return payload['sub']
     except jwt.ExpiredSignatureError:
         return 'Signature expired. Please log in again.'
     except jwt.InvalidTokenError:
         return 'Invalid token. Please log in again.'
+
+
+def decode_refresh_token(token):
+    """
+    Проверяет refresh токен и возвращает его субъект (id пользователя), если он действительный и не отозван.
+    Иначе возвращает те же сообщения об ошибке, что и decode_auth_token. Refresh токены не кэшируются,
+    чтобы кэш проверенных токенов никогда не принял refresh токен за access токен.
+    """
+    try:
+        payload = _decode_auth_token(current_app.config, token, token_type=REFRESH_TOKEN_TYPE)
+        # Отзыв refresh токена проверяется на основной БД, чтобы токен нельзя было использовать,
+        # пока отзыв ещё не дошёл до реплик.
+        if BlacklistToken.is_token_hash_in_blacklist(_revocation_key(token, payload), primary=True):
+            return 'Token blacklisted. Please log in again.'
+        return payload['sub']
+    except jwt.ExpiredSignatureError:
+        return 'Signature expired. Please log in again.'
+    except jwt.InvalidTokenError:
+        return 'Invalid token. Please log in again.'
+
+
+def decode_auth_tokens(tokens):
+    """
+    Пакетный вариант decode_auth_token: принимает список токенов и возвращает список той же длины с субъектом
+    токена или сообщением об ошибке для каждого токена. Чёрный список проверяется одним запросом на все токены.
+    """
+    token_cache = current_app.config.get('TOKEN_CACHE')
+    results = [None] * len(tokens)
+    verified = []
+    for index, token in enumerate(tokens):
+        if not isinstance(token, str) or not token:
+            results[index] = 'Invalid token. Please log in again.'
+            continue
+        token_hash = _token_hash(token)
+        cached = token_cache.get(token_hash) if token_cache is not None else None
+        if cached is not None:
+            subject, revocation_key = cached
+            if BlacklistToken.lookup_revocation_table(revocation_key):
+                results[index] = 'Token blacklisted. Please log in again.'
+            else:
+                results[index] = subject
+            continue
+        try:
+            payload = _decode_auth_token(current_app.config, token)
+        except jwt.ExpiredSignatureError:
+            results[index] = 'Signature expired. Please log in again.'
+        except jwt.InvalidTokenError:
+            results[index] = 'Invalid token. Please log in again.'
+        else:
+            verified.append((index, token_hash, _revocation_key(token, payload), payload))
+    blacklisted = BlacklistToken.get_blacklisted_token_hashes([item[2] for item in verified])
+    for index, token_hash, revocation_key, payload in verified:
+        if revocation_key in blacklisted:
+            results[index] = 'Token blacklisted. Please log in again.'
+        else:
+            if token_cache is not None:
+                token_cache.set(token_hash, (payload['sub'], revocation_key), ttl=payload['exp'] - time.time())
+            results[index] = payload['sub']
+    return results
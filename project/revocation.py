@@ -0,0 +1,252 @@
+import calendar
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+MAGIC = b'FAREVOC1'
+# Заголовок: magic, ёмкость, состояние, поколение, число записей, время синхронизации и перестроения.
+HEADER = struct.Struct('<8sIIQQdd')
+STATE = struct.Struct('<I')
+GENERATION = struct.Struct('<Q')
+STATE_OFFSET = 12
+GENERATION_OFFSET = 16
+HEADER_SIZE = 64
+# Слот: срок действия токена в секундах unix time (0 - слот пуст) и SHA-256 ключа отзыва.
+SLOT = struct.Struct('<q32s')
+MAX_PROBES = 32
+
+NOT_READY = 0
+READY = 1
+OVERFLOW = 2
+
+_WRITE_LOCK_BYTE = 0
+_SYNC_LOCK_BYTE = 1
+_ZEROS = bytes(1 << 20)
+
+
+def to_unix_time(value):
+    """Переводит datetime в секунды unix time. Наивные даты считаются датами в UTC."""
+    if value.tzinfo is None:
+        return calendar.timegm(value.utctimetuple())
+    return int(value.timestamp())
+
+
+class RevocationTable:
+    """Хеш-таблица отозванных токенов фиксированного размера в файле, отображённом в память.
+
+    Все процессы приложения на одном хосте открывают один файл и видят отзыв токена, записанный любым из них,
+    без запроса к БД. Таблица открытой адресации с линейным пробированием: поиск читает не больше MAX_PROBES
+    слотов и не берёт блокировок, запись и перестроение идут под блокировкой файла.
+
+    Пока таблица не построена из БД, перестраивается или переполнена, lookup возвращает None и проверка
+    идёт обычным путём через фильтр Блума и БД. Слоты истёкших токенов переиспользуются, а периодическое
+    перестроение очищает таблицу от них полностью. БД остаётся источником истины: при перезапуске таблица
+    догружает из неё отзывы с момента последней синхронизации.
+    """
+
+    def __init__(self, path, capacity, resync_interval, rebuild_interval):
+        self.path = path
+        self.capacity = capacity
+        self.resync_interval = resync_interval
+        self.rebuild_interval = rebuild_interval
+        self.size = HEADER_SIZE + capacity * SLOT.size
+        self.lookups = 0
+        self.positives = 0
+        self.fallbacks = 0
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        # Блокировки держатся на отдельном файле, который не подменяется при пересоздании таблицы.
+        self._lock_fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        with self._write_lock():
+            if not self._is_valid_file():
+                self._create_file()
+            fd = os.open(path, os.O_RDWR)
+            try:
+                self._mm = mmap.mmap(fd, self.size)
+            finally:
+                os.close(fd)
+
+    def _is_valid_file(self):
+        try:
+            with open(self.path, 'rb') as f:
+                header = f.read(HEADER.size)
+                f.seek(0, os.SEEK_END)
+                file_size = f.tell()
+        except FileNotFoundError:
+            return False
+        return (file_size == self.size and len(header) == HEADER.size
+                and HEADER.unpack(header)[:2] == (MAGIC, self.capacity))
+
+    def _create_file(self):
+        # Файл разрежённый, и страницы занимают место, только когда перестроение их заполняет. На tmpfs
+        # (/dev/shm) запись за пределами свободного места убивает процесс SIGBUS, поэтому место проверяется заранее.
+        stat = os.statvfs(os.path.dirname(os.path.abspath(self.path)))
+        free = stat.f_bavail * stat.f_frsize
+        if free < self.size:
+            raise RuntimeError(f'Для таблицы отзывов {self.path} нужно {self.size} байт, а свободно {free}. '
+                               f'Уменьшите REVOCATION_TABLE_CAPACITY или увеличьте раздел (shm_size в docker).')
+        # Новый файл подменяет старый атомарно: процессы, которые ещё держат старый, не получат SIGBUS.
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, self.size)
+            os.pwrite(fd, HEADER.pack(MAGIC, self.capacity, NOT_READY, 0, 0, 0.0, 0.0), 0)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, self.path)
+
+    @contextmanager
+    def _write_lock(self):
+        with self._lock:
+            fcntl.lockf(self._lock_fd, fcntl.LOCK_EX, 1, _WRITE_LOCK_BYTE)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._lock_fd, fcntl.LOCK_UN, 1, _WRITE_LOCK_BYTE)
+
+    def _header(self):
+        return HEADER.unpack_from(self._mm, 0)
+
+    def _write_header(self, state, generation, count, synced_at, rebuilt_at):
+        HEADER.pack_into(self._mm, 0, MAGIC, self.capacity, state, generation, count, synced_at, rebuilt_at)
+
+    def _home(self, digest):
+        return int.from_bytes(digest[:8], 'little') % self.capacity
+
+    def lookup(self, digest, now=None):
+        """Возвращает True, если токен отозван и ещё не истёк, False, если нет, и None, если таблица
+        сейчас не может ответить. Не берёт блокировок: перестроение меняет поколение в заголовке,
+        и поиск, пересёкшийся с ним, отвечает None."""
+        mm = self._mm
+        self.lookups += 1
+        generation = GENERATION.unpack_from(mm, GENERATION_OFFSET)[0]
+        if generation & 1 or STATE.unpack_from(mm, STATE_OFFSET)[0] != READY:
+            self.fallbacks += 1
+            return None
+        now = time.time() if now is None else now
+        found = False
+        index = self._home(digest)
+        for _ in range(MAX_PROBES):
+            expires_at, slot_digest = SLOT.unpack_from(mm, HEADER_SIZE + index * SLOT.size)
+            if expires_at == 0:
+                break
+            if slot_digest == digest:
+                found = expires_at > now
+                break
+            index = index + 1 if index + 1 < self.capacity else 0
+        if GENERATION.unpack_from(mm, GENERATION_OFFSET)[0] != generation:
+            self.fallbacks += 1
+            return None
+        if found:
+            self.positives += 1
+        return found
+
+    def _insert(self, digest, expires_at, now):
+        """Записывает ключ в таблицу. Возвращает 1 для новой записи, 0 для уже известного ключа
+        и None, если в пределах MAX_PROBES нет свободного слота."""
+        mm = self._mm
+        target = None
+        index = self._home(digest)
+        for _ in range(MAX_PROBES):
+            offset = HEADER_SIZE + index * SLOT.size
+            slot_expires_at, slot_digest = SLOT.unpack_from(mm, offset)
+            if slot_expires_at == 0:
+                if target is None:
+                    target = offset
+                break
+            if slot_digest == digest:
+                if expires_at > slot_expires_at:
+                    struct.pack_into('<q', mm, offset, expires_at)
+                return 0
+            if target is None and slot_expires_at <= now:
+                target = offset
+            index = index + 1 if index + 1 < self.capacity else 0
+        if target is None:
+            return None
+        # Сначала ключ, потом срок действия: читатель не увидит живой срок с чужим ключом.
+        mm[target + 8:target + SLOT.size] = digest
+        struct.pack_into('<q', mm, target, expires_at)
+        return 1
+
+    def add(self, digest, expires_at):
+        """Добавляет отозванный токен. expires_at - datetime окончания срока действия токена."""
+        with self._write_lock():
+            self._add_locked([(digest, expires_at)])
+
+    def _add_locked(self, entries):
+        state, generation, count, synced_at, rebuilt_at = self._header()[2:]
+        now = time.time()
+        for digest, expires_at in entries:
+            inserted = self._insert(bytes(digest), to_unix_time(expires_at), now)
+            if inserted is None:
+                state = OVERFLOW
+            else:
+                count += inserted
+        self._write_header(state, generation, count, synced_at, rebuilt_at)
+
+    @property
+    def synced_at(self):
+        return datetime.utcfromtimestamp(self._header()[5])
+
+    def needs_resync(self):
+        return time.time() - self._header()[5] >= self.resync_interval
+
+    def needs_rebuild(self):
+        # Переполненная таблица перестраивается по расписанию: сразу это не поможет, пока токены не истекут.
+        header = self._header()
+        return header[2] == NOT_READY or time.time() - header[6] >= self.rebuild_interval
+
+    def try_begin_sync(self):
+        """Захватывает право на синхронизацию без ожидания, чтобы её выполнял только один поток одного процесса."""
+        if not self._sync_lock.acquire(blocking=False):
+            return False
+        try:
+            fcntl.lockf(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, _SYNC_LOCK_BYTE)
+        except OSError:
+            self._sync_lock.release()
+            return False
+        return True
+
+    def end_sync(self):
+        fcntl.lockf(self._lock_fd, fcntl.LOCK_UN, 1, _SYNC_LOCK_BYTE)
+        self._sync_lock.release()
+
+    def rebuild(self, entries, synced_at):
+        """Заполняет таблицу заново парами (ключ отзыва, срок действия), полученными из БД на момент synced_at."""
+        with self._write_lock():
+            generation = self._header()[3] + 1
+            self._write_header(NOT_READY, generation, 0, 0.0, 0.0)
+            mm = self._mm
+            for offset in range(HEADER_SIZE, self.size, len(_ZEROS)):
+                end = min(offset + len(_ZEROS), self.size)
+                mm[offset:end] = _ZEROS[:end - offset]
+            now = time.time()
+            self._write_header(READY, generation, 0, to_unix_time(synced_at), now)
+            self._add_locked(entries)
+            state, _, count, synced, rebuilt = self._header()[2:]
+            self._write_header(state, generation + 1, count, synced, rebuilt)
+
+    def merge(self, entries, synced_at):
+        """Добавляет отзывы, записанные в БД после предыдущей синхронизации."""
+        with self._write_lock():
+            self._add_locked(entries)
+            state, generation, count, _, rebuilt_at = self._header()[2:]
+            self._write_header(state, generation, count, to_unix_time(synced_at), rebuilt_at)
+
+    def stats(self):
+        state, _, count = self._header()[2:5]
+        return {
+            'ready': state == READY,
+            'overflow': state == OVERFLOW,
+            'items': count,
+            'capacity': self.capacity,
+            'memory_bytes': self.size,
+            'lookups': self.lookups,
+            'positives': self.positives,
+            'fallbacks': self.fallbacks,
+        }
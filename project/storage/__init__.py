@@ -0,0 +1,110 @@
+from flask import current_app
+from werkzeug.utils import import_string
+
+POSTGRES_BACKEND = 'project.storage.postgres.PostgresStorage'
+
+
+class Storage:
+    """Хранилище пользователей и отозванных токенов, через которое работают User и BlacklistToken.
+
+    Пользователь читается проекциями: профиль - кортеж (id, email, is_admin, registration_date, version),
+    данные для входа - кортеж (id, password). Ключ отзыва токена - bytes, даты - наивные datetime в UTC.
+    Параметр primary методов чтения требует читать с основной БД, а не с реплики; хранилища без реплик его игнорируют.
+    """
+
+    name = None
+
+    def ensure_schema(self, mode):
+        """Проверяет схему при запуске приложения по режиму SCHEMA_CHECK_ON_STARTUP.
+        Возвращает версию схемы или None, если проверка не выполнялась."""
+        raise NotImplementedError
+
+    def init_schema(self):
+        """Создаёт хранилище и применяет недостающие миграции (команда init-db). Возвращает версию схемы или None."""
+        raise NotImplementedError
+
+    def delete_test_data(self):
+        """Удаляет данные тестовых таблиц."""
+        raise NotImplementedError
+
+    def create_user(self, email, password, registration_date):
+        """Атомарно сохраняет пользователя. Возвращает его профиль или None, если email уже занят."""
+        raise NotImplementedError
+
+    def get_user_id_by_email(self, email, primary=False):
+        """Возвращает кортеж (id,) пользователя или None."""
+        raise NotImplementedError
+
+    def get_user_credentials_by_email(self, email, primary=False):
+        """Возвращает кортеж (id, password) пользователя или None."""
+        raise NotImplementedError
+
+    def get_user_profile_by_id(self, user_id, primary=False):
+        """Возвращает профиль пользователя или None."""
+        raise NotImplementedError
+
+    def get_user_version(self, user_id, primary=False):
+        """Возвращает версию строки пользователя или None. Версия растёт при каждом изменении строки."""
+        raise NotImplementedError
+
+    def get_user_profiles_by_ids(self, user_ids):
+        """Возвращает список профилей найденных пользователей."""
+        raise NotImplementedError
+
+    def get_user_profiles_page(self, after_id, limit):
+        """Возвращает не больше limit профилей с id больше after_id по возрастанию id."""
+        raise NotImplementedError
+
+    def iter_user_profiles(self, after_id, batch_size):
+        """Возвращает итератор по профилям с id больше after_id по возрастанию id. Профили читаются
+        из БД по batch_size строк, поэтому память не зависит от числа пользователей."""
+        raise NotImplementedError
+
+    def set_user_admin(self, email, is_admin):
+        """Меняет права администратора пользователя. Возвращает id пользователя или None, если его нет."""
+        raise NotImplementedError
+
+    def save_token(self, token_hash, expires_at, blacklisted_date):
+        """Добавляет ключ отзыва токена в чёрный список."""
+        raise NotImplementedError
+
+    def save_tokens(self, rows):
+        """Добавляет в чёрный список строки (ключ отзыва, срок действия, дата отзыва) в одной транзакции."""
+        raise NotImplementedError
+
+    def is_token_blacklisted(self, token_hash, primary=False):
+        """Возвращает True, если ключ отзыва есть в чёрном списке."""
+        raise NotImplementedError
+
+    def get_blacklisted_token_hashes(self, token_hashes):
+        """Возвращает множество ключей отзыва из token_hashes, которые есть в чёрном списке."""
+        raise NotImplementedError
+
+    def get_token_hashes_since(self, since, now):
+        """Возвращает ключи отзыва ещё не истёкших к now токенов, добавленных в чёрный список начиная с since."""
+        raise NotImplementedError
+
+    def get_revoked_tokens_since(self, since, now):
+        """То же, что get_token_hashes_since, но возвращает пары (ключ отзыва, срок действия токена)."""
+        raise NotImplementedError
+
+    def maintain_token_partitions(self, now):
+        """Создаёт будущие секции чёрного списка и удаляет истёкшие. Возвращает списки имён созданных
+        и удалённых секций или None, если хранилище не секционирует чёрный список."""
+        return None
+
+    def purge_expired_tokens(self, now, batch_size):
+        """Удаляет из чёрного списка истёкшие к now токены пачками по batch_size. Возвращает число удалённых."""
+        raise NotImplementedError
+
+
+def init_storage(config=None):
+    """Создаёт хранилище STORAGE_BACKEND с параметрами STORAGE_OPTIONS и кладёт его в config['STORAGE']."""
+    config = current_app.config if config is None else config
+    backend = import_string(config['STORAGE_BACKEND'])
+    config['STORAGE'] = backend(**config.get('STORAGE_OPTIONS', {}))
+    return config['STORAGE']
+
+
+def get_storage():
+    return current_app.config['STORAGE']
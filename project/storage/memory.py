@@ -0,0 +1,119 @@
+import threading
+
+from project.storage import Storage
+
+
+class MemoryStorage(Storage):
+    """Хранилище в памяти процесса. Данные не переживают перезапуск и не видны другим процессам,
+    поэтому подходит для тестов и запуска в одном процессе без сервера БД."""
+
+    name = 'memory'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}
+        self._user_ids_by_email = {}
+        self._tokens = {}
+        self._next_user_id = 1
+
+    def ensure_schema(self, mode):
+        return None
+
+    def init_schema(self):
+        return None
+
+    def delete_test_data(self):
+        with self._lock:
+            self._users.clear()
+            self._user_ids_by_email.clear()
+            self._tokens.clear()
+
+    def create_user(self, email, password, registration_date):
+        with self._lock:
+            if email in self._user_ids_by_email:
+                return None
+            user_id = self._next_user_id
+            self._next_user_id += 1
+            self._users[user_id] = (user_id, email, password, False, registration_date, 1)
+            self._user_ids_by_email[email] = user_id
+            return self._profile(user_id)
+
+    def get_user_id_by_email(self, email, primary=False):
+        user_id = self._user_ids_by_email.get(email)
+        return (user_id,) if user_id is not None else None
+
+    def _profile(self, user_id):
+        user_data = self._users.get(user_id)
+        if user_data is None:
+            return None
+        return user_data[0], user_data[1], user_data[3], user_data[4], user_data[5]
+
+    def get_user_credentials_by_email(self, email, primary=False):
+        user_data = self._users.get(self._user_ids_by_email.get(email))
+        return (user_data[0], user_data[2]) if user_data is not None else None
+
+    def get_user_profile_by_id(self, user_id, primary=False):
+        return self._profile(user_id)
+
+    def get_user_version(self, user_id, primary=False):
+        user_data = self._users.get(user_id)
+        return user_data[5] if user_data is not None else None
+
+    def get_user_profiles_by_ids(self, user_ids):
+        return [self._profile(user_id) for user_id in set(user_ids) if user_id in self._users]
+
+    def get_user_profiles_page(self, after_id, limit):
+        with self._lock:
+            user_ids = sorted(user_id for user_id in self._users if user_id > after_id)[:limit]
+            return [self._profile(user_id) for user_id in user_ids]
+
+    def iter_user_profiles(self, after_id, batch_size):
+        while True:
+            profiles = self.get_user_profiles_page(after_id, batch_size)
+            yield from profiles
+            if len(profiles) < batch_size:
+                return
+            after_id = profiles[-1][0]
+
+    def set_user_admin(self, email, is_admin):
+        with self._lock:
+            user_id = self._user_ids_by_email.get(email)
+            if user_id is None:
+                return None
+            user_id, email, password, old_is_admin, registration_date, version = self._users[user_id]
+            if old_is_admin != is_admin:
+                self._users[user_id] = (user_id, email, password, is_admin, registration_date, version + 1)
+            return user_id
+
+    def save_token(self, token_hash, expires_at, blacklisted_date):
+        with self._lock:
+            self._tokens[bytes(token_hash)] = (expires_at, blacklisted_date)
+
+    def save_tokens(self, rows):
+        with self._lock:
+            for token_hash, expires_at, blacklisted_date in rows:
+                self._tokens[bytes(token_hash)] = (expires_at, blacklisted_date)
+
+    def is_token_blacklisted(self, token_hash, primary=False):
+        return bytes(token_hash) in self._tokens
+
+    def get_blacklisted_token_hashes(self, token_hashes):
+        tokens = self._tokens
+        return {bytes(token_hash) for token_hash in token_hashes if bytes(token_hash) in tokens}
+
+    def get_token_hashes_since(self, since, now):
+        with self._lock:
+            return [token_hash for token_hash, (expires_at, blacklisted_date) in self._tokens.items()
+                    if blacklisted_date >= since and expires_at > now]
+
+    def get_revoked_tokens_since(self, since, now):
+        with self._lock:
+            return [(token_hash, expires_at) for token_hash, (expires_at, blacklisted_date) in self._tokens.items()
+                    if blacklisted_date >= since and expires_at > now]
+
+    def purge_expired_tokens(self, now, batch_size):
+        with self._lock:
+            expired = [token_hash for token_hash, (expires_at, _) in self._tokens.items() if expires_at <= now]
+            for token_hash in expired:
+                del self._tokens[token_hash]
+        return len(expired)
@@ -0,0 +1,180 @@
+from project.db import get_conn_to_db, close_db_conn, create_data_base, delete_test_tables, execute_statement, \
+    get_statement, register_statement
+from project.migrations import apply_migrations, ensure_schema, maintain_blacklist_partitions
+from project.storage import Storage
+
+PROFILE_COLUMNS = 'id, email, is_admin, registration_date, version'
+
+register_statement('create_user', f"""INSERT INTO {{user_table}}
+                                      (email, password, registration_date)
+                                      VALUES(%s, %s, %s)
+                                      ON CONFLICT (email) DO NOTHING
+                                      RETURNING {PROFILE_COLUMNS};""")
+register_statement('user_id_by_email', """SELECT id FROM {user_table} WHERE email = %s;""")
+register_statement('user_credentials_by_email', """SELECT id, password FROM {user_table} WHERE email = %s;""")
+register_statement('user_profile_by_id', f"""SELECT {PROFILE_COLUMNS} FROM {{user_table}} WHERE id = %s;""")
+register_statement('user_version_by_id', """SELECT version FROM {user_table} WHERE id = %s;""")
+register_statement('user_profiles_by_ids', f"""SELECT {PROFILE_COLUMNS} FROM {{user_table}}
+                                               WHERE id = ANY(%s);""")
+register_statement('user_profiles_page', f"""SELECT {PROFILE_COLUMNS} FROM {{user_table}}
+                                             WHERE id > %s ORDER BY id LIMIT %s;""")
+register_statement('user_profiles_export', f"""SELECT {PROFILE_COLUMNS} FROM {{user_table}}
+                                               WHERE id > %s ORDER BY id;""")
+register_statement('set_user_admin', """UPDATE {user_table} SET is_admin = %s WHERE email = %s RETURNING id;""")
+register_statement('save_token', """INSERT INTO {blacklist_token_table}
+                                    (token_hash, expires_at, blacklisted_date)
+                                    VALUES(%s, %s, %s);""")
+# Пачка отзывов вставляется одним запросом с постоянным текстом, поэтому его тоже можно подготовить.
+register_statement('save_tokens', """INSERT INTO {blacklist_token_table}
+                                     (token_hash, expires_at, blacklisted_date)
+                                     SELECT * FROM unnest(%s::bytea[], %s::timestamptz[], %s::timestamptz[]);""")
+register_statement('is_token_blacklisted', """SELECT 1 FROM {blacklist_token_table} WHERE token_hash = %s;""")
+register_statement('blacklisted_token_hashes', """SELECT token_hash FROM {blacklist_token_table}
+                                                  WHERE token_hash = ANY(%s);""")
+register_statement('token_hashes_since', """SELECT token_hash FROM {blacklist_token_table}
+                                            WHERE blacklisted_date >= %s AND expires_at > %s;""")
+register_statement('revoked_tokens_since', """SELECT token_hash, expires_at FROM {blacklist_token_table}
+                                              WHERE blacklisted_date >= %s AND expires_at > %s;""")
+register_statement('purge_expired_tokens', """DELETE FROM {blacklist_token_table}
+                                              WHERE id IN (SELECT id FROM {blacklist_token_table}
+                                                           WHERE expires_at <= %s LIMIT %s);""")
+
+
+class PostgresStorage(Storage):
+    """Хранилище в PostgreSQL через пул соединений project.db. Чтения без primary идут на реплики DB_REPLICAS."""
+
+    name = 'postgres'
+
+    def ensure_schema(self, mode):
+        return ensure_schema(mode)
+
+    def init_schema(self):
+        create_data_base()
+        version = apply_migrations()
+        maintain_blacklist_partitions()
+        return version
+
+    def delete_test_data(self):
+        delete_test_tables()
+
+    @staticmethod
+    def _fetchone(name, data, readonly=False):
+        conn = get_conn_to_db(readonly=readonly)
+        cursor = conn.cursor()
+        execute_statement(cursor, name, data)
+        row = cursor.fetchone()
+        cursor.close()
+        close_db_conn()
+        return row
+
+    @staticmethod
+    def _fetchall(name, data, readonly=False):
+        conn = get_conn_to_db(readonly=readonly)
+        cursor = conn.cursor()
+        execute_statement(cursor, name, data)
+        rows = cursor.fetchall()
+        cursor.close()
+        close_db_conn()
+        return rows
+
+    def create_user(self, email, password, registration_date):
+        conn = get_conn_to_db()
+        cursor = conn.cursor()
+        execute_statement(cursor, 'create_user', [email, password, registration_date])
+        user_data = cursor.fetchone()
+        conn.commit()
+        cursor.close()
+        close_db_conn()
+        return user_data
+
+    def get_user_id_by_email(self, email, primary=False):
+        return self._fetchone('user_id_by_email', [email], readonly=not primary)
+
+    def get_user_credentials_by_email(self, email, primary=False):
+        return self._fetchone('user_credentials_by_email', [email], readonly=not primary)
+
+    def get_user_profile_by_id(self, user_id, primary=False):
+        return self._fetchone('user_profile_by_id', [user_id], readonly=not primary)
+
+    def get_user_version(self, user_id, primary=False):
+        row = self._fetchone('user_version_by_id', [user_id], readonly=not primary)
+        return row[0] if row else None
+
+    def get_user_profiles_by_ids(self, user_ids):
+        return self._fetchall('user_profiles_by_ids', [list(user_ids)], readonly=True)
+
+    def get_user_profiles_page(self, after_id, limit):
+        return self._fetchall('user_profiles_page', [after_id, limit], readonly=True)
+
+    def iter_user_profiles(self, after_id, batch_size):
+        conn = get_conn_to_db(readonly=True)
+        # Именованный курсор держит результат на сервере и отдаёт его по itersize строк. DECLARE не работает
+        # с EXECUTE, поэтому запрос выполняется текстом, без prepared statement.
+        cursor = conn.cursor(name='user_profiles_export')
+        cursor.itersize = batch_size
+        try:
+            cursor.execute(get_statement('user_profiles_export').text, [after_id])
+            yield from cursor
+        finally:
+            cursor.close()
+            close_db_conn()
+
+    def set_user_admin(self, email, is_admin):
+        conn = get_conn_to_db()
+        cursor = conn.cursor()
+        execute_statement(cursor, 'set_user_admin', [is_admin, email])
+        row = cursor.fetchone()
+        conn.commit()
+        cursor.close()
+        close_db_conn()
+        return row[0] if row else None
+
+    def save_token(self, token_hash, expires_at, blacklisted_date):
+        conn = get_conn_to_db()
+        cursor = conn.cursor()
+        execute_statement(cursor, 'save_token', [token_hash, expires_at, blacklisted_date])
+        conn.commit()
+        cursor.close()
+        close_db_conn()
+
+    def save_tokens(self, rows):
+        token_hashes, expires_at, blacklisted_dates = zip(*rows)
+        conn = get_conn_to_db()
+        try:
+            cursor = conn.cursor()
+            execute_statement(cursor, 'save_tokens', [list(token_hashes), list(expires_at), list(blacklisted_dates)])
+            conn.commit()
+            cursor.close()
+        finally:
+            # Пул откатывает незавершённую транзакцию, а закрытое соединение выбрасывает.
+            close_db_conn()
+
+    def is_token_blacklisted(self, token_hash, primary=False):
+        return bool(self._fetchone('is_token_blacklisted', [token_hash], readonly=not primary))
+
+    def get_blacklisted_token_hashes(self, token_hashes):
+        return {bytes(row[0]) for row in self._fetchall('blacklisted_token_hashes', [list(token_hashes)],
+                                                        readonly=True)}
+
+    def get_token_hashes_since(self, since, now):
+        return [bytes(row[0]) for row in self._fetchall('token_hashes_since', [since, now])]
+
+    def get_revoked_tokens_since(self, since, now):
+        return [(bytes(row[0]), row[1]) for row in self._fetchall('revoked_tokens_since', [since, now])]
+
+    def maintain_token_partitions(self, now):
+        return maintain_blacklist_partitions(now)
+
+    def purge_expired_tokens(self, now, batch_size):
+        conn = get_conn_to_db()
+        cursor = conn.cursor()
+        deleted = 0
+        while True:
+            execute_statement(cursor, 'purge_expired_tokens', [now, batch_size])
+            conn.commit()
+            deleted += cursor.rowcount
+            if cursor.rowcount < batch_size:
+                break
+        cursor.close()
+        close_db_conn()
+        return deleted
@@ -0,0 +1,283 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+from flask import current_app
+
+from project.db import quote_ident
+from project.metrics import timed
+from project.migrations import SCHEMA_CHECK_MODES, SchemaOutdated
+from project.storage import Storage
+
+PROFILE_COLUMNS = 'id, email, is_admin, registration_date, version'
+
+
+def _to_text(value):
+    """Даты хранятся текстом одинаковой длины, поэтому сравниваются в SQL как строки."""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat(sep=' ', timespec='microseconds')
+
+
+def _profile_from_row(row):
+    return row[0], row[1], bool(row[2]), datetime.fromisoformat(row[3]), row[4]
+
+
+def _names():
+    user_table_name = current_app.config['USER_TABLE_NAME']
+    blacklist_token_table_name = current_app.config['BLACKLIST_TOKEN_TABLE_NAME']
+    return dict(
+        user_table=quote_ident(user_table_name),
+        blacklist_token_table=quote_ident(blacklist_token_table_name),
+        schema_version_table=quote_ident(current_app.config['SCHEMA_VERSION_TABLE_NAME']),
+        token_hash_index=quote_ident(blacklist_token_table_name + '_token_hash_idx'),
+        expires_at_index=quote_ident(blacklist_token_table_name + '_expires_at_idx'),
+        blacklisted_date_index=quote_ident(blacklist_token_table_name + '_blacklisted_date_idx'),
+        user_version_trigger=quote_ident(user_table_name + '_bump_version'),
+    )
+
+
+def _create_tables(conn, names):
+    conn.execute("""CREATE TABLE IF NOT EXISTS {user_table}
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     email TEXT NOT NULL UNIQUE,
+                     password TEXT NOT NULL,
+                     is_admin INTEGER NOT NULL DEFAULT 0,
+                     registration_date TEXT NOT NULL);""".format(**names))
+    conn.execute("""CREATE TABLE IF NOT EXISTS {blacklist_token_table}
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     token_hash BLOB NOT NULL,
+                     expires_at TEXT NOT NULL,
+                     blacklisted_date TEXT NOT NULL);""".format(**names))
+    conn.execute("""CREATE INDEX IF NOT EXISTS {token_hash_index}
+                    ON {blacklist_token_table} (token_hash);""".format(**names))
+    conn.execute("""CREATE INDEX IF NOT EXISTS {expires_at_index}
+                    ON {blacklist_token_table} (expires_at);""".format(**names))
+
+
+def _add_user_version(conn, names):
+    conn.execute("""ALTER TABLE {user_table} ADD COLUMN version INTEGER NOT NULL DEFAULT 1;""".format(**names))
+    # Триггер не срабатывает на собственное изменение version, так как следит только за остальными столбцами.
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS {user_version_trigger}
+                    AFTER UPDATE OF email, password, is_admin, registration_date ON {user_table}
+                    BEGIN
+                        UPDATE {user_table} SET version = OLD.version + 1 WHERE id = NEW.id;
+                    END;""".format(**names))
+
+
+def _add_blacklisted_date_index(conn, names):
+    conn.execute("""CREATE INDEX IF NOT EXISTS {blacklisted_date_index}
+                    ON {blacklist_token_table} (blacklisted_date);""".format(**names))
+
+
+# Миграции схемы SQLite: (версия, описание, функция миграции).
+SQLITE_MIGRATIONS = [
+    (1, 'Создание таблиц user и blacklist_token', _create_tables),
+    (2, 'Версия строки пользователя для ETag', _add_user_version),
+    (3, 'Индекс по дате отзыва для догрузки отзывов', _add_blacklisted_date_index),
+]
+
+LATEST_SQLITE_SCHEMA_VERSION = SQLITE_MIGRATIONS[-1][0]
+
+
+class SqliteStorage(Storage):
+    """Хранилище в файле SQLite для запуска на одном узле без сервера БД.
+
+    Процесс держит одно соединение и выполняет запросы по очереди: SQLite всё равно сериализует запись,
+    а чтения из локального файла занимают микросекунды. Несколько процессов могут работать с одним файлом
+    в режиме WAL. path=':memory:' держит БД в памяти процесса.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path=':memory:', timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connection(self):
+        # Соединение SQLite нельзя использовать после fork, поэтому каждый процесс открывает своё.
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            if self.path != ':memory:':
+                conn.execute('PRAGMA journal_mode=WAL;')
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def _execute(self, query, params=()):
+        """Выполняет запрос и возвращает все его строки и число изменённых строк."""
+        with self._lock, timed('db_query'):
+            cursor = self._connection().execute(query.format(**_names()), params)
+            rows = cursor.fetchall()
+            rowcount = cursor.rowcount
+            cursor.close()
+        return rows, rowcount
+
+    def _get_schema_version(self, conn, names):
+        conn.execute("""CREATE TABLE IF NOT EXISTS {schema_version_table}
+                        (version INTEGER PRIMARY KEY,
+                         description TEXT NOT NULL,
+                         applied_date TEXT NOT NULL);""".format(**names))
+        return conn.execute('SELECT coalesce(max(version), 0) FROM {schema_version_table};'.format(
+            **names)).fetchone()[0]
+
+    def ensure_schema(self, mode):
+        if mode not in SCHEMA_CHECK_MODES:
+            raise ValueError(f'SCHEMA_CHECK_ON_STARTUP должен быть одним из {SCHEMA_CHECK_MODES}, а не {mode!r}.')
+        if mode == 'skip':
+            return None
+        with self._lock:
+            version = self._get_schema_version(self._connection(), _names())
+        if version < LATEST_SQLITE_SCHEMA_VERSION:
+            if mode == 'check':
+                raise SchemaOutdated(f'Версия схемы SQLite {version}, приложению нужна '
+                                     f'{LATEST_SQLITE_SCHEMA_VERSION}. Выполните flask init-db.')
+            version = self.init_schema()
+        return version
+
+    def init_schema(self):
+        names = _names()
+        with self._lock:
+            conn = self._connection()
+            # BEGIN IMMEDIATE не даёт двум процессам применять миграции одновременно.
+            conn.execute('BEGIN IMMEDIATE;')
+            try:
+                version = self._get_schema_version(conn, names)
+                for migration_version, description, migration in SQLITE_MIGRATIONS:
+                    if migration_version <= version:
+                        continue
+                    migration(conn, names)
+                    conn.execute('INSERT INTO {schema_version_table} (version, description, applied_date) '
+                                 'VALUES(?, ?, ?);'.format(**names),
+                                 [migration_version, description, _to_text(datetime.utcnow())])
+                    version = migration_version
+                    print(f"Применена миграция SQLite {migration_version}: {description}.")
+                conn.execute('COMMIT;')
+            except Exception:
+                conn.execute('ROLLBACK;')
+                raise
+        return version
+
+    def delete_test_data(self):
+        config = current_app.config
+        if config['USER_TABLE_NAME'].endswith('_test') and config['BLACKLIST_TOKEN_TABLE_NAME'].endswith('_test'):
+            self._execute('DELETE FROM {user_table};')
+            self._execute('DELETE FROM {blacklist_token_table};')
+
+    def create_user(self, email, password, registration_date):
+        rows, _ = self._execute(f"""INSERT INTO {{user_table}} (email, password, registration_date)
+                                    VALUES(?, ?, ?)
+                                    ON CONFLICT (email) DO NOTHING
+                                    RETURNING {PROFILE_COLUMNS};""",
+                                [email, password, _to_text(registration_date)])
+        return _profile_from_row(rows[0]) if rows else None
+
+    def get_user_id_by_email(self, email, primary=False):
+        rows, _ = self._execute('SELECT id FROM {user_table} WHERE email = ?;', [email])
+        return rows[0] if rows else None
+
+    def get_user_credentials_by_email(self, email, primary=False):
+        rows, _ = self._execute('SELECT id, password FROM {user_table} WHERE email = ?;', [email])
+        return rows[0] if rows else None
+
+    def get_user_profile_by_id(self, user_id, primary=False):
+        rows, _ = self._execute(f'SELECT {PROFILE_COLUMNS} FROM {{user_table}} WHERE id = ?;', [user_id])
+        return _profile_from_row(rows[0]) if rows else None
+
+    def get_user_version(self, user_id, primary=False):
+        rows, _ = self._execute('SELECT version FROM {user_table} WHERE id = ?;', [user_id])
+        return rows[0][0] if rows else None
+
+    def get_user_profiles_by_ids(self, user_ids):
+        user_ids = list(set(user_ids))
+        if not user_ids:
+            return []
+        placeholders = ', '.join('?' * len(user_ids))
+        rows, _ = self._execute(f'SELECT {PROFILE_COLUMNS} FROM {{user_table}} WHERE id IN ({placeholders});',
+                                user_ids)
+        return [_profile_from_row(row) for row in rows]
+
+    def get_user_profiles_page(self, after_id, limit):
+        rows, _ = self._execute(f'SELECT {PROFILE_COLUMNS} FROM {{user_table}} WHERE id > ? ORDER BY id LIMIT ?;',
+                                [after_id, limit])
+        return [_profile_from_row(row) for row in rows]
+
+    def iter_user_profiles(self, after_id, batch_size):
+        # Соединение одно на процесс, поэтому курсор не держится между пачками: каждая пачка читается
+        # отдельным запросом по ключу, начиная с последнего прочитанного id.
+        while True:
+            profiles = self.get_user_profiles_page(after_id, batch_size)
+            yield from profiles
+            if len(profiles) < batch_size:
+                return
+            after_id = profiles[-1][0]
+
+    def set_user_admin(self, email, is_admin):
+        rows, _ = self._execute('UPDATE {user_table} SET is_admin = ? WHERE email = ? AND is_admin != ? RETURNING id;',
+                                [int(is_admin), email, int(is_admin)])
+        if rows:
+            return rows[0][0]
+        user_id = self.get_user_id_by_email(email)
+        return user_id[0] if user_id else None
+
+    def save_token(self, token_hash, expires_at, blacklisted_date):
+        self._execute("""INSERT INTO {blacklist_token_table} (token_hash, expires_at, blacklisted_date)
+                         VALUES(?, ?, ?);""",
+                      [bytes(token_hash), _to_text(expires_at), _to_text(blacklisted_date)])
+
+    def save_tokens(self, rows):
+        params = [[bytes(token_hash), _to_text(expires_at), _to_text(blacklisted_date)]
+                  for token_hash, expires_at, blacklisted_date in rows]
+        query = """INSERT INTO {blacklist_token_table} (token_hash, expires_at, blacklisted_date)
+                   VALUES(?, ?, ?);""".format(**_names())
+        with self._lock, timed('db_query'):
+            conn = self._connection()
+            conn.execute('BEGIN;')
+            try:
+                conn.executemany(query, params)
+                conn.execute('COMMIT;')
+            except Exception:
+                conn.execute('ROLLBACK;')
+                raise
+
+    def is_token_blacklisted(self, token_hash, primary=False):
+        rows, _ = self._execute('SELECT 1 FROM {blacklist_token_table} WHERE token_hash = ? LIMIT 1;',
+                                [bytes(token_hash)])
+        return bool(rows)
+
+    def get_blacklisted_token_hashes(self, token_hashes):
+        token_hashes = [bytes(token_hash) for token_hash in token_hashes]
+        if not token_hashes:
+            return set()
+        placeholders = ', '.join('?' * len(token_hashes))
+        rows, _ = self._execute(f"""SELECT token_hash FROM {{blacklist_token_table}}
+                                    WHERE token_hash IN ({placeholders});""", token_hashes)
+        return {bytes(row[0]) for row in rows}
+
+    def get_token_hashes_since(self, since, now):
+        rows, _ = self._execute("""SELECT token_hash FROM {blacklist_token_table}
+                                   WHERE blacklisted_date >= ? AND expires_at > ?;""",
+                                [_to_text(since), _to_text(now)])
+        return [bytes(row[0]) for row in rows]
+
+    def get_revoked_tokens_since(self, since, now):
+        rows, _ = self._execute("""SELECT token_hash, expires_at FROM {blacklist_token_table}
+                                   WHERE blacklisted_date >= ? AND expires_at > ?;""",
+                                [_to_text(since), _to_text(now)])
+        return [(bytes(row[0]), datetime.fromisoformat(row[1])) for row in rows]
+
+    def purge_expired_tokens(self, now, batch_size):
+        deleted = 0
+        while True:
+            _, rowcount = self._execute("""DELETE FROM {blacklist_token_table}
+                                           WHERE id IN (SELECT id FROM {blacklist_token_table}
+                                                        WHERE expires_at <= ? LIMIT ?);""",
+                                        [_to_text(now), batch_size])
+            deleted += rowcount
+            if rowcount < batch_size:
+                break
+        return deleted
@@ -1,8 +1,15 @@
+import unittest
+
 from flask_testing import TestCase
 
 from project import create_app
-from project.db import delete_test_tables, create_data_base, create_user_table, create_blacklist_token_table, \
-    close_db_conn
+from project.config import TestingConfig
+from project.storage import POSTGRES_BACKEND, init_storage
+
+# Тесты, которым нужен PostgreSQL, пропускаются при запуске с другим хранилищем, например
+# STORAGE_BACKEND=project.storage.memory.MemoryStorage python -m pytest
+requires_postgres = unittest.skipUnless(TestingConfig.STORAGE_BACKEND == POSTGRES_BACKEND,
+                                        'needs the postgres storage backend')
 
 
 class BaseTestCase(TestCase):
@@ -12,13 +19,11 @@ class BaseTestCase(TestCase):
         app = create_app()
         with app.app_context():
             app.config.from_object('project.config.TestingConfig')
+            init_storage()
         return app
 
     def setUp(self):
-        create_data_base()
-        create_user_table()
-        create_blacklist_token_table()
-        close_db_conn()
+        self.app.config['STORAGE'].init_schema()
 
     def tearDown(self):
-        delete_test_tables()
+        self.app.config['STORAGE'].delete_test_data()
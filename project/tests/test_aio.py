@@ -0,0 +1,96 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from project.models import BlacklistToken, _revocation_key, _unverified_payload
+from project.revocation import RevocationTable
+from project.tests.base import BaseTestCase, requires_postgres
+
+try:
+    from project import create_asgi_app
+    import project.aio  # noqa: F401
+except ImportError:
+    create_asgi_app = None
+
+
+@unittest.skipIf(create_asgi_app is None, 'quart and asyncpg are not installed')
+@requires_postgres
+class TestAsyncAuthBlueprint(BaseTestCase):
+
+    def run_async(self, scenario):
+        asgi_app = create_asgi_app()
+        asgi_app.config.from_object('project.config.TestingConfig')
+
+        async def run():
+            async with asgi_app.test_app():
+                return await scenario(asgi_app.test_client())
+        return asyncio.run(run())
+
+    def test_register_status_logout(self):
+        """ Test the async register, status and logout endpoints against the same database """
+        async def scenario(client):
+            response = await client.post('/auth/register', json=dict(email='joe@gmail.com', password='123456'))
+            self.assertEqual(response.status_code, 201)
+            auth_token = (await response.get_json())['auth_token']
+            headers = dict(Authorization='Bearer ' + auth_token)
+            response = await client.get('/auth/status', headers=headers)
+            data = await response.get_json()
+            self.assertTrue(data['data']['email'] == 'joe@gmail.com')
+            etag = response.headers['ETag']
+            response = await client.get('/auth/status', headers=dict(headers, **{'If-None-Match': etag}))
+            self.assertEqual(response.status_code, 304)
+            response = await client.post('/auth/logout', headers=headers)
+            self.assertEqual(response.status_code, 200)
+            response = await client.get('/auth/status', headers=headers)
+            data = await response.get_json()
+            self.assertTrue(data['message'] == 'Token blacklisted. Please log in again.')
+        self.run_async(scenario)
+
+    def test_refresh_token(self):
+        """ Test the async refresh endpoint """
+        async def scenario(client):
+            response = await client.post('/auth/register', json=dict(email='joe@gmail.com', password='123456'))
+            refresh_token = (await response.get_json())['refresh_token']
+            response = await client.post('/auth/refresh', json=dict(refresh_token=refresh_token))
+            self.assertEqual(response.status_code, 200)
+            auth_token = (await response.get_json())['auth_token']
+            response = await client.get('/auth/status', headers=dict(Authorization='Bearer ' + auth_token))
+            self.assertEqual(response.status_code, 200)
+            response = await client.post('/auth/logout', headers=dict(Authorization='Bearer ' + auth_token),
+                                         json=dict(refresh_token=refresh_token))
+            self.assertEqual(response.status_code, 200)
+            response = await client.post('/auth/refresh', json=dict(refresh_token=refresh_token))
+            self.assertEqual(response.status_code, 401)
+        self.run_async(scenario)
+
+
+    def test_cached_token_revoked_by_another_worker(self):
+        """ Test that a token cached by the async worker is rejected once another worker revokes it """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        async def scenario(client):
+            config = client.app.config
+            config['REVOCATION_TABLE_PATH'] = os.path.join(directory, 'revocations')
+            config['REVOCATION_TABLE'] = BlacklistToken.create_revocation_table(config)
+            response = await client.post('/auth/register', json=dict(email='joe@gmail.com', password='123456'))
+            auth_token = (await response.get_json())['auth_token']
+            headers = dict(Authorization='Bearer ' + auth_token)
+            self.assertEqual((await client.get('/auth/status', headers=headers)).status_code, 200)
+            # Синхронный воркер того же хоста записывает отзыв в общую таблицу, минуя кэш этого процесса.
+            other_worker = RevocationTable(config['REVOCATION_TABLE_PATH'],
+                                           capacity=config['REVOCATION_TABLE_CAPACITY'],
+                                           resync_interval=5, rebuild_interval=600)
+            other_worker.add(_revocation_key(auth_token, _unverified_payload(auth_token)),
+                             datetime.utcnow() + timedelta(seconds=60))
+            response = await client.get('/auth/status', headers=headers)
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual((await response.get_json())['message'], 'Token blacklisted. Please log in again.')
+        self.run_async(scenario)
+
+
+if __name__ == '__main__':
+    unittest.main()
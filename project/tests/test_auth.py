@@ -1,6 +1,8 @@
 import time
 import json
 import unittest
+from datetime import datetime, timedelta
+from unittest import mock
 
 from project.tests.base import BaseTestCase
 from project.models import User, BlacklistToken
@@ -54,6 +56,36 @@ class TestAuthBlueprint(BaseTestCase):
             self.assertTrue(response.content_type == 'application/json')
             self.assertEqual(response.status_code, 202)
 
+    def test_create_user_with_existing_email(self):
+        """ Test that atomic user creation reports an already registered email """
+        user = User.create(email='joe@gmail.com', password='test')
+        self.assertEqual(user.email, 'joe@gmail.com')
+        self.assertIsNone(User.create(email='joe@gmail.com', password='123456'))
+
+    def test_existing_email_is_rejected_before_hashing(self):
+        """ Test that a taken email is looked up on the primary and rejected without spending time on bcrypt """
+        User.create(email='joe@gmail.com', password='test')
+        storage = self.app.config['STORAGE']
+        with mock.patch('project.models.generate_password_hash') as generate_password_hash, \
+                mock.patch.object(storage, 'get_user_id_by_email', wraps=storage.get_user_id_by_email) as lookup:
+            self.assertIsNone(User.create(email='joe@gmail.com', password='123456'))
+        generate_password_hash.assert_not_called()
+        lookup.assert_called_once_with('joe@gmail.com', primary=True)
+
+    def test_user_records_hold_only_projected_columns(self):
+        """ Test that a profile never carries the password hash and credentials carry only id and hash """
+        user = User.create(email='joe@gmail.com', password='test')
+        profile = User.get_profile_by_id(user.id)
+        self.assertEqual(profile.as_dict(), user.as_dict())
+        with self.assertRaises(AttributeError):
+            profile.password
+        credentials = User.get_credentials_by_email('joe@gmail.com')
+        self.assertEqual(credentials.id, user.id)
+        self.assertTrue(self.app.config['BCRYPT'].check_password_hash(credentials.password, 'test'))
+        with self.assertRaises(AttributeError):
+            credentials.email
+        self.assertIsNone(User.get_credentials_by_email('bob@gmail.com'))
+
     def test_registered_user_login(self):
         """ Test for login of registered-user login """
         with self.client:
@@ -108,7 +140,125 @@ class TestAuthBlueprint(BaseTestCase):
             self.assertTrue(data['data'] is not None)
             self.assertTrue(data['data']['email'] == 'joe@gmail.com')
             self.assertTrue(data['data']['is_admin'] is False)
+            self.assertNotIn('password', data['data'])
+            self.assertEqual(response.status_code, 200)
+
+    def test_user_status_uses_token_cache(self):
+        """ Test that a repeated status check is served from the token cache until the token is blacklisted """
+        with self.client:
+            resp_register = self.register_user('joe@gmail.com', '123456')
+            auth_token = json.loads(resp_register.data.decode())['auth_token']
+            token_cache = self.app.config['TOKEN_CACHE']
+            hits = token_cache.hits
+            for _ in range(2):
+                response = self.client.get('/auth/status', headers=dict(Authorization='Bearer ' + auth_token))
+                self.assertEqual(response.status_code, 200)
+            self.assertEqual(token_cache.hits, hits + 1)
+            BlacklistToken.save(token=auth_token)
+            response = self.client.get('/auth/status', headers=dict(Authorization='Bearer ' + auth_token))
+            data = json.loads(response.data.decode())
+            self.assertTrue(data['message'] == 'Token blacklisted. Please log in again.')
+            self.assertEqual(response.status_code, 401)
+
+    def test_user_status_uses_user_cache(self):
+        """ Test that repeated status checks read the user record from the user cache """
+        with self.client:
+            resp_register = self.register_user('joe@gmail.com', '123456')
+            auth_token = json.loads(resp_register.data.decode())['auth_token']
+            user_cache = self.app.config['USER_CACHE']
+            hits = user_cache.hits
+            for _ in range(2):
+                response = self.client.get('/auth/status', headers=dict(Authorization='Bearer ' + auth_token))
+                data = json.loads(response.data.decode())
+                self.assertTrue(data['data']['email'] == 'joe@gmail.com')
+            self.assertEqual(user_cache.hits, hits + 1)
+
+    def test_user_status_conditional_get(self):
+        """ Test that status returns an ETag and answers a matching If-None-Match with 304 from the user cache """
+        with self.client:
+            resp_register = self.register_user('joe@gmail.com', '123456')
+            headers = dict(Authorization='Bearer ' + json.loads(resp_register.data.decode())['auth_token'])
+            response = self.client.get('/auth/status', headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('version', json.loads(response.data.decode())['data'])
+            etag = response.headers['ETag']
+            self.assertFalse(etag.startswith('W/'))
+            self.assertEqual(response.headers['Cache-Control'], 'private, no-cache')
+            user_cache = self.app.config['USER_CACHE']
+            hits = user_cache.hits
+            response = self.client.get('/auth/status', headers=dict(headers, **{'If-None-Match': etag}))
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b'')
+            self.assertEqual(response.headers['ETag'], etag)
+            self.assertEqual(user_cache.hits, hits + 1)
+            response = self.client.get('/auth/status', headers=dict(headers, **{'If-None-Match': '"0.0"'}))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['ETag'], etag)
+
+    def login_admin(self):
+        self.register_user('admin@gmail.com', '123456')
+        User.set_admin('admin@gmail.com')
+        auth_token = json.loads(self.login_user('admin@gmail.com', '123456').data.decode())['auth_token']
+        return dict(Authorization='Bearer ' + auth_token)
+
+    def test_admin_users_requires_admin(self):
+        """ Test that the admin endpoints reject users without admin rights """
+        with self.client:
+            resp_register = self.register_user('joe@gmail.com', '123456')
+            headers = dict(Authorization='Bearer ' + json.loads(resp_register.data.decode())['auth_token'])
+            for url in ('/auth/admin/users', '/auth/admin/users/export'):
+                response = self.client.get(url, headers=headers)
+                self.assertEqual(response.status_code, 403)
+                self.assertEqual(json.loads(response.data.decode())['message'], 'Admin rights required.')
+                self.assertEqual(self.client.get(url).status_code, 401)
+
+    def test_revoked_admin_is_rejected_right_away(self):
+        """ Test that revoking admin rights takes effect even while the profile is cached in the worker """
+        with self.client:
+            headers = self.login_admin()
+            for url in ('/auth/admin/users', '/auth/admin/users/export'):
+                self.assertEqual(self.client.get(url, headers=headers).status_code, 200)
+            self.client.get('/auth/status', headers=headers)
+            # Команда set-admin выполняется в другом процессе и не сбрасывает кэш пользователей воркера.
+            self.app.config['STORAGE'].set_user_admin('admin@gmail.com', False)
+            for url in ('/auth/admin/users', '/auth/admin/users/export'):
+                self.assertEqual(self.client.get(url, headers=headers).status_code, 403)
+
+    def test_admin_users_keyset_pages(self):
+        """ Test that the admin user listing pages through users by id """
+        with self.client:
+            headers = self.login_admin()
+            for i in range(4):
+                User.create(f'user{i}@gmail.com', '123456')
+            emails, after = [], 0
+            while after is not None:
+                response = self.client.get(f'/auth/admin/users?after={after}&limit=2', headers=headers)
+                self.assertEqual(response.status_code, 200)
+                data = json.loads(response.data.decode())
+                self.assertLessEqual(len(data['data']), 2)
+                emails += [user['email'] for user in data['data']]
+                after = data['next_after']
+            self.assertEqual(emails, ['admin@gmail.com'] + [f'user{i}@gmail.com' for i in range(4)])
+            self.assertNotIn('password', data['data'][0])
+            response = self.client.get('/auth/admin/users?limit=0', headers=headers)
+            self.assertEqual(response.status_code, 400)
+
+    def test_admin_users_export(self):
+        """ Test that the export streams every user as one json line in id order """
+        self.app.config['ADMIN_EXPORT_BATCH_SIZE'] = 2
+        with self.client:
+            headers = self.login_admin()
+            for i in range(4):
+                User.create(f'user{i}@gmail.com', '123456')
+            response = self.client.get('/auth/admin/users/export', headers=headers)
             self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            users = [json.loads(line) for line in response.data.decode().splitlines()]
+            self.assertEqual([user['email'] for user in users],
+                             ['admin@gmail.com'] + [f'user{i}@gmail.com' for i in range(4)])
+            self.assertTrue(users[0]['is_admin'])
+            response = self.client.get(f'/auth/admin/users/export?after={users[2]["id"]}', headers=headers)
+            self.assertEqual(len(response.data.decode().splitlines()), 2)
 
     def test_user_status_malformed_bearer_token(self):
         """ Test for user status with malformed bearer token"""
@@ -214,6 +364,77 @@ class TestAuthBlueprint(BaseTestCase):
             self.assertTrue(data['message'] == 'Token blacklisted. Please log in again.')
             self.assertEqual(response.status_code, 401)
 
+    def test_purge_expired_blacklisted_tokens(self):
+        """ Test that revoked tokens are purged once they can no longer validate """
+        with self.client:
+            resp_register = self.register_user('joe@gmail.com', '123456')
+            blacklist_token = json.loads(resp_register.data.decode())['auth_token']
+            BlacklistToken.save(token=blacklist_token)
+            self.assertEqual(BlacklistToken.purge_expired(), 0)
+            self.assertTrue(BlacklistToken.is_token_in_blacklist(blacklist_token))
+            self.assertEqual(BlacklistToken.purge_expired(now=datetime.utcnow() + timedelta(seconds=10)), 1)
+            self.assertFalse(BlacklistToken.is_token_in_blacklist(blacklist_token))
+
+    def test_refresh_token(self):
+        """ Test that a refresh token mints access tokens and is revoked on logout """
+        with self.client:
+            self.register_user('joe@gmail.com', '123456')
+            data_login = json.loads(self.login_user('joe@gmail.com', '123456').data.decode())
+            refresh_token = data_login['refresh_token']
+            response = self.client.post('/auth/refresh', data=json.dumps(dict(refresh_token=refresh_token)),
+                                        content_type='application/json')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(data['message'] == 'Successfully refreshed.')
+            auth_token = data['auth_token']
+            response = self.client.get('/auth/status', headers=dict(Authorization='Bearer ' + auth_token))
+            self.assertEqual(response.status_code, 200)
+            # Токены разных типов не взаимозаменяемы.
+            response = self.client.get('/auth/status', headers=dict(Authorization='Bearer ' + refresh_token))
+            self.assertEqual(response.status_code, 401)
+            response = self.client.post('/auth/refresh', data=json.dumps(dict(refresh_token=auth_token)),
+                                        content_type='application/json')
+            self.assertEqual(json.loads(response.data.decode())['message'], 'Invalid token. Please log in again.')
+            response = self.client.post('/auth/logout', headers=dict(Authorization='Bearer ' + auth_token),
+                                        data=json.dumps(dict(refresh_token=refresh_token)),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            response = self.client.post('/auth/refresh', data=json.dumps(dict(refresh_token=refresh_token)),
+                                        content_type='application/json')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 401)
+            self.assertTrue(data['message'] == 'Token blacklisted. Please log in again.')
+
+    def test_refresh_without_token(self):
+        """ Test that /auth/refresh requires a refresh token """
+        with self.client:
+            response = self.client.post('/auth/refresh', data=json.dumps(dict()), content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+    def test_introspect_tokens(self):
+        """ Test batch introspection of valid, blacklisted and invalid tokens """
+        with self.client:
+            resp_register = self.register_user('joe@gmail.com', '123456')
+            valid_token = json.loads(resp_register.data.decode())['auth_token']
+            resp_login = self.login_user('joe@gmail.com', '123456')
+            blacklist_token = json.loads(resp_login.data.decode())['auth_token']
+            BlacklistToken.save(token=blacklist_token)
+            response = self.client.post(
+                '/auth/introspect',
+                data=json.dumps(dict(tokens=[valid_token, blacklist_token, 'not-a-token'])),
+                content_type='application/json',
+            )
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            results = data['results']
+            self.assertTrue(results[0]['active'])
+            self.assertTrue(results[0]['data']['email'] == 'joe@gmail.com')
+            self.assertNotIn('password', results[0]['data'])
+            self.assertFalse(results[1]['active'])
+            self.assertTrue(results[1]['message'] == 'Token blacklisted. Please log in again.')
+            self.assertFalse(results[2]['active'])
+            self.assertTrue(results[2]['message'] == 'Invalid token. Please log in again.')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,59 @@
+import hashlib
+import unittest
+
+from project.bloom import BloomFilter, BlacklistFilter
+
+
+def digest(value):
+    return hashlib.sha256(value.encode('utf-8')).digest()
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    def test_no_false_negatives(self):
+        """ Test that every added digest is reported as possibly present """
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        digests = [digest(str(i)) for i in range(1000)]
+        for item in digests:
+            bloom.add(item)
+        self.assertTrue(all(item in bloom for item in digests))
+
+    def test_false_positive_rate_is_bounded(self):
+        """ Test that the observed false positive rate stays near the configured one """
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(digest(str(i)))
+        false_positives = sum(digest('other' + str(i)) in bloom for i in range(10000))
+        self.assertLess(false_positives / 10000, 0.03)
+        self.assertLess(bloom.expected_false_positive_rate(), 0.02)
+
+
+class TestBlacklistFilter(unittest.TestCase):
+
+    def test_not_ready_filter_always_goes_to_db(self):
+        """ Test that a filter which was not warmed up never answers 'not revoked' """
+        blacklist_filter = BlacklistFilter(capacity=100, error_rate=0.01, resync_interval=5, rebuild_interval=600)
+        self.assertTrue(blacklist_filter.might_contain(digest('token')))
+        blacklist_filter.rebuild([], None)
+        self.assertFalse(blacklist_filter.might_contain(digest('token')))
+        stats = blacklist_filter.stats()
+        self.assertEqual(stats['lookups'], 2)
+        self.assertEqual(stats['filter_negatives'], 1)
+
+    def test_add_during_rebuild_is_kept(self):
+        """ Test that a digest added while the filter is being rebuilt survives the swap """
+        blacklist_filter = BlacklistFilter(capacity=100, error_rate=0.01, resync_interval=5, rebuild_interval=600)
+
+        def digests():
+            yield digest('old')
+            blacklist_filter.add(digest('revoked during rebuild'))
+            yield digest('other')
+
+        blacklist_filter.rebuild(digests(), None)
+        self.assertTrue(blacklist_filter.might_contain(digest('revoked during rebuild')))
+        self.assertTrue(blacklist_filter.might_contain(digest('old')))
+        self.assertIsNone(blacklist_filter._rebuild_adds)
+
+
+if __name__ == '__main__':
+    unittest.main()
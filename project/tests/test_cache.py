@@ -0,0 +1,31 @@
+import time
+import unittest
+
+from project.cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_least_recently_used_entry_is_evicted(self):
+        """ Test that the cache keeps at most maxsize entries and drops the least recently used one """
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['size'], 2)
+
+    def test_entry_expires(self):
+        """ Test that an entry is not returned after its ttl """
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set('a', 1, ttl=0.01)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['misses'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
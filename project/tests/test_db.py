@@ -0,0 +1,352 @@
+import json
+import time
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from psycopg2 import sql
+
+from project.tests.base import BaseTestCase, requires_postgres
+from project.db import get_conn_to_db, close_db_conn, get_db_pool, get_replica_set, PoolTimeout, get_statement, \
+    execute_statement, DatabaseUnavailable
+from project.migrations import apply_migrations, ensure_schema, maintain_blacklist_partitions, MIGRATIONS, \
+    SchemaOutdated
+from project.models import User
+
+
+@requires_postgres
+class TestConnectionPool(BaseTestCase):
+
+    def test_connection_is_reused(self):
+        """ Test that a returned connection is handed out again """
+        conn = get_conn_to_db()
+        close_db_conn()
+        self.assertIs(get_conn_to_db(), conn)
+        close_db_conn()
+
+    def test_returned_connection_is_rolled_back(self):
+        """ Test that an unfinished transaction is rolled back on return """
+        conn = get_conn_to_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT 1;')
+        cursor.close()
+        close_db_conn()
+        self.assertFalse(conn.closed)
+        self.assertEqual(conn.get_transaction_status(), 0)
+
+    def test_pool_timeout(self):
+        """ Test that checkout fails fast when the pool is exhausted """
+        pool = get_db_pool()
+        timeout = pool.timeout
+        pool.timeout = 0.1
+        taken = []
+        try:
+            with self.assertRaises(PoolTimeout):
+                for _ in range(pool.max_size + 1):
+                    taken.append(pool.getconn())
+        finally:
+            pool.timeout = timeout
+            for conn in taken:
+                pool.putconn(conn)
+
+    def test_connections_work_in_utc(self):
+        """ Test that pooled connections use UTC whatever the database time zone is """
+        conn = get_conn_to_db()
+        conn.autocommit = True
+        cursor = conn.cursor()
+        database = sql.Identifier(self.app.config['DB_NAME'])
+        cursor.execute(sql.SQL("ALTER DATABASE {database} SET TimeZone = 'Asia/Tokyo';").format(database=database))
+        cursor.close()
+        close_db_conn()
+        try:
+            get_db_pool().close()
+            self.assertEqual(self.fetch_time_zone(), 'UTC')
+        finally:
+            conn = get_conn_to_db()
+            conn.autocommit = True
+            cursor = conn.cursor()
+            cursor.execute(sql.SQL('ALTER DATABASE {database} RESET TimeZone;').format(database=database))
+            cursor.close()
+            close_db_conn()
+
+    def fetch_time_zone(self):
+        cursor = get_conn_to_db().cursor()
+        cursor.execute('SHOW TimeZone;')
+        value = cursor.fetchone()[0]
+        cursor.close()
+        close_db_conn()
+        return value
+
+    def test_pool_timeout_is_not_retried(self):
+        """ Test that get_conn_to_db raises PoolTimeout after a single wait when the pool is exhausted """
+        pool = get_db_pool()
+        timeout = pool.timeout
+        pool.timeout = 0.5
+        taken = []
+        try:
+            while len(taken) < pool.max_size:
+                taken.append(pool.getconn())
+            started = time.monotonic()
+            with self.assertRaises(PoolTimeout):
+                get_conn_to_db()
+            self.assertLess(time.monotonic() - started, 2 * pool.timeout)
+        finally:
+            pool.timeout = timeout
+            for conn in taken:
+                pool.putconn(conn)
+
+    def test_unreachable_database_raises(self):
+        """ Test that get_conn_to_db raises DatabaseUnavailable instead of returning None """
+        port = self.app.config['DB_PORT']
+        self.app.config['DB_PORT'] = 1
+        try:
+            with self.assertRaises(DatabaseUnavailable):
+                get_conn_to_db()
+        finally:
+            self.app.config['DB_PORT'] = port
+
+
+@requires_postgres
+class TestReplicaRouting(BaseTestCase):
+
+    def replica_dsn(self, **overrides):
+        """ DSN of the test database used as a stand-in replica """
+        params = dict(dbname=self.app.config['DB_NAME'], user=self.app.config['DB_USER'],
+                      host=self.app.config['DB_HOST'], port=self.app.config['DB_PORT'])
+        if self.app.config['DB_PASSWORD']:
+            params['password'] = self.app.config['DB_PASSWORD']
+        params.update(overrides)
+        return ' '.join(f'{key}={value}' for key, value in params.items())
+
+    def test_reads_go_to_replicas_round_robin(self):
+        """ Test that read-only connections come from the replicas in turn and writes from the primary """
+        self.app.config['DB_REPLICAS'] = [self.replica_dsn(application_name='replica_a'),
+                                          self.replica_dsn(application_name='replica_b')]
+        replica_pools = get_replica_set().pools
+        used = []
+        for _ in range(2):
+            used.append(get_conn_to_db(readonly=True).pool)
+            close_db_conn()
+        self.assertEqual(sorted(map(id, used)), sorted(map(id, replica_pools)))
+        self.assertIs(get_conn_to_db().pool, get_db_pool())
+        # Пока открыто соединение с основной БД, чтение идёт через него.
+        self.assertIs(get_conn_to_db(readonly=True).pool, get_db_pool())
+        close_db_conn()
+
+    def test_failed_replica_is_ejected(self):
+        """ Test that an unreachable replica is skipped and all reads fall back to the primary without replicas """
+        self.app.config['DB_REPLICAS'] = [self.replica_dsn(port=1, application_name='replica_down'),
+                                          self.replica_dsn(application_name='replica_up')]
+        down, up = get_replica_set().pools
+        for _ in range(3):
+            self.assertIs(get_conn_to_db(readonly=True).pool, up)
+            close_db_conn()
+        self.assertNotIn(down, get_replica_set().candidates())
+        self.app.config['DB_REPLICAS'] = [self.replica_dsn(port=1, application_name='replica_down_only')]
+        self.assertIs(get_conn_to_db(readonly=True).pool, get_db_pool())
+        close_db_conn()
+
+    def test_status_and_logout_with_replicas(self):
+        """ Test that status reads from a replica and logout confirms the revocation on the primary """
+        self.app.config['DB_REPLICAS'] = [self.replica_dsn(application_name='replica_status')]
+        with self.client:
+            self.client.post('/auth/register', data=json.dumps(dict(email='joe@gmail.com', password='123456')),
+                             content_type='application/json')
+            response = self.client.post('/auth/login', data=json.dumps(dict(email='joe@gmail.com', password='123456')),
+                                        content_type='application/json')
+            auth_token = json.loads(response.data.decode())['auth_token']
+            headers = dict(Authorization='Bearer ' + auth_token)
+            self.assertEqual(self.client.get('/auth/status', headers=headers).status_code, 200)
+            self.assertEqual(self.client.post('/auth/logout', headers=headers).status_code, 200)
+            self.assertEqual(self.client.get('/auth/status', headers=headers).status_code, 401)
+
+
+@requires_postgres
+class TestStatementRegistry(BaseTestCase):
+
+    def test_statement_is_composed_once_per_table_names(self):
+        """ Test that a statement is composed once per table name configuration """
+        statement = get_statement('user_profile_by_id')
+        self.assertIs(get_statement('user_profile_by_id'), statement)
+        self.assertIn('"user_test"', statement.text)
+        self.assertIn('id = $1', statement.numbered_text)
+        other = get_statement('user_profile_by_id', dict(self.app.config, USER_TABLE_NAME='other_user_test'))
+        self.assertIn('"other_user_test"', other.text)
+        self.assertNotEqual(other.prepared_name, statement.prepared_name)
+
+    def test_statement_is_prepared_once_per_connection(self):
+        """ Test that a registered statement is prepared on the server once per pooled connection """
+        statement = get_statement('user_credentials_by_email')
+        conn = get_conn_to_db()
+        cursor = conn.cursor()
+        for _ in range(3):
+            execute_statement(cursor, 'user_credentials_by_email', ['nobody@gmail.com'])
+            self.assertIsNone(cursor.fetchone())
+        self.assertIn(statement.prepared_name, conn.prepared_statements)
+        cursor.execute('SELECT count(*) FROM pg_prepared_statements WHERE name = %s;', [statement.prepared_name])
+        self.assertEqual(cursor.fetchone()[0], 1)
+        cursor.close()
+        close_db_conn()
+
+    def test_prepared_statements_can_be_disabled(self):
+        """ Test that statements run unprepared when DB_PREPARED_STATEMENTS is off """
+        self.app.config['DB_PREPARED_STATEMENTS'] = False
+        conn = get_conn_to_db()
+        prepared_statements = set(conn.prepared_statements)
+        cursor = conn.cursor()
+        execute_statement(cursor, 'user_id_by_email', ['nobody@gmail.com'])
+        self.assertIsNone(cursor.fetchone())
+        self.assertEqual(conn.prepared_statements, prepared_statements)
+        cursor.close()
+        close_db_conn()
+
+
+@requires_postgres
+class TestMigrations(BaseTestCase):
+
+    def test_migrations_are_idempotent(self):
+        """ Test that re-applying migrations keeps the latest schema version """
+        latest_version = MIGRATIONS[-1][0]
+        self.assertEqual(apply_migrations(), latest_version)
+        self.assertEqual(apply_migrations(), latest_version)
+
+    def test_schema_check_on_startup(self):
+        """ Test that startup schema check accepts the current schema and rejects an outdated one """
+        latest_version = MIGRATIONS[-1][0]
+        self.assertEqual(ensure_schema('check'), latest_version)
+        self.assertEqual(ensure_schema('migrate'), latest_version)
+        self.assertIsNone(ensure_schema('skip'))
+        self.app.config['SCHEMA_VERSION_TABLE_NAME'] = 'schema_version_missing_test'
+        with self.assertRaises(SchemaOutdated):
+            ensure_schema('check')
+        with self.assertRaises(ValueError):
+            ensure_schema('sometimes')
+
+    def fetch_value(self, query):
+        cursor = get_conn_to_db().cursor()
+        cursor.execute(query)
+        value = cursor.fetchone()[0]
+        cursor.close()
+        close_db_conn()
+        return value
+
+    def test_blacklist_partitions(self):
+        """ Test that the blacklist is partitioned by expiry and expired partitions are dropped whole """
+        config = self.app.config
+        table_names = config['BLACKLIST_TOKEN_TABLE_NAME'], config['SCHEMA_VERSION_TABLE_NAME']
+        config['BLACKLIST_TOKEN_TABLE_NAME'] = 'blacklist_token_partition_test'
+        config['SCHEMA_VERSION_TABLE_NAME'] = 'schema_version_partition_test'
+        storage = config['STORAGE']
+        now = datetime.utcnow()
+        midnight = datetime(now.year, now.month, now.day)
+        try:
+            # Схема до секционирования (миграция 7).
+            with mock.patch('project.migrations.MIGRATIONS', MIGRATIONS[:6]):
+                apply_migrations()
+            storage.save_token(b'o' * 32, now + timedelta(seconds=60), now)
+            self.assertEqual(apply_migrations(), MIGRATIONS[-1][0])
+            storage.save_token(b'f' * 32, now + timedelta(days=60), now)
+            storage.save_token(b'm' * 32, midnight, now)
+            created, dropped = maintain_blacklist_partitions(now)
+            self.assertTrue(created)
+            self.assertEqual(dropped, [])
+            # Срок, равный нижней границе секции, попадает в эту секцию, а не в предыдущие сутки.
+            partition_name = self.fetch_value("""SELECT tableoid::regclass::text FROM blacklist_token_partition_test
+                                                 WHERE token_hash = decode(repeat('6d', 32), 'hex');""")
+            self.assertTrue(partition_name.startswith(f'blacklist_token_partition_test_{midnight:%Y%m%d}_'))
+            # Индекс для догрузки отзывов по дате есть и в секции по умолчанию, и в созданных секциях.
+            for table_name in (partition_name, 'blacklist_token_partition_test_default'):
+                self.assertEqual(self.fetch_value(f"""SELECT count(*) FROM pg_indexes WHERE tablename = '{table_name}'
+                                                      AND indexdef LIKE '%(blacklisted_date)';"""), 1)
+            storage.save_token(b'e' * 32, now - timedelta(days=1), now)
+            self.assertEqual(maintain_blacklist_partitions(now), ([], []))
+            # Истёкший токен без секции удаляется из секции по умолчанию, а токен, срок которого дальше
+            # созданных секций, остаётся в ней.
+            self.assertFalse(storage.is_token_blacklisted(b'e' * 32, primary=True))
+            self.assertEqual(self.fetch_value('SELECT count(*) FROM blacklist_token_partition_test_default;'), 1)
+            created, dropped = maintain_blacklist_partitions(now + timedelta(days=40))
+            self.assertTrue(dropped)
+            self.assertEqual(self.fetch_value('SELECT count(*) FROM blacklist_token_partition_test_default;'), 0)
+            self.assertFalse(storage.is_token_blacklisted(b'o' * 32, primary=True))
+            self.assertTrue(storage.is_token_blacklisted(b'f' * 32, primary=True))
+        finally:
+            conn = get_conn_to_db()
+            cursor = conn.cursor()
+            cursor.execute('DROP TABLE IF EXISTS blacklist_token_partition_test, schema_version_partition_test;')
+            conn.commit()
+            cursor.close()
+            close_db_conn()
+            config['BLACKLIST_TOKEN_TABLE_NAME'], config['SCHEMA_VERSION_TABLE_NAME'] = table_names
+
+    def test_duplicate_emails_are_removed_before_unique_index(self):
+        """ Test that the unique email migration keeps the first user of each duplicated email """
+        config = self.app.config
+        table_names = (config['USER_TABLE_NAME'], config['BLACKLIST_TOKEN_TABLE_NAME'],
+                       config['SCHEMA_VERSION_TABLE_NAME'])
+        config['USER_TABLE_NAME'] = 'user_dedupe_test'
+        config['BLACKLIST_TOKEN_TABLE_NAME'] = 'blacklist_token_dedupe_test'
+        config['SCHEMA_VERSION_TABLE_NAME'] = 'schema_version_dedupe_test'
+        try:
+            # Схема до уникального индекса по email (миграция 3).
+            with mock.patch('project.migrations.MIGRATIONS', MIGRATIONS[:2]):
+                apply_migrations()
+            conn = get_conn_to_db()
+            cursor = conn.cursor()
+            cursor.execute("""INSERT INTO user_dedupe_test (email, password, registration_date)
+                              VALUES ('joe@gmail.com', 'first', now()), ('joe@gmail.com', 'second', now()),
+                                     ('bob@gmail.com', 'bob', now()) RETURNING id;""")
+            first_id = cursor.fetchone()[0]
+            conn.commit()
+            cursor.close()
+            close_db_conn()
+            self.assertEqual(apply_migrations(), MIGRATIONS[-1][0])
+            self.assertEqual(self.fetch_value("""SELECT array_agg(password ORDER BY id) FROM user_dedupe_test
+                                                 WHERE email = 'joe@gmail.com';"""), ['first'])
+            self.assertEqual(self.fetch_value("SELECT count(*) FROM user_dedupe_test;"), 2)
+            self.assertTrue(self.fetch_value("""SELECT indisunique AND indisvalid FROM pg_index
+                                                WHERE indexrelid = 'user_dedupe_test_email_key'::regclass;"""))
+            self.assertEqual(User.get_user_id_or_none('joe@gmail.com', primary=True)[0], first_id)
+        finally:
+            conn = get_conn_to_db()
+            cursor = conn.cursor()
+            cursor.execute("""DROP TABLE IF EXISTS user_dedupe_test, blacklist_token_dedupe_test,
+                                                   schema_version_dedupe_test;
+                              DROP FUNCTION IF EXISTS user_dedupe_test_bump_version();""")
+            conn.commit()
+            cursor.close()
+            close_db_conn()
+            (config['USER_TABLE_NAME'], config['BLACKLIST_TOKEN_TABLE_NAME'],
+             config['SCHEMA_VERSION_TABLE_NAME']) = table_names
+
+    def test_user_version_is_bumped_on_update(self):
+        """ Test that the trigger bumps the user row version and the status ETag follows it """
+        with self.client:
+            User.create('joe@gmail.com', '123456')
+            user_id = User.get_user_id_or_none('joe@gmail.com')[0]
+            auth_token = User.encode_auth_token(user_id)
+            headers = dict(Authorization='Bearer ' + auth_token)
+            etag = self.client.get('/auth/status', headers=headers).headers['ETag']
+            self.assertEqual(User.get_profile_version(user_id), 1)
+            conn = get_conn_to_db()
+            cursor = conn.cursor()
+            cursor.execute(f"UPDATE {self.app.config['USER_TABLE_NAME']} SET is_admin = TRUE WHERE id = %s;",
+                           [user_id])
+            conn.commit()
+            cursor.close()
+            close_db_conn()
+            User.invalidate_cache(user_id)
+            self.assertEqual(User.get_profile_version(user_id, primary=True), 2)
+            response = self.client.get('/auth/status', headers=dict(headers, **{'If-None-Match': etag}))
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+            self.assertTrue(json.loads(response.data.decode())['data']['is_admin'])
+
+    def test_startup_timings(self):
+        """ Test that startup steps are timed """
+        timings = self.app.config['STARTUP_TIMINGS']
+        for step in ('config', 'schema', 'blacklist_filter', 'total'):
+            self.assertIn(step, timings)
+
+
+if __name__ == '__main__':
+    unittest.main()
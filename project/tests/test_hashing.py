@@ -0,0 +1,51 @@
+import json
+import unittest
+
+from project.tests.base import BaseTestCase
+from project.hashing import HashingPool, HashingPoolBusy, _generate_password_hash, _check_password_hash
+
+
+class TestHashingPool(BaseTestCase):
+
+    def test_pool_hashes_and_checks_password(self):
+        """ Test that hashing in the process pool is compatible with the inline bcrypt """
+        pool = HashingPool(size=1, queue_size=0, timeout=30)
+        try:
+            pw_hash = pool.run(_generate_password_hash, '123456', 4)
+            self.assertTrue(pool.run(_check_password_hash, pw_hash, '123456'))
+            self.assertTrue(self.app.config['BCRYPT'].check_password_hash(pw_hash, '123456'))
+            self.assertFalse(pool.run(_check_password_hash, pw_hash, '123457'))
+        finally:
+            pool.shutdown()
+
+    def test_full_queue_fails_fast(self):
+        """ Test that a request is rejected at once when the pool queue is full """
+        pool = HashingPool(size=1, queue_size=0, timeout=30)
+        pool._slots.acquire()
+        with self.assertRaises(HashingPoolBusy):
+            pool.run(_generate_password_hash, '123456', 4)
+
+    def test_login_when_pool_is_busy(self):
+        """ Test that login answers 503 with Retry-After when the hashing queue is full """
+        pool = HashingPool(size=1, queue_size=0, timeout=30)
+        with self.client:
+            self.client.post('/auth/register', data=json.dumps(dict(email='joe@gmail.com', password='123456')),
+                             content_type='application/json')
+            pool._slots.acquire()
+            self.app.config['HASHING_POOL'] = pool
+            try:
+                response = self.client.post(
+                    '/auth/login',
+                    data=json.dumps(dict(email='joe@gmail.com', password='123456')),
+                    content_type='application/json',
+                )
+            finally:
+                self.app.config['HASHING_POOL'] = None
+            data = json.loads(response.data.decode())
+            self.assertTrue(data['status'] == 'fail')
+            self.assertEqual(response.status_code, 503)
+            self.assertTrue(response.headers.get('Retry-After'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import io
+import json
+import unittest
+
+from project.tests.base import BaseTestCase, requires_postgres
+from project.importer import import_users
+from project.models import User
+
+
+@requires_postgres
+class TestImportUsers(BaseTestCase):
+
+    def test_import_ndjson(self):
+        """ Test bulk import with plaintext passwords, existing hashes, duplicates and invalid rows """
+        User.save(email='joe@gmail.com', password='123456')
+        pw_hash = self.app.config['BCRYPT'].generate_password_hash('secret', 4).decode('utf-8')
+        lines = [
+            json.dumps(dict(email='ann@gmail.com', password='123456')),
+            json.dumps(dict(email='bob@gmail.com', password_hash=pw_hash)),
+            json.dumps(dict(email='joe@gmail.com', password='654321')),
+            json.dumps(dict(email='no-password@gmail.com')),
+        ]
+        stats = import_users(io.StringIO('\n'.join(lines)), file_format='ndjson', batch_size=2, workers=1)
+        self.assertEqual(stats.inserted, 2)
+        self.assertEqual(stats.duplicates, 1)
+        self.assertEqual(stats.rejected, 1)
+        user = User.get_credentials_by_email('ann@gmail.com')
+        self.assertTrue(self.app.config['BCRYPT'].check_password_hash(user.password, '123456'))
+        self.assertEqual(User.get_credentials_by_email('bob@gmail.com').password, pw_hash)
+
+
+if __name__ == '__main__':
+    unittest.main()
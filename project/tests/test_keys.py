@@ -0,0 +1,108 @@
+import json
+import shutil
+import tempfile
+import unittest
+
+import jwt
+
+from project.keys import generate_signing_key, init_keyring, get_keyring
+from project.tests.base import BaseTestCase
+
+
+class TestAsymmetricSigning(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.keys_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.app.config['JWT_ALGORITHM'] = 'HS256'
+        init_keyring(self.app.config)
+        shutil.rmtree(self.keys_dir)
+        super().tearDown()
+
+    def use_keys(self, algorithm):
+        self.app.config['JWT_ALGORITHM'] = algorithm
+        self.app.config['JWT_KEYS_DIR'] = self.keys_dir
+        init_keyring(self.app.config)
+
+    def register_user(self, email, password):
+        response = self.client.post('/auth/register', data=json.dumps(dict(email=email, password=password)),
+                                    content_type='application/json')
+        return json.loads(response.data.decode())['auth_token']
+
+    def test_token_verifies_with_published_jwks(self):
+        """ Test that tokens signed with each asymmetric algorithm verify against the JWKS """
+        for algorithm in ('RS256', 'EdDSA'):
+            kid = generate_signing_key(self.keys_dir, algorithm)
+            self.use_keys(algorithm)
+            with self.client:
+                auth_token = self.register_user(f'joe-{algorithm.lower()}@gmail.com', '123456')
+                self.assertEqual(jwt.get_unverified_header(auth_token)['kid'], kid)
+                jwks = json.loads(self.client.get('/.well-known/jwks.json').data.decode())
+                public_key = jwt.PyJWKSet.from_dict(jwks)[kid].key
+                payload = jwt.decode(auth_token, public_key, algorithms=[algorithm])
+                self.assertTrue(isinstance(payload['sub'], int))
+                response = self.client.get('/auth/status', headers=dict(Authorization='Bearer ' + auth_token))
+                self.assertEqual(response.status_code, 200)
+
+    def test_key_rotation(self):
+        """ Test that tokens signed with a rotated out key stay valid while the key is published """
+        old_kid = generate_signing_key(self.keys_dir, 'EdDSA')
+        self.use_keys('EdDSA')
+        with self.client:
+            old_token = self.register_user('joe@gmail.com', '123456')
+            new_kid = generate_signing_key(self.keys_dir, 'EdDSA')
+            self.use_keys('EdDSA')
+            new_token = self.register_user('bob@gmail.com', '123456')
+            self.assertEqual(jwt.get_unverified_header(old_token)['kid'], old_kid)
+            self.assertEqual(jwt.get_unverified_header(new_token)['kid'], new_kid)
+            jwks = json.loads(self.client.get('/.well-known/jwks.json').data.decode())
+            self.assertEqual([key['kid'] for key in jwks['keys']], [old_kid, new_kid])
+            for auth_token in (old_token, new_token):
+                response = self.client.get('/auth/status', headers=dict(Authorization='Bearer ' + auth_token))
+                self.assertEqual(response.status_code, 200)
+
+    def test_hs256_token_is_rejected_with_asymmetric_keys(self):
+        """ Test that a token signed with the shared secret is rejected once asymmetric signing is on """
+        with self.client:
+            auth_token = self.register_user('joe@gmail.com', '123456')
+            generate_signing_key(self.keys_dir, 'EdDSA')
+            self.use_keys('EdDSA')
+            self.app.config['TOKEN_CACHE'] = None
+            response = self.client.get('/auth/status', headers=dict(Authorization='Bearer ' + auth_token))
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(data['message'], 'Invalid token. Please log in again.')
+
+    def test_keyring_can_be_loaded_lazily(self):
+        """ Test that a lazily initialized keyring tolerates a missing key until the first signature """
+        self.app.config['JWT_ALGORITHM'] = 'EdDSA'
+        self.app.config['JWT_KEYS_DIR'] = self.keys_dir
+        init_keyring(self.app.config, lazy=True)
+        with self.assertRaises(RuntimeError):
+            get_keyring(self.app.config)
+        kid = generate_signing_key(self.keys_dir, 'EdDSA')
+        self.assertEqual(get_keyring(self.app.config).active.kid, kid)
+
+    def test_jwks_cache_headers(self):
+        """ Test that the JWKS is cacheable and answers 304 to a matching If-None-Match """
+        generate_signing_key(self.keys_dir, 'RS256')
+        self.use_keys('RS256')
+        with self.client:
+            response = self.client.get('/.well-known/jwks.json')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('max-age=', response.headers['Cache-Control'])
+            etag = response.headers['ETag']
+            response = self.client.get('/.well-known/jwks.json', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+
+    def test_jwks_is_empty_for_hs256(self):
+        """ Test that no key material is published when tokens are signed with the shared secret """
+        with self.client:
+            response = self.client.get('/.well-known/jwks.json')
+            self.assertEqual(json.loads(response.data.decode()), {'keys': []})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import json
+import os
+import unittest
+
+from project.metrics import Counter, Histogram
+from project.tests.base import BaseTestCase
+
+
+class TestMetricTypes(unittest.TestCase):
+
+    def test_histogram_renders_cumulative_buckets(self):
+        """ Test that a histogram renders cumulative buckets, sum and count per label set """
+        histogram = Histogram('test_seconds', 'Test histogram.', ('phase',), buckets=(0.1, 1.0))
+        histogram.observe(0.05, 'jwt')
+        histogram.observe(0.5, 'jwt')
+        histogram.observe(5.0, 'jwt')
+        lines = histogram.render()
+        self.assertIn('# TYPE test_seconds histogram', lines)
+        self.assertIn('test_seconds_bucket{phase="jwt",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{phase="jwt",le="1.0"} 2', lines)
+        self.assertIn('test_seconds_bucket{phase="jwt",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_sum{phase="jwt"} 5.55', lines)
+        self.assertIn('test_seconds_count{phase="jwt"} 3', lines)
+
+    def test_counter_escapes_label_values(self):
+        """ Test that counter label values are escaped in the text format """
+        counter = Counter('test_total', 'Test counter.', ('name',))
+        counter.inc('a"b')
+        counter.inc('a"b', amount=2)
+        self.assertIn('test_total{name="a\\"b"} 3', counter.render())
+
+
+class TestMetricsEndpoint(BaseTestCase):
+
+    def test_login_reports_server_timing(self):
+        """ Test that a login response breaks its duration down by phase in Server-Timing """
+        self.app.config['SERVER_TIMING_ENABLED'] = True
+        with self.client:
+            self.client.post('/auth/register', data=json.dumps(dict(email='joe@gmail.com', password='123456')),
+                             content_type='application/json')
+            response = self.client.post('/auth/login',
+                                        data=json.dumps(dict(email='joe@gmail.com', password='123456')),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            server_timing = response.headers['Server-Timing']
+            phases = [entry.split(';')[0].strip() for entry in server_timing.split(',')]
+            expected = ['bcrypt', 'jwt', 'total']
+            if self.app.config['STORAGE'].name == 'postgres':
+                expected += ['db_connect', 'db_query']
+            for phase in expected:
+                self.assertIn(phase, phases)
+
+    def test_server_timing_can_be_disabled(self):
+        """ Test that no Server-Timing header is sent when it is disabled """
+        self.app.config['SERVER_TIMING_ENABLED'] = False
+        with self.client:
+            response = self.client.get('/auth/status')
+            self.assertNotIn('Server-Timing', response.headers)
+
+    def test_metrics_endpoint(self):
+        """ Test that /metrics exposes request, phase and cache metrics in Prometheus text format """
+        with self.client:
+            self.client.get('/auth/status')
+            response = self.client.get('/metrics')
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.content_type.startswith('text/plain'))
+            body = response.data.decode()
+            pid = f'pid="{os.getpid()}"'
+            self.assertIn('# TYPE flask_auth_request_seconds histogram', body)
+            self.assertIn('flask_auth_request_seconds_count{endpoint="auth.user_api",method="GET",status="401",'
+                          f'{pid}}}', body)
+            self.assertIn('# TYPE flask_auth_phase_seconds histogram', body)
+            self.assertIn(f'flask_auth_cache{{cache="token",stat="hit_rate",{pid}}}', body)
+            self.assertIn(f'flask_auth_blacklist_filter{{stat="items",{pid}}}', body)
+
+    def test_monotonic_stats_are_counters(self):
+        """ Test that cache and filter lookup counts are exported as counters rather than gauges """
+        with self.client:
+            self.client.get('/auth/status')
+            body = self.client.get('/metrics').data.decode()
+            pid = f'pid="{os.getpid()}"'
+            self.assertIn('# TYPE flask_auth_cache_hits_total counter', body)
+            self.assertIn('# TYPE flask_auth_cache_misses_total counter', body)
+            self.assertIn(f'flask_auth_cache_misses_total{{cache="token",{pid}}}', body)
+            self.assertIn('# TYPE flask_auth_blacklist_filter_lookups_total counter', body)
+            self.assertNotIn('stat="hits"', body)
+            self.assertNotIn('stat="lookups"', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from project.models import BlacklistToken, User, _revocation_key, _unverified_payload
+from project.revocation import RevocationTable
+from project.tests.base import BaseTestCase
+
+
+def digest(value):
+    return hashlib.sha256(value.encode('utf-8')).digest()
+
+
+def _revoke_in_child(path, value):
+    table = RevocationTable(path, capacity=64, resync_interval=5, rebuild_interval=600)
+    table.add(digest(value), datetime.utcnow() + timedelta(seconds=60))
+
+
+class TestRevocationTable(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'revocations')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open_table(self, capacity=64):
+        return RevocationTable(self.path, capacity=capacity, resync_interval=5, rebuild_interval=600)
+
+    def test_table_answers_only_after_rebuild(self):
+        """ Test that a table that was never built from the database does not answer """
+        table = self.open_table()
+        self.assertIsNone(table.lookup(digest('token')))
+        table.rebuild([(digest('revoked'), datetime.utcnow() + timedelta(seconds=60))], datetime.utcnow())
+        self.assertTrue(table.lookup(digest('revoked')))
+        self.assertFalse(table.lookup(digest('token')))
+        self.assertFalse(table.needs_rebuild())
+        self.assertFalse(table.needs_resync())
+
+    def test_expired_tokens_are_not_revoked_and_slots_are_reused(self):
+        """ Test that expired entries stop matching and their slots are taken by new revocations """
+        table = self.open_table(capacity=4)
+        now = datetime.utcnow()
+        table.rebuild([(digest(str(i)), now - timedelta(seconds=10)) for i in range(4)], now)
+        self.assertFalse(table.lookup(digest('0')))
+        table.add(digest('new'), now + timedelta(seconds=60))
+        self.assertTrue(table.lookup(digest('new')))
+        self.assertTrue(table.stats()['ready'])
+
+    def test_table_larger_than_free_space_is_refused(self):
+        """ Test that a table that does not fit the partition is refused instead of crashing with SIGBUS later """
+        stat = os.statvfs(self.directory)
+        capacity = stat.f_bavail * stat.f_frsize // 40 + 1
+        with self.assertRaises(RuntimeError):
+            self.open_table(capacity=capacity)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_overflow_falls_back(self):
+        """ Test that a full table stops answering instead of missing revocations """
+        table = self.open_table(capacity=4)
+        expires_at = datetime.utcnow() + timedelta(seconds=60)
+        table.rebuild([(digest(str(i)), expires_at) for i in range(5)], datetime.utcnow())
+        self.assertIsNone(table.lookup(digest('0')))
+        self.assertTrue(table.stats()['overflow'])
+
+    def test_processes_share_the_table(self):
+        """ Test that a revocation written by another process is visible without a lock """
+        table = self.open_table()
+        table.rebuild([], datetime.utcnow())
+        process = multiprocessing.get_context('fork').Process(target=_revoke_in_child, args=(self.path, 'token'))
+        process.start()
+        process.join()
+        self.assertTrue(table.lookup(digest('token')))
+
+    def test_capacity_change_recreates_file(self):
+        """ Test that reopening with another capacity starts from an empty table """
+        self.open_table().rebuild([(digest('token'), datetime.utcnow() + timedelta(seconds=60))],
+                                  datetime.utcnow())
+        table = self.open_table(capacity=128)
+        self.assertIsNone(table.lookup(digest('token')))
+        self.assertEqual(table.stats()['capacity'], 128)
+
+
+class TestRevocationTableInApp(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.app.config['REVOCATION_TABLE_PATH'] = os.path.join(self.directory, 'revocations')
+        BlacklistToken.init_revocation_table()
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.directory)
+
+    def test_logout_is_visible_to_other_workers(self):
+        """ Test that a token cached by one worker is rejected as soon as another worker revokes it """
+        with self.client:
+            User.create('joe@gmail.com', '123456')
+            response = self.client.post('/auth/login', data=json.dumps(dict(email='joe@gmail.com', password='123456')),
+                                        content_type='application/json')
+            auth_token = json.loads(response.data.decode())['auth_token']
+            headers = dict(Authorization='Bearer ' + auth_token)
+            self.assertEqual(self.client.get('/auth/status', headers=headers).status_code, 200)
+            # Другой воркер открывает тот же файл и записывает отзыв, минуя кэши этого процесса.
+            other_worker = RevocationTable(self.app.config['REVOCATION_TABLE_PATH'],
+                                           capacity=self.app.config['REVOCATION_TABLE_CAPACITY'],
+                                           resync_interval=5, rebuild_interval=600)
+            other_worker.add(_revocation_key(auth_token, _unverified_payload(auth_token)),
+                             datetime.utcnow() + timedelta(seconds=60))
+            response = self.client.get('/auth/status', headers=headers)
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(json.loads(response.data.decode())['message'], 'Token blacklisted. Please log in again.')
+
+    def test_restart_rebuilds_from_database(self):
+        """ Test that revocations stored in the database are loaded when the table is rebuilt """
+        with self.client:
+            User.create('joe@gmail.com', '123456')
+            auth_token = User.encode_auth_token(User.get_user_id_or_none('joe@gmail.com')[0])
+            self.app.config['REVOCATION_TABLE'] = None
+            BlacklistToken.save(auth_token)
+            os.remove(self.app.config['REVOCATION_TABLE_PATH'])
+            BlacklistToken.init_revocation_table()
+            revocation_key = _revocation_key(auth_token, _unverified_payload(auth_token))
+            self.assertTrue(self.app.config['REVOCATION_TABLE'].lookup(revocation_key))
+
+
+if __name__ == '__main__':
+    unittest.main()
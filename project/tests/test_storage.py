@@ -0,0 +1,151 @@
+import json
+import os
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from project import create_app
+from project.migrations import SchemaOutdated
+from project.storage import init_storage
+from project.storage.memory import MemoryStorage
+from project.storage.sqlite import SqliteStorage
+from project.tests.base import BaseTestCase
+
+
+class StorageContract:
+    """ Checks shared by all storage backends """
+
+    def test_create_user(self):
+        """ Test that a user is created once per email and can be read back """
+        registration_date = datetime(2024, 1, 2, 3, 4, 5)
+        profile = self.storage.create_user('joe@gmail.com', 'hash', registration_date)
+        self.assertEqual(tuple(profile[1:]), ('joe@gmail.com', False, registration_date, 1))
+        self.assertIsNone(self.storage.create_user('joe@gmail.com', 'other', registration_date))
+        self.assertEqual(tuple(self.storage.get_user_id_by_email('joe@gmail.com')), (profile[0],))
+        self.assertIsNone(self.storage.get_user_id_by_email('bob@gmail.com'))
+        self.assertEqual(tuple(self.storage.get_user_credentials_by_email('joe@gmail.com')), (profile[0], 'hash'))
+        self.assertIsNone(self.storage.get_user_credentials_by_email('bob@gmail.com'))
+        self.assertEqual(self.storage.get_user_profile_by_id(profile[0]), profile)
+        self.assertIsNone(self.storage.get_user_profile_by_id(profile[0] + 1))
+        self.assertEqual(self.storage.get_user_version(profile[0]), 1)
+        self.assertIsNone(self.storage.get_user_version(profile[0] + 1))
+
+    def test_get_user_profiles_by_ids(self):
+        """ Test that profiles are read in one call and missing ids are skipped """
+        now = datetime.utcnow()
+        first = self.storage.create_user('joe@gmail.com', 'hash', now)
+        second = self.storage.create_user('bob@gmail.com', 'hash', now)
+        profiles = self.storage.get_user_profiles_by_ids([first[0], second[0], second[0] + 100])
+        self.assertEqual(sorted(profiles), sorted([first, second]))
+        self.assertEqual(self.storage.get_user_profiles_by_ids([]), [])
+
+    def test_user_pages_and_admin_rights(self):
+        """ Test keyset pages, the streaming iterator and admin rights changes """
+        now = datetime.utcnow()
+        profiles = [self.storage.create_user(f'user{i}@gmail.com', 'hash', now) for i in range(5)]
+        ids = [profile[0] for profile in profiles]
+        self.assertEqual([profile[0] for profile in self.storage.get_user_profiles_page(0, 2)], ids[:2])
+        self.assertEqual([profile[0] for profile in self.storage.get_user_profiles_page(ids[3], 2)], ids[4:])
+        self.assertEqual([profile[0] for profile in self.storage.iter_user_profiles(ids[0], 2)], ids[1:])
+        self.assertEqual(self.storage.set_user_admin('user1@gmail.com', True), ids[1])
+        self.assertEqual(self.storage.set_user_admin('user1@gmail.com', True), ids[1])
+        self.assertIsNone(self.storage.set_user_admin('bob@gmail.com', True))
+        self.assertEqual(tuple(self.storage.get_user_profile_by_id(ids[1])[2::2]), (True, 2))
+
+    def test_blacklist(self):
+        """ Test that revoked token hashes are found until they are purged after expiry """
+        now = datetime.utcnow()
+        expired, live = b'e' * 32, b'l' * 32
+        self.storage.save_token(expired, now - timedelta(seconds=1), now - timedelta(seconds=10))
+        self.storage.save_token(live, now + timedelta(seconds=60), now)
+        self.assertTrue(self.storage.is_token_blacklisted(live))
+        self.assertFalse(self.storage.is_token_blacklisted(b'x' * 32))
+        self.assertEqual(self.storage.get_blacklisted_token_hashes([expired, live, b'x' * 32]), {expired, live})
+        self.assertEqual(self.storage.get_blacklisted_token_hashes([]), set())
+        self.assertEqual(self.storage.get_token_hashes_since(datetime.min, now), [live])
+        self.assertEqual(self.storage.get_token_hashes_since(now + timedelta(seconds=1), now), [])
+        self.assertEqual(self.storage.purge_expired_tokens(now, 10), 1)
+        self.assertFalse(self.storage.is_token_blacklisted(expired))
+        self.assertTrue(self.storage.is_token_blacklisted(live))
+
+    def test_save_tokens(self):
+        """ Test that a batch of revocations is saved in one call """
+        now = datetime.utcnow()
+        rows = [(bytes([i]) * 32, now + timedelta(seconds=60), now) for i in range(3)]
+        self.storage.save_tokens(rows)
+        self.assertEqual(self.storage.get_blacklisted_token_hashes([row[0] for row in rows]), {row[0] for row in rows})
+        self.assertEqual(self.storage.get_revoked_tokens_since(now, now), [row[:2] for row in rows])
+
+
+class TestMemoryStorage(StorageContract, BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.storage = MemoryStorage()
+
+
+class TestSqliteStorage(StorageContract, BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.storage = SqliteStorage()
+        self.storage.init_schema()
+
+    def test_schema_check(self):
+        """ Test that the SQLite schema is versioned like the Postgres one """
+        self.assertEqual(self.storage.ensure_schema('check'), self.storage.init_schema())
+        self.assertIsNone(self.storage.ensure_schema('skip'))
+        with self.assertRaises(SchemaOutdated):
+            SqliteStorage().ensure_schema('check')
+
+    def test_user_version_is_bumped_on_update(self):
+        """ Test that the trigger bumps the user row version on every change """
+        profile = self.storage.create_user('joe@gmail.com', 'hash', datetime.utcnow())
+        self.assertEqual(profile[4], 1)
+        self.storage._execute('UPDATE {user_table} SET is_admin = 1 WHERE id = ?;', [profile[0]])
+        self.storage._execute('UPDATE {user_table} SET password = ? WHERE id = ?;', ['other', profile[0]])
+        self.assertEqual(self.storage.get_user_version(profile[0]), 3)
+        self.assertEqual(self.storage.get_user_profile_by_id(profile[0])[4], 3)
+
+
+class TestSqliteBackedApp(BaseTestCase):
+
+    def create_app(self):
+        app = super().create_app()
+        app.config['STORAGE_BACKEND'] = 'project.storage.sqlite.SqliteStorage'
+        init_storage(app.config)
+        return app
+
+    def test_register_login_logout(self):
+        """ Test the auth flow end to end on the SQLite backend """
+        with self.client:
+            credentials = json.dumps(dict(email='joe@gmail.com', password='123456'))
+            response = self.client.post('/auth/register', data=credentials, content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+            response = self.client.post('/auth/login', data=credentials, content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            auth_token = json.loads(response.data.decode())['auth_token']
+            headers = dict(Authorization='Bearer ' + auth_token)
+            response = self.client.get('/auth/status', headers=headers)
+            self.assertEqual(json.loads(response.data.decode())['data']['email'], 'joe@gmail.com')
+            response = self.client.post('/auth/logout', headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(self.app.config['STORAGE'].get_token_hashes_since(datetime.min, datetime.utcnow()))
+
+
+class TestSchemaCheckOnStartup(BaseTestCase):
+
+    def test_flask_commands_start_with_outdated_schema(self):
+        """ Test that an outdated schema stops the application server but not the flask commands """
+        outdated = mock.patch.object(type(self.app.config['STORAGE']), 'ensure_schema',
+                                     side_effect=SchemaOutdated('outdated'))
+        with outdated, mock.patch.dict(os.environ, FLASK_RUN_FROM_CLI=''):
+            with self.assertRaises(SchemaOutdated):
+                create_app()
+        with outdated, mock.patch.dict(os.environ, FLASK_RUN_FROM_CLI='true'):
+            app = create_app()
+        self.assertIn('init-db', app.cli.commands)
+
+
+if __name__ == '__main__':
+    unittest.main()
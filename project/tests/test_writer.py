@@ -0,0 +1,126 @@
+import json
+import time
+import unittest
+from datetime import datetime, timedelta
+
+from project.db import get_db_pool
+from project.models import BlacklistToken, User, _revocation_key, _unverified_payload
+from project.storage.memory import MemoryStorage
+from project.tests.base import BaseTestCase, requires_postgres
+from project.writer import RevocationWriter
+
+
+class FailingOnceStorage(MemoryStorage):
+
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def save_tokens(self, rows):
+        self.calls += 1
+        if self.calls == 1:
+            raise RuntimeError('database is down')
+        super().save_tokens(rows)
+
+
+class TestRevocationWriter(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.writer = None
+
+    def tearDown(self):
+        if self.writer is not None:
+            self.writer.stop(timeout=5)
+        super().tearDown()
+
+    def start_writer(self, batch_size=100, flush_interval=60, queue_size=100):
+        self.writer = RevocationWriter(self.app, batch_size=batch_size, flush_interval=flush_interval,
+                                       queue_size=queue_size)
+        self.writer.retry_interval = 0.01
+        self.app.config['REVOCATION_WRITER'] = self.writer
+        return self.writer
+
+    def test_full_batch_is_written_in_one_call(self):
+        """ Test that revocations are written as one batch once the batch size is reached """
+        writer = self.start_writer(batch_size=3)
+        expires_at = datetime.utcnow() + timedelta(seconds=60)
+        for i in range(3):
+            writer.submit(bytes([i]) * 32, expires_at)
+        self.assertTrue(writer.flush(timeout=5))
+        self.assertEqual(writer.stats()['batches'], 1)
+        self.assertEqual(self.app.config['STORAGE'].get_blacklisted_token_hashes([bytes([i]) * 32 for i in range(3)]),
+                         {bytes([i]) * 32 for i in range(3)})
+        self.assertFalse(writer.is_pending(b'\x00' * 32))
+
+    def test_queued_revocation_is_visible_before_it_is_written(self):
+        """ Test that a queued revocation is found by the blacklist check before the batch is committed """
+        writer = self.start_writer()
+        token_hash = b't' * 32
+        writer.submit(token_hash, datetime.utcnow() + timedelta(seconds=60))
+        self.assertFalse(self.app.config['STORAGE'].is_token_blacklisted(token_hash))
+        self.assertTrue(BlacklistToken.is_token_hash_in_blacklist(token_hash))
+        self.assertEqual(BlacklistToken.get_blacklisted_token_hashes([token_hash, b'x' * 32]), {token_hash})
+        self.assertTrue(writer.flush(timeout=5))
+        self.assertTrue(self.app.config['STORAGE'].is_token_blacklisted(token_hash))
+
+    def test_full_queue_is_rejected(self):
+        """ Test that submit refuses revocations when the queue is full so that they are written synchronously """
+        writer = self.start_writer(queue_size=1)
+        expires_at = datetime.utcnow() + timedelta(seconds=60)
+        self.assertTrue(writer.submit(b'a' * 32, expires_at))
+        self.assertFalse(writer.submit(b'b' * 32, expires_at))
+
+    def test_failed_batch_is_retried(self):
+        """ Test that a batch is kept in the queue and written again after a database error """
+        storage = FailingOnceStorage()
+        self.app.config['STORAGE'] = storage
+        writer = self.start_writer()
+        writer.submit(b'r' * 32, datetime.utcnow() + timedelta(seconds=60))
+        self.assertTrue(writer.flush(timeout=5))
+        self.assertEqual(storage.calls, 2)
+        self.assertEqual(writer.stats()['failures'], 1)
+        self.assertTrue(storage.is_token_blacklisted(b'r' * 32))
+
+    @requires_postgres
+    def test_batch_is_retried_on_a_new_connection(self):
+        """ Test that a batch that failed on a dropped database connection is written on a fresh one """
+        pool = get_db_pool()
+        conn, killer = pool.getconn(), pool.getconn()
+        cursor = killer.cursor()
+        cursor.execute('SELECT pg_terminate_backend(%s);', [conn.get_backend_pid()])
+        while True:
+            cursor.execute('SELECT count(*) FROM pg_stat_activity WHERE pid = %s;', [conn.get_backend_pid()])
+            if not cursor.fetchone()[0]:
+                break
+            time.sleep(0.01)
+        cursor.close()
+        pool.putconn(killer)
+        # Пул отдаёт последнее возвращённое соединение, поэтому пачку понесёт оборванное соединение.
+        pool.putconn(conn)
+        writer = self.start_writer()
+        writer.submit(b'p' * 32, datetime.utcnow() + timedelta(seconds=60))
+        self.assertTrue(writer.flush(timeout=5))
+        self.assertEqual(writer.stats()['failures'], 1)
+        self.assertTrue(self.app.config['STORAGE'].is_token_blacklisted(b'p' * 32, primary=True))
+
+    def test_logout_goes_through_the_writer(self):
+        """ Test that logout answers before the revocation is committed and the token is rejected right away """
+        self.start_writer()
+        with self.client:
+            User.create('joe@gmail.com', '123456')
+            response = self.client.post('/auth/login', data=json.dumps(dict(email='joe@gmail.com', password='123456')),
+                                        content_type='application/json')
+            headers = dict(Authorization='Bearer ' + json.loads(response.data.decode())['auth_token'])
+            self.assertEqual(self.client.post('/auth/logout', headers=headers).status_code, 200)
+            auth_token = headers['Authorization'].split(' ')[1]
+            revocation_key = _revocation_key(auth_token, _unverified_payload(auth_token))
+            self.assertFalse(self.app.config['STORAGE'].is_token_blacklisted(revocation_key))
+            response = self.client.get('/auth/status', headers=headers)
+            self.assertEqual(json.loads(response.data.decode())['message'], 'Token blacklisted. Please log in again.')
+            self.assertTrue(self.writer.flush(timeout=5))
+            self.assertTrue(self.app.config['STORAGE'].is_token_blacklisted(revocation_key, primary=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,70 @@
-from flask import Blueprint, request, make_response, jsonify, current_app
+from flask import Blueprint, Response, request, make_response, jsonify, current_app, stream_with_context
 from flask.views import MethodView
 
-from project.models import User, BlacklistToken, decode_auth_token
+from project.hashing import check_password_hash, HashingPoolBusy
+from project.keys import get_keyring
+from project.models import User, BlacklistToken, decode_auth_token, decode_auth_tokens, decode_refresh_token, \
+    user_etag
 
 auth_blueprint = Blueprint('auth', __name__)
 
 
+def hashing_pool_busy_response():
+    """Ответ на запрос, для которого не нашлось места в очереди пула хеширования паролей."""
+    response_object = {
+        'status': 'fail',
+        'message': 'Service is busy. Please try again later.'
+    }
+    retry_after = str(current_app.config.get('BCRYPT_RETRY_AFTER'))
+    return make_response(jsonify(response_object)), 503, {'Retry-After': retry_after}
+
+
+def profile_cache_headers(etag):
+    """Заголовки ответа с профилем: клиент может хранить ответ, но должен проверять его через If-None-Match.
+    Ответ зависит от токена, поэтому общие кэши различают его по заголовку Authorization."""
+    return {'ETag': f'"{etag}"', 'Cache-Control': 'private, no-cache', 'Vary': 'Authorization'}
+
+
+def authenticate_admin():
+    """Проверяет токен из заголовка Authorization и права администратора его пользователя.
+    Возвращает (профиль пользователя, None) или (None, ответ с ошибкой)."""
+    auth_header = request.headers.get('Authorization')
+    if auth_header:
+        try:
+            auth_token = auth_header.split(" ")[1]
+        except IndexError:
+            response_object = {
+                'status': 'fail',
+                'message': 'Bearer token malformed.'
+            }
+            return None, (make_response(jsonify(response_object)), 401)
+    else:
+        auth_token = ''
+    if not auth_token:
+        response_object = {
+            'status': 'fail',
+            'message': 'Provide a valid auth token.'
+        }
+        return None, (make_response(jsonify(response_object)), 401)
+    resp = decode_auth_token(auth_token)
+    if isinstance(resp, str):
+        response_object = {
+            'status': 'fail',
+            'message': resp
+        }
+        return None, (make_response(jsonify(response_object)), 401)
+    # Права читаются из основной БД мимо кэша пользователей: кэш каждого процесса сбрасывается только
+    # по истечении USER_CACHE_TTL, а отзыв прав командой set-admin должен действовать сразу.
+    user = User.get_profile_by_id(user_id=resp, primary=True, cached=False)
+    if user is None or not user.is_admin:
+        response_object = {
+            'status': 'fail',
+            'message': 'Admin rights required.'
+        }
+        return None, (make_response(jsonify(response_object)), 403)
+    return user, None
+
+
 class RegisterAPI(MethodView):
     """
     API для регистрации пользователя
@@ -15,34 +74,34 @@ class RegisterAPI(MethodView):
     def post():
         """Endpoint для обработки post запросов"""
         post_data = request.get_json()
-        user_id = User.get_user_id_or_none(email=post_data.get('email'))
-
-        if not user_id:
-            try:
-                User.save(email=post_data.get('email'),
-                          password=post_data.get('password'))
-                user_dict = User.get_user_dict_by_email(email=post_data.get('email'))
-                auth_token = User.encode_auth_token(user_id=user_dict['id'])
+        try:
+            user = User.create(email=post_data.get('email'),
+                               password=post_data.get('password'))
+            if user:
+                auth_token = User.encode_auth_token(user_id=user.id)
                 if auth_token:
                     response_object = {
                         'status': 'success',
                         'message': 'Successfully registered.',
-                        'auth_token': auth_token
+                        'auth_token': auth_token,
+                        'refresh_token': User.encode_refresh_token(user_id=user.id)
                     }
                     return make_response(jsonify(response_object)), 201
-            except Exception as e:
-                print(e)
+            else:
                 response_object = {
                     'status': 'fail',
-                    'message': 'Some error occurred. Please try again.'
+                    'message': 'User already exists. Please Log in.',
                 }
-                return make_response(jsonify(response_object)), 401
-        else:
-            response_object = {
-                'status': 'fail',
-                'message': 'User already exists. Please Log in.',
-            }
-            return make_response(jsonify(response_object)), 202
+                return make_response(jsonify(response_object)), 202
+        except HashingPoolBusy:
+            return hashing_pool_busy_response()
+        except Exception as e:
+            print(e)
+        response_object = {
+            'status': 'fail',
+            'message': 'Some error occurred. Please try again.'
+        }
+        return make_response(jsonify(response_object)), 401
 
 
 class LoginAPI(MethodView):
@@ -57,17 +116,16 @@ class LoginAPI(MethodView):
         """Endpoint для обработки post запросов"""
         post_data = request.get_json()
         try:
-            user_dict = User.get_user_dict_by_email(email=post_data.get('email'))
-            if user_dict:
-                bcrypt = current_app.config['BCRYPT']
-                if bcrypt.check_password_hash(
-                        user_dict['password'], post_data.get('password')):
-                    auth_token = User.encode_auth_token(user_id=user_dict['id'])
+            user = User.get_credentials_by_email(email=post_data.get('email'))
+            if user:
+                if check_password_hash(user.password, post_data.get('password')):
+                    auth_token = User.encode_auth_token(user_id=user.id)
                     if auth_token:
                         response_object = {
                             'status': 'success',
                             'message': 'Successfully logged in.',
-                            'auth_token': auth_token
+                            'auth_token': auth_token,
+                            'refresh_token': User.encode_refresh_token(user_id=user.id)
                         }
                         return make_response(jsonify(response_object)), 200
                     else:
@@ -85,6 +143,8 @@ class LoginAPI(MethodView):
                     'message': 'User does not exist.'
                 }
                 return make_response(jsonify(response_object)), 404
+        except HashingPoolBusy:
+            return hashing_pool_busy_response()
         except Exception as e:
             print(e)
             response_object = {
@@ -119,12 +179,24 @@ class UserAPI(MethodView):
         if auth_token:
             resp = decode_auth_token(auth_token)
             if not isinstance(resp, str):
-                user_dict = User.get_user_dict_by_id(user_id=resp)
+                if request.if_none_match:
+                    # Для проверки ETag хватает версии профиля: она берётся из кэша или читается из БД одна,
+                    # а тело ответа при совпадении не собирается.
+                    version = User.get_profile_version(user_id=resp)
+                    if version is not None and request.if_none_match.contains_weak(user_etag(resp, version)):
+                        return '', 304, profile_cache_headers(user_etag(resp, version))
+                user = User.get_profile_by_id(user_id=resp)
+                if user is None:
+                    response_object = {
+                        'status': 'success',
+                        'data': {}
+                    }
+                    return make_response(jsonify(response_object)), 200
                 response_object = {
                     'status': 'success',
-                    'data': user_dict
+                    'data': user.as_dict()
                 }
-                return make_response(jsonify(response_object)), 200
+                return make_response(jsonify(response_object)), 200, profile_cache_headers(user.etag())
             response_object = {
                 'status': 'fail',
                 'message': resp
@@ -140,7 +212,8 @@ class UserAPI(MethodView):
 
 class LogoutAPI(MethodView):
     """
-    API для выхода пользователя по заголовку Authorization.
+    API для выхода пользователя по заголовку Authorization. Если в json передан refresh_token того же
+    пользователя, он тоже отзывается.
     Возвращает ответ с json со словарём с данными пользователя и status 'success', если выход прошла успешно.
     В противном случае возвращает status 'fail' и осмысленные message
     """
@@ -165,18 +238,16 @@ class LogoutAPI(MethodView):
             if not isinstance(resp, str):
                 try:
                     BlacklistToken.save(token=auth_token)
-                    if BlacklistToken.is_token_in_blacklist(token=auth_token):
-                        response_object = {
-                            'status': 'success',
-                            'message': 'Successfully logged out.'
-                        }
-                        return make_response(jsonify(response_object)), 200
-                    else:
-                        response_object = {
-                            'status': 'fail',
-                            'message': 'logout is fail'
-                        }
-                        return make_response(jsonify(response_object)), 401
+                    refresh_token = (request.get_json(silent=True) or {}).get('refresh_token')
+                    if refresh_token and decode_refresh_token(refresh_token) == resp:
+                        BlacklistToken.save(token=refresh_token)
+                    # save либо записал отзыв в БД, либо поставил его в очередь отложенной записи, и процесс
+                    # уже видит его, поэтому повторно проверять токен по БД не нужно.
+                    response_object = {
+                        'status': 'success',
+                        'message': 'Successfully logged out.'
+                    }
+                    return make_response(jsonify(response_object)), 200
                 except Exception as e:
                     response_object = {
                         'status': 'fail',
@@ -197,11 +268,192 @@ class LogoutAPI(MethodView):
             return make_response(jsonify(response_object)), 403
 
 
+class RefreshAPI(MethodView):
+    """
+    API для получения нового access токена по refresh токену из json без проверки пароля.
+    Возвращает ответ с json с auth_token и status 'success', если refresh токен действителен и не отозван,
+    в противном случае возвращает status 'fail' и осмысленные message
+    """
+
+    @staticmethod
+    def post():
+        """Endpoint для обработки post запросов"""
+        refresh_token = (request.get_json(silent=True) or {}).get('refresh_token')
+        if not isinstance(refresh_token, str) or not refresh_token:
+            response_object = {
+                'status': 'fail',
+                'message': 'Provide a valid refresh token.'
+            }
+            return make_response(jsonify(response_object)), 400
+        try:
+            resp = decode_refresh_token(refresh_token)
+            if isinstance(resp, str):
+                response_object = {
+                    'status': 'fail',
+                    'message': resp
+                }
+                return make_response(jsonify(response_object)), 401
+            if not User.get_profile_by_id(user_id=resp):
+                response_object = {
+                    'status': 'fail',
+                    'message': 'User does not exist.'
+                }
+                return make_response(jsonify(response_object)), 401
+            auth_token = User.encode_auth_token(user_id=resp)
+            if not auth_token:
+                raise Exception('Ошибка при получении токена пользователя')
+        except Exception as e:
+            print(e)
+            response_object = {
+                'status': 'fail',
+                'message': 'Try again.'
+            }
+            return make_response(jsonify(response_object)), 500
+        response_object = {
+            'status': 'success',
+            'message': 'Successfully refreshed.',
+            'auth_token': auth_token
+        }
+        return make_response(jsonify(response_object)), 200
+
+
+class IntrospectAPI(MethodView):
+    """
+    API для пакетной проверки токенов. Принимает json со списком tokens и возвращает для каждого токена
+    active и данные пользователя, если токен действителен, или active False и message в противном случае.
+    Стоимость запроса в обращениях к БД не зависит от числа токенов
+    """
+
+    @staticmethod
+    def post():
+        """Endpoint для обработки post запросов"""
+        post_data = request.get_json(silent=True) or {}
+        tokens = post_data.get('tokens')
+        max_tokens = current_app.config.get('INTROSPECT_MAX_TOKENS')
+        if not isinstance(tokens, list) or len(tokens) > max_tokens:
+            response_object = {
+                'status': 'fail',
+                'message': f'Provide a list of at most {max_tokens} tokens.'
+            }
+            return make_response(jsonify(response_object)), 400
+        try:
+            decoded = decode_auth_tokens(tokens)
+            profiles = User.get_profiles_by_ids([resp for resp in decoded if not isinstance(resp, str)])
+        except Exception as e:
+            print(e)
+            response_object = {
+                'status': 'fail',
+                'message': 'Some error occurred. Please try again.'
+            }
+            return make_response(jsonify(response_object)), 500
+        results = []
+        for resp in decoded:
+            user = profiles.get(resp) if not isinstance(resp, str) else None
+            if user:
+                results.append({'active': True, 'data': user.as_dict()})
+            else:
+                results.append({'active': False, 'message': resp if isinstance(resp, str) else 'User does not exist.'})
+        response_object = {
+            'status': 'success',
+            'results': results
+        }
+        return make_response(jsonify(response_object)), 200
+
+
+class AdminUsersAPI(MethodView):
+    """
+    API для постраничного просмотра пользователей администратором. Страница задаётся параметрами after - id
+    последнего пользователя предыдущей страницы и limit. Возвращает пользователей по возрастанию id и next_after
+    для запроса следующей страницы или None, если страница последняя
+    """
+
+    @staticmethod
+    def get():
+        """Endpoint для обработки get запросов"""
+        _, error_response = authenticate_admin()
+        if error_response is not None:
+            return error_response
+        after_id = request.args.get('after', 0, type=int)
+        limit = request.args.get('limit', current_app.config['ADMIN_USERS_PAGE_SIZE'], type=int)
+        max_limit = current_app.config['ADMIN_USERS_MAX_PAGE_SIZE']
+        if not 0 < limit <= max_limit:
+            response_object = {
+                'status': 'fail',
+                'message': f'limit must be between 1 and {max_limit}.'
+            }
+            return make_response(jsonify(response_object)), 400
+        users = User.get_profiles_page(after_id=after_id, limit=limit)
+        response_object = {
+            'status': 'success',
+            'data': [user.as_dict() for user in users],
+            'next_after': users[-1].id if len(users) == limit else None
+        }
+        return make_response(jsonify(response_object)), 200
+
+
+class AdminUsersExportAPI(MethodView):
+    """
+    API для выгрузки всех пользователей администратором в формате NDJSON: по одному json объекту на строку,
+    по возрастанию id, начиная с id больше after. Ответ отдаётся потоком по мере чтения из БД,
+    поэтому память сервера не зависит от числа пользователей. Прерванную выгрузку можно продолжить
+    с id последней полученной строки
+    """
+
+    @staticmethod
+    def get():
+        """Endpoint для обработки get запросов"""
+        _, error_response = authenticate_admin()
+        if error_response is not None:
+            return error_response
+        after_id = request.args.get('after', 0, type=int)
+        batch_size = current_app.config['ADMIN_EXPORT_BATCH_SIZE']
+
+        def generate():
+            dumps = current_app.json.dumps
+            lines = []
+            for user in User.iter_profiles(after_id=after_id, batch_size=batch_size):
+                lines.append(dumps(user.as_dict()) + '\n')
+                if len(lines) >= batch_size:
+                    yield ''.join(lines)
+                    lines = []
+            if lines:
+                yield ''.join(lines)
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+class JwksAPI(MethodView):
+    """
+    API с открытыми ключами подписи токенов в формате JWKS, чтобы другие сервисы проверяли токены сами,
+    не обращаясь к /auth/status. Ответ кэшируется клиентами на JWKS_MAX_AGE секунд и отдаётся с ETag
+    """
+
+    @staticmethod
+    def get():
+        """Endpoint для обработки get запросов"""
+        keyring = get_keyring(current_app.config)
+        if keyring is None:
+            body, etag = '{"keys": []}', 'empty'
+        else:
+            body, etag = keyring.jwks_json, keyring.jwks_etag
+        response = make_response(body)
+        response.mimetype = 'application/json'
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config.get('JWKS_MAX_AGE')
+        return response.make_conditional(request)
+
+
 # define the API resources
 registration_view = RegisterAPI.as_view('register_api')
 login_view = LoginAPI.as_view('login_api')
 user_view = UserAPI.as_view('user_api')
 logout_view = LogoutAPI.as_view('logout_api')
+refresh_view = RefreshAPI.as_view('refresh_api')
+introspect_view = IntrospectAPI.as_view('introspect_api')
+jwks_view = JwksAPI.as_view('jwks_api')
+admin_users_view = AdminUsersAPI.as_view('admin_users_api')
+admin_users_export_view = AdminUsersExportAPI.as_view('admin_users_export_api')
 
 # add Rules for API Endpoints
 auth_blueprint.add_url_rule(
@@ -224,3 +476,28 @@ auth_blueprint.add_url_rule(
     view_func=logout_view,
     methods=['POST']
 )
+auth_blueprint.add_url_rule(
+    '/auth/refresh',
+    view_func=refresh_view,
+    methods=['POST']
+)
+auth_blueprint.add_url_rule(
+    '/auth/introspect',
+    view_func=introspect_view,
+    methods=['POST']
+)
+auth_blueprint.add_url_rule(
+    '/.well-known/jwks.json',
+    view_func=jwks_view,
+    methods=['GET']
+)
+auth_blueprint.add_url_rule(
+    '/auth/admin/users',
+    view_func=admin_users_view,
+    methods=['GET']
+)
+auth_blueprint.add_url_rule(
+    '/auth/admin/users/export',
+    view_func=admin_users_export_view,
+    methods=['GET']
+)
@@ -0,0 +1,169 @@
+import atexit
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from flask import current_app
+
+from project.storage import get_storage
+
+
+class RevocationWriter:
+    """Отложенная запись отозванных токенов в БД пачками.
+
+    logout ставит отзыв в очередь процесса и сразу отвечает клиенту, а фоновый поток записывает очередь
+    многострочными вставками с одним коммитом на пачку: когда набралось batch_size отзывов или самый старый
+    отзыв ждёт flush_interval секунд. Пока отзыв не записан, процесс видит его через is_pending, а другие
+    процессы хоста - через общую таблицу отзывов, если она включена.
+
+    Если очередь заполнена (queue_size), submit возвращает False и отзыв нужно записать синхронно.
+    Отзывы в очереди теряются при аварийном завершении процесса, при обычном выходе очередь дописывается.
+    """
+
+    retry_interval = 1
+
+    def __init__(self, app, batch_size, flush_interval, queue_size):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.batches = 0
+        self.written = 0
+        self.failures = 0
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._pending = {}
+        self._in_flight = 0
+        self._flush_due = None
+        self._flush_requested = False
+        self._stopping = False
+        self._thread = None
+        self._pid = None
+
+    def _ensure_thread(self):
+        # Поток не переживает fork, а очередь родителя дописывает сам родитель.
+        if self._pid != os.getpid():
+            self._queue.clear()
+            self._pending.clear()
+            self._in_flight = 0
+            self._thread = threading.Thread(target=self._run, name='revocation-writer', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def submit(self, token_hash, expires_at):
+        """Ставит отзыв в очередь. Возвращает False, если очередь заполнена или запись остановлена."""
+        token_hash = bytes(token_hash)
+        with self._cond:
+            if self._stopping or len(self._queue) + self._in_flight >= self.queue_size:
+                return False
+            self._ensure_thread()
+            if not self._queue:
+                self._flush_due = time.monotonic() + self.flush_interval
+            self._queue.append((token_hash, expires_at))
+            self._pending[token_hash] = expires_at
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify_all()
+        return True
+
+    def is_pending(self, token_hash):
+        """Возвращает True, если отзыв токена стоит в очереди или записывается. Не берёт блокировок."""
+        return bytes(token_hash) in self._pending
+
+    def pending_entries(self):
+        """Возвращает ещё не записанные отзывы: список пар (ключ отзыва, срок действия)."""
+        with self._cond:
+            return list(self._pending.items())
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                if self._queue and (len(self._queue) >= self.batch_size or self._flush_requested or self._stopping):
+                    break
+                if self._queue:
+                    remaining = self._flush_due - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                elif self._stopping:
+                    return None
+                else:
+                    self._cond.wait()
+            batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+            self._in_flight = len(batch)
+            # Остаток очереди уже ждал, поэтому идёт следующей пачкой без задержки.
+            self._flush_due = time.monotonic()
+            return batch
+
+    def _write(self, batch):
+        # Дата записи, а не logout: синхронизация фильтров и таблиц отзывов ищет новые строки по ней
+        # с перекрытием в resync_interval, поэтому отзыв, записанный с опозданием, всё равно будет найден.
+        blacklisted_date = datetime.utcnow()
+        rows = [(token_hash, expires_at, blacklisted_date) for token_hash, expires_at in batch]
+        try:
+            get_storage().save_tokens(rows)
+        except Exception as e:
+            print(f'Возникло исключение {e} при записи пачки из {len(batch)} отозванных токенов.')
+            with self._cond:
+                self.failures += 1
+                self._queue.extendleft(reversed(batch))
+                self._in_flight = 0
+                self._cond.notify_all()
+            time.sleep(self.retry_interval)
+            return
+        with self._cond:
+            for token_hash, _ in batch:
+                self._pending.pop(token_hash, None)
+            self._in_flight = 0
+            self.batches += 1
+            self.written += len(batch)
+            if not self._queue:
+                self._flush_requested = False
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            # Контекст на каждую пачку: при его закрытии соединение возвращается в пул, а оборванное после
+            # ошибки соединение пул выбрасывает, поэтому повтор пачки идёт через новое соединение.
+            with self.app.app_context():
+                self._write(batch)
+
+    def flush(self, timeout=None):
+        """Записывает очередь без ожидания flush_interval. Возвращает True, если всё записано за timeout секунд."""
+        with self._cond:
+            if self._pid != os.getpid():
+                return not self._queue
+            self._flush_requested = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: not self._queue and not self._in_flight, timeout)
+
+    def stop(self, timeout=None):
+        """Дописывает очередь и останавливает фоновый поток. Новые отзывы после этого пишутся синхронно."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+
+    def stats(self):
+        with self._cond:
+            return {'queued': len(self._queue), 'in_flight': self._in_flight, 'batches': self.batches,
+                    'written': self.written, 'failures': self.failures}
+
+
+def init_revocation_writer(config=None):
+    """Создаёт отложенную запись отзывов, если в настройках задан REVOCATION_WRITER_BATCH_SIZE больше нуля."""
+    config = current_app.config if config is None else config
+    batch_size = config.get('REVOCATION_WRITER_BATCH_SIZE')
+    if not batch_size:
+        config['REVOCATION_WRITER'] = None
+        return
+    writer = RevocationWriter(current_app._get_current_object(), batch_size=batch_size,
+                              flush_interval=config['REVOCATION_WRITER_FLUSH_INTERVAL'],
+                              queue_size=config['REVOCATION_WRITER_QUEUE_SIZE'])
+    atexit.register(writer.stop, config['REVOCATION_WRITER_FLUSH_INTERVAL'] + writer.retry_interval)
+    config['REVOCATION_WRITER'] = writer